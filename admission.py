@@ -0,0 +1,155 @@
+from __future__ import annotations
+
+import os
+import time
+import logging
+import threading
+
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Optional
+
+import metrics
+
+log = logging.getLogger(__name__)
+
+# ADMISSION_MSG_RATE      - Messages per second a sender may sustain (default: 1)
+# ADMISSION_MSG_BURST     - Messages a sender may send back to back (default: 10)
+# ADMISSION_LOOKUP_RATE   - Record/history lookups per minute per sender (default: 6)
+# ADMISSION_LOOKUP_BURST  - Lookups a sender may make back to back (default: 3)
+# UPSTREAM_CONCURRENCY    - Upstream lookups in flight, split between dispatcher workers
+#                           (DISPATCH_PEERS, set by the dispatcher) (default: 16)
+# UPSTREAM_QUEUE_WAIT     - Seconds a lookup may wait for a free slot before being shed (default: 0.5)
+# BULK_UPSTREAM_SHARE     - Fraction of those slots bulk validation may hold at once (default: 0.25)
+# BULK_QUEUE_WAIT         - Seconds a bulk lookup may wait for a slot (default: 30)
+MSG_RATE = float(os.getenv("ADMISSION_MSG_RATE", "1"))
+MSG_BURST = float(os.getenv("ADMISSION_MSG_BURST", "10"))
+LOOKUP_RATE = float(os.getenv("ADMISSION_LOOKUP_RATE", "6")) / 60
+LOOKUP_BURST = float(os.getenv("ADMISSION_LOOKUP_BURST", "3"))
+PEERS = max(1, int(os.getenv("DISPATCH_PEERS", "1")))
+UPSTREAM_CONCURRENCY = max(1, int(os.getenv("UPSTREAM_CONCURRENCY", "16")) // PEERS)
+UPSTREAM_QUEUE_WAIT = float(os.getenv("UPSTREAM_QUEUE_WAIT", "0.5"))
+BULK_UPSTREAM_SHARE = float(os.getenv("BULK_UPSTREAM_SHARE", "0.25"))
+BULK_QUEUE_WAIT = float(os.getenv("BULK_QUEUE_WAIT", "30"))
+MAX_SENDERS = 50_000
+
+REJECTIONS = metrics.counter("admission_rejections_total", "Work shed by admission control, by reason")
+
+RATE_LIMIT_REPLY = ("Estas enviando mensajes muy rapido. "
+                    "Espera un momento y vuelve a intentarlo, por favor.")
+LOOKUP_LIMIT_REPLY = ("Ya realizaste varias consultas seguidas. "
+                      "Espera un minuto antes de consultar de nuevo, por favor.")
+BUSY_REPLY = ("En este momento tenemos alta demanda y no pudimos completar tu consulta. "
+              "Intentalo de nuevo en unos minutos, por favor.")
+
+# Verdicts from SenderLimiter.admit
+ADMIT = "admit"
+SHED_NOTIFY = "shed_notify"   # first rejection since the sender was last admitted
+SHED_SILENT = "shed_silent"   # already told; drop without replying
+
+class Rejected(Exception):
+    """A lookup was shed; `reply` is the canned message for the patient."""
+
+    def __init__(self, reason: str, reply: str, notify: bool = True):
+        super().__init__(reason)
+        self.reason = reason
+        self.reply = reply
+        self.notify = notify
+
+# ────────────────────────────── Per-sender token buckets ─────────────────────────────
+class SenderLimiter:
+    """Token bucket per sender, refilled lazily on each check.
+
+    Buckets live in an LRU capped at `max_senders`; an evicted sender simply
+    comes back with a full bucket. A sender is told it is being limited
+    once, then further messages are dropped silently until it is admitted
+    again, so a spammer can't make us spam back.
+    """
+
+    def __init__(self, name: str, rate: float, burst: float, max_senders: int = MAX_SENDERS):
+        self.name = name
+        self.rate = rate
+        self.burst = burst
+        self.max_senders = max_senders
+        self._buckets: "OrderedDict[str, list]" = OrderedDict()   # sender -> [tokens, last, warned]
+        self._lock = threading.Lock()
+
+    def admit(self, sender: str, cost: float = 1.0) -> str:
+        if self.rate <= 0:
+            return ADMIT
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.get(sender)
+            if bucket is None:
+                bucket = self._buckets[sender] = [self.burst, now, False]
+                if len(self._buckets) > self.max_senders:
+                    self._buckets.popitem(last=False)
+            else:
+                self._buckets.move_to_end(sender)
+                bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+                bucket[1] = now
+            if bucket[0] >= cost:
+                bucket[0] -= cost
+                bucket[2] = False
+                return ADMIT
+            verdict = SHED_SILENT if bucket[2] else SHED_NOTIFY
+            bucket[2] = True
+        REJECTIONS.inc(reason=self.name)
+        return verdict
+
+    def __len__(self) -> int:
+        return len(self._buckets)
+
+# ────────────────────────────── Global upstream gate ─────────────────────────────
+class UpstreamGate:
+    """Caps concurrent upstream lookups in this process.
+
+    A caller waits at most `queue_wait` seconds for a slot and is shed
+    otherwise, so a slow DOC_API ties up a bounded number of workers
+    instead of all of them.
+    """
+
+    def __init__(self, limit: int, queue_wait: float):
+        self.limit = limit
+        self.queue_wait = queue_wait
+        self._sem = threading.BoundedSemaphore(limit)
+        metrics.gauge("upstream_inflight", "Upstream lookups holding an admission slot") \
+            .set_function(lambda: self.limit - self._sem._value)
+
+    @contextmanager
+    def slot(self, wait: Optional[float] = None):
+        if not self._sem.acquire(timeout=self.queue_wait if wait is None else wait):
+            REJECTIONS.inc(reason="upstream_busy")
+            raise Rejected("upstream_busy", BUSY_REPLY)
+        try:
+            yield
+        finally:
+            self._sem.release()
+
+messages = SenderLimiter("sender_messages", MSG_RATE, MSG_BURST)
+lookups = SenderLimiter("sender_lookups", LOOKUP_RATE, LOOKUP_BURST)
+gate = UpstreamGate(UPSTREAM_CONCURRENCY, UPSTREAM_QUEUE_WAIT)
+# bulk runs share the gate with patients but never hold more than their share of it
+_bulk = threading.BoundedSemaphore(max(1, int(UPSTREAM_CONCURRENCY * BULK_UPSTREAM_SHARE)))
+
+@contextmanager
+def lookup(sender: str):
+    """Admit one upstream lookup for `sender`, or raise Rejected."""
+    verdict = lookups.admit(sender)
+    if verdict != ADMIT:
+        raise Rejected("sender_lookups", LOOKUP_LIMIT_REPLY, notify=verdict == SHED_NOTIFY)
+    with gate.slot():
+        yield
+
+@contextmanager
+def bulk_lookup():
+    """Admit one bulk-validation lookup; it queues for up to BULK_QUEUE_WAIT, then raises Rejected."""
+    deadline = time.monotonic() + BULK_QUEUE_WAIT
+    if not _bulk.acquire(timeout=BULK_QUEUE_WAIT):
+        REJECTIONS.inc(reason="bulk_busy")
+        raise Rejected("bulk_busy", BUSY_REPLY)
+    try:
+        with gate.slot(wait=max(0.0, deadline - time.monotonic())):
+            yield
+    finally:
+        _bulk.release()
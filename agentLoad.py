@@ -0,0 +1,382 @@
+from __future__ import annotations
+
+import os
+import heapq
+import logging
+import threading
+import time
+
+from typing import Callable, Dict, Iterable, Optional, Any
+
+from metrics import CACHE_REQUESTS
+
+log = logging.getLogger(__name__)
+
+# AGENT_LOAD_RECONCILE - Seconds between full re-counts against Chatwoot (default: 300)
+# AGENT_LOAD_MAX_PAGES - Safety cap on /conversations pages read per re-count (default: 200)
+# AGENT_ROSTER_REFRESH - Seconds between background refreshes of GET /agents (default: 60)
+# AGENT_ROSTER_EVENTS  - Webhook events that trigger an early roster refresh
+# HANDOFF_TTL_HOURS    - Hours a handed-off conversation stays with its agent when no
+#                        status event arrives to release it (default: 24)
+RECONCILE_SECONDS = float(os.getenv("AGENT_LOAD_RECONCILE", "300"))
+SEED_RETRY_SECONDS = 30.0
+MAX_PAGES = int(os.getenv("AGENT_LOAD_MAX_PAGES", "200"))
+ROSTER_REFRESH_SECONDS = float(os.getenv("AGENT_ROSTER_REFRESH", "60"))
+ROSTER_EVENTS = set(filter(None, os.getenv(
+    "AGENT_ROSTER_EVENTS", "agent_status_changed,assignee_changed").split(",")))
+HANDOFF_TTL_SECONDS = float(os.getenv("HANDOFF_TTL_HOURS", "24")) * 3600
+
+CONVERSATION_EVENTS = {
+    "conversation_created",
+    "conversation_status_changed",
+    "conversation_updated",
+    "assignee_changed",
+    "conversation_resolved",
+}
+
+def _assignee_id(conv: Dict[str, Any]) -> Optional[int]:
+    assignee = (conv.get("meta") or {}).get("assignee") or {}
+    agent_id = assignee.get("id") or conv.get("assignee_id")
+    return int(agent_id) if agent_id else None
+
+# ────────────────────────────── Agent Load Index ─────────────────────────────
+class AgentLoadIndex:
+    """Open-conversation count per agent, kept current from webhook events.
+
+    Seeded in the background with a paginated read of open conversations
+    (`start()`), then updated from conversation events and re-counted
+    every RECONCILE_SECONDS. Until the first seed lands every agent reads
+    as idle. Events that arrive while a seed is paging are journaled and
+    re-applied on top of it, so a re-count never undoes them. Picking the
+    least busy agent is a heap lookup; it never calls Chatwoot.
+
+    `on_seed`, if set, is called with the ids of the assigned open
+    conversations after every successful seed.
+    """
+
+    def __init__(self, client, reconcile_seconds: float = RECONCILE_SECONDS,
+                 on_seed: Optional[Callable[[Iterable[int]], None]] = None):
+        self.client = client
+        self.reconcile_seconds = reconcile_seconds
+        self.on_seed = on_seed
+        self._lock = threading.Lock()
+        self._assignee: Dict[int, int] = {}     # open conversation -> agent
+        self._counts: Dict[int, int] = {}       # agent -> open conversations
+        self._heap: list[tuple[int, int]] = []  # (count, agent), lazily pruned
+        self._seeded_at: Optional[float] = None
+        self._attempted_at: Optional[float] = None
+        self._reconciling = False
+        self._journal: Optional[Dict[int, Optional[int]]] = None   # events seen during a seed
+
+    def start(self):
+        """Seed in the background; callers are served the (empty) index meanwhile."""
+        self.maybe_reconcile()
+
+    # ── seeding / reconciliation ──
+    def seed(self) -> bool:
+        """Recount open conversations per agent from Chatwoot."""
+        with self._lock:
+            self._journal = {}
+        assignee = None
+        try:
+            assignee = self._read_open()
+        finally:
+            if assignee is None:
+                with self._lock:
+                    self._journal = None
+        if assignee is None:
+            return False
+
+        with self._lock:
+            # Webhook updates that arrived while we were paging win over the pages
+            for conv_id, agent_id in self._journal.items():
+                if agent_id is None:
+                    assignee.pop(conv_id, None)
+                else:
+                    assignee[conv_id] = agent_id
+            self._journal = None
+            counts: Dict[int, int] = {agent_id: 0 for agent_id in self._counts}
+            for agent_id in assignee.values():
+                counts[agent_id] = counts.get(agent_id, 0) + 1
+            self._assignee = assignee
+            self._counts = counts
+            self._rebuild_heap()
+            self._seeded_at = time.monotonic()
+        log.info("Agent load index seeded: %d open conversations, %d agents",
+                 len(assignee), len(counts))
+        if self.on_seed is not None:
+            try:
+                self.on_seed(list(assignee))
+            except Exception as e:
+                log.error("Agent load on_seed callback failed: %s", e)
+        return True
+
+    def _read_open(self) -> Optional[Dict[int, int]]:
+        """Open conversation -> assigned agent, or None if a page failed."""
+        assignee: Dict[int, int] = {}
+        for page in range(1, MAX_PAGES + 1):
+            result = self.client._request(
+                "GET", "/conversations",
+                params={"status": "open", "assignee_type": "all", "page": page},
+            )
+            if result is None:
+                log.warning("Agent load seed aborted at page %d", page)
+                return None
+            convs = (result.get("data") or {}).get("payload") or []
+            if not convs:
+                break
+            for conv in convs:
+                agent_id = _assignee_id(conv)
+                if conv.get("id") and agent_id:
+                    assignee[int(conv["id"])] = agent_id
+        return assignee
+
+    def maybe_reconcile(self):
+        """Kick off a background re-count when the last one is stale (or failed)."""
+        now = time.monotonic()
+        with self._lock:
+            if self._reconciling:
+                return
+            wait = self.reconcile_seconds if self._seeded_at is not None else SEED_RETRY_SECONDS
+            if self._attempted_at is not None and now - self._attempted_at < wait:
+                return
+            self._reconciling = True
+            self._attempted_at = now
+
+        def run():
+            try:
+                self.seed()
+            except Exception as e:
+                log.error("Agent load reconcile failed: %s", e)
+            finally:
+                with self._lock:
+                    self._reconciling = False
+
+        threading.Thread(target=run, name="agent-load-reconcile", daemon=True).start()
+
+    # ── updates ──
+    def apply_event(self, event: str, payload: Dict[str, Any]) -> bool:
+        """Update the index from a Chatwoot conversation webhook."""
+        if event not in CONVERSATION_EVENTS:
+            return False
+        conv_id = payload.get("id")
+        if not conv_id:
+            return False
+
+        status = payload.get("status")
+        if event == "conversation_resolved":
+            status = "resolved"
+        is_open = status == "open" if status else event == "assignee_changed"
+        self._set(int(conv_id), _assignee_id(payload) if is_open else None)
+        return True
+
+    def note_assignment(self, conversation_id: int, agent_id: int):
+        """Record an assignment we made ourselves, ahead of its webhook."""
+        self._set(int(conversation_id), int(agent_id))
+
+    def track_agents(self, agent_ids: Iterable[int]):
+        """Make sure agents with no open conversations are in the index."""
+        with self._lock:
+            for agent_id in agent_ids:
+                if agent_id not in self._counts:
+                    self._counts[agent_id] = 0
+                    heapq.heappush(self._heap, (0, agent_id))
+
+    def _set(self, conversation_id: int, agent_id: Optional[int]):
+        with self._lock:
+            if self._journal is not None:
+                self._journal[conversation_id] = agent_id
+            old = self._assignee.pop(conversation_id, None)
+            if old == agent_id:
+                if agent_id is not None:
+                    self._assignee[conversation_id] = agent_id
+                return
+            if old is not None:
+                self._bump(old, -1)
+            if agent_id is not None:
+                self._assignee[conversation_id] = agent_id
+                self._bump(agent_id, 1)
+
+    def _bump(self, agent_id: int, delta: int):
+        count = max(0, self._counts.get(agent_id, 0) + delta)
+        self._counts[agent_id] = count
+        heapq.heappush(self._heap, (count, agent_id))
+        if len(self._heap) > 4 * len(self._counts) + 64:
+            self._rebuild_heap()
+
+    def _rebuild_heap(self):
+        self._heap = [(c, a) for a, c in self._counts.items()]
+        heapq.heapify(self._heap)
+
+    # ── queries ──
+    def count(self, agent_id: int) -> int:
+        return self._counts.get(agent_id, 0)
+
+    def least_busy(self, agent_ids: Iterable[int]) -> Optional[int]:
+        """Return the candidate with the fewest open conversations."""
+        candidates = set(agent_ids)
+        if not candidates:
+            return None
+        self.maybe_reconcile()
+        self.track_agents(candidates)
+
+        with self._lock:
+            heap = self._heap
+            while heap and heap[0][0] != self._counts.get(heap[0][1]):
+                heapq.heappop(heap)  # stale entry
+            if heap and heap[0][1] in candidates:
+                return heap[0][1]
+            # Globally least busy agent is offline; pick among candidates
+            return min(candidates, key=lambda a: (self._counts.get(a, 0), a))
+
+    def snapshot(self) -> Dict[int, int]:
+        with self._lock:
+            return dict(self._counts)
+
+# ────────────────────────────── Handoff Index ─────────────────────────────
+class HandoffIndex:
+    """Conversations handed to a human agent, which the bot must stay out of.
+
+    Maps conversation id -> expiry. A successful handoff adds the
+    conversation; a status event keeps it while it is open or snoozed
+    and drops it once it is resolved or back to pending (bot-owned).
+    The TTL is a backstop for a missed event.
+    """
+
+    PURGE_EVERY = 60.0
+
+    def __init__(self, ttl_seconds: float = HANDOFF_TTL_SECONDS):
+        self.ttl = ttl_seconds
+        self._until: Dict[int, float] = {}
+        self._lock = threading.Lock()
+        self._purged_at = time.monotonic()
+
+    def add(self, conversation_id: int):
+        now = time.monotonic()
+        with self._lock:
+            self._until[int(conversation_id)] = now + self.ttl
+            if now - self._purged_at > self.PURGE_EVERY:
+                self._until = {c: t for c, t in self._until.items() if t > now}
+                self._purged_at = now
+
+    def seed(self, conversation_ids: Iterable[int]):
+        """Add conversations already assigned to an agent (e.g. handed off before a restart)."""
+        until = time.monotonic() + self.ttl
+        with self._lock:
+            for conv_id in conversation_ids:
+                self._until[int(conv_id)] = until
+
+    def discard(self, conversation_id: int):
+        with self._lock:
+            self._until.pop(int(conversation_id), None)
+
+    def __contains__(self, conversation_id) -> bool:
+        until = self._until.get(int(conversation_id))
+        if until is None:
+            return False
+        if until > time.monotonic():
+            return True
+        self.discard(conversation_id)
+        return False
+
+    def apply_event(self, event: str, payload: Dict[str, Any]) -> bool:
+        """Follow a conversation status webhook; True if it changed the index."""
+        if event not in CONVERSATION_EVENTS or not payload.get("id"):
+            return False
+        conv_id = int(payload["id"])
+        if conv_id not in self:
+            return False
+        status = "resolved" if event == "conversation_resolved" else payload.get("status")
+        if status in ("resolved", "pending"):
+            self.discard(conv_id)
+            return True
+        if status in ("open", "snoozed"):
+            self.add(conv_id)
+            return True
+        return False
+
+    def __len__(self) -> int:
+        return len(self._until)
+
+# ────────────────────────────── Agent Roster Cache ─────────────────────────────
+class AgentRoster:
+    """Last known GET /agents result, refreshed off the request path.
+
+    A daemon thread refreshes every `refresh_seconds` or as soon as
+    `invalidate()` is called. When Chatwoot is down the previous roster
+    keeps being served; only the very first load blocks a caller.
+    """
+
+    def __init__(self, client, refresh_seconds: float = ROSTER_REFRESH_SECONDS):
+        self.client = client
+        self.refresh_seconds = refresh_seconds
+        self._agents: Optional[list] = None
+        self._fetched_at: Optional[float] = None
+        self._failures = 0
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def refresh(self) -> bool:
+        agents = self.client._request("GET", "/agents")
+        if not isinstance(agents, list):
+            self._failures += 1
+            log.warning("Agent roster refresh failed (%d in a row); serving cached roster",
+                        self._failures)
+            return False
+        with self._lock:
+            self._agents = agents
+            self._fetched_at = time.monotonic()
+            self._failures = 0
+        return True
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.refresh_seconds)
+            self._wake.clear()
+            try:
+                self.refresh()
+            except Exception as e:
+                log.error("Agent roster refresh error: %s", e)
+
+    def _ensure_started(self):
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(
+                        target=self._run, name="agent-roster", daemon=True)
+                    self._thread.start()
+
+    def agents(self) -> Optional[list]:
+        """Return the cached roster, loading it inline only the first time."""
+        self._ensure_started()
+        if self._agents is None:
+            CACHE_REQUESTS.inc(cache="agent_roster", result="miss")
+            self.refresh()
+        else:
+            CACHE_REQUESTS.inc(cache="agent_roster", result="hit")
+        return self._agents
+
+    def invalidate(self):
+        """Ask the background thread to refresh now."""
+        self._ensure_started()
+        self._wake.set()
+
+    def apply_event(self, event: str) -> bool:
+        if event in ROSTER_EVENTS:
+            self.invalidate()
+            return True
+        return False
+
+    def age_seconds(self) -> Optional[float]:
+        if self._fetched_at is None:
+            return None
+        return time.monotonic() - self._fetched_at
+
+    def stats(self) -> Dict[str, Any]:
+        age = self.age_seconds()
+        return {
+            "agents": len(self._agents or []),
+            "age_seconds": round(age, 1) if age is not None else None,
+            "consecutive_failures": self._failures,
+        }
@@ -1,17 +1,34 @@
 # app.py - Updated with proper Chatwoot integration
 from dotenv import load_dotenv
 import os
-from flask import Flask, request, abort
+import logging
+from flask import Flask, request, abort, Response
 from datetime import datetime, timedelta
 
-from utils import parse_incoming
+from utils import parse_incoming, parse_phone_id
 from botFSM import ChatBot
 from whatsappAPI import send_text, AGENTS
-from chatwootWebhook import cw_bp
+from chatwootWebhook import cw_bp, _count_states
+import jsonCodec
+import metrics
+import tracing
+import capture
+import admission
+import outbox
+import delivery
+import media
+from transports import whatsapp_transport
+import whatsappAPI as wa
+from profiler import profile_bp, profiled
+from bulkValidate import bulk_bp
+from logConfig import configure_logging
 
 load_dotenv()
+configure_logging()
+log = logging.getLogger(__name__)
 
 VERIFY_TOKEN = os.getenv("VERIFY_TOKEN", "fallback")
+METRICS_TOKEN = os.getenv("METRICS_TOKEN")
 WA_PHONE_ID = os.getenv("WA_PHONE_ID")
 WA_TOKEN = os.getenv("WA_TOKEN")
 
@@ -22,7 +39,12 @@ if not all((WA_PHONE_ID, WA_TOKEN)):
     raise RuntimeError("WA_PHONE_ID and WA_TOKEN must be in en vars or .env")
 
 app = Flask(__name__)
-machines: dict[str, ChatBot] = {}
+app.register_blueprint(profile_bp)
+app.register_blueprint(bulk_bp)
+machines: dict[tuple[str, str], ChatBot] = {}   # (business phone_id, sender) -> session
+
+metrics.gauge("bot_sessions", "Live bot sessions by state").set_function(
+    lambda: _count_states(machines), label="state", channel="whatsapp")
 
 if __name__ == "__main__":
     app.register_blueprint(cw_bp)
@@ -35,7 +57,16 @@ def cleanup_old_machines():
         machines.pop(k, None)
         machine_timestamps.pop(k, None)
 
+def _message_id(payload: dict):
+    try:
+        return payload["entry"][0]["changes"][0]["value"]["messages"][0].get("id")
+    except (KeyError, IndexError, TypeError):
+        return None
+
 @app.route("/webhook", methods=["GET", "POST"])
+@metrics.timed(metrics.WEBHOOK_SECONDS, endpoint="whatsapp")
+@tracing.traced_root("webhook.whatsapp")
+@profiled
 def incoming():
     try:
         if request.method == "GET":
@@ -43,11 +74,30 @@ def incoming():
                 return request.args["hub.challenge"], 200
             return abort(403)
 
-        payload = request.get_json()
+        raw = request.get_data(cache=False)
+        capture.record("whatsapp", raw)
+
+        # Status callbacks (sent/delivered/read) outnumber messages: time them
+        # against our sends straight from the raw bytes and ack
+        statuses = jsonCodec.peek_statuses(raw) if raw else None
+        if statuses is not None:
+            delivery.observe(statuses)
+            return "EVENT_RECIEVED", 200
+
+        # Other non-message events: ack without decoding
+        if raw and jsonCodec.whatsapp_reject_reason(raw):
+            return "EVENT_RECIEVED", 200
+
+        try:
+            payload = jsonCodec.loads(raw) if raw else None
+        except jsonCodec.DecodeError:
+            payload = None
         if not payload:
             return "No payload", 400
 
         msg_type, value, sender = parse_incoming(payload)
+        phone_id = wa.number_for(parse_phone_id(payload)).phone_id
+        outbox.begin_turn(_message_id(payload))
         
         if not sender:
             return "EVENT_RECIEVED", 200
@@ -56,10 +106,24 @@ def incoming():
             # Agents reply with “@<customer> mensaje…”
             if value.startswith("@"):
                 dest, msg = value[1:].split(maxsplit=1)
-                send_text(dest, msg)
+                send_text(dest, msg, phone_id=phone_id)
             return "ok", 200
         
-        bot = machines.setdefault(sender, ChatBot(sender=sender))
+        # Per-sender flood control: say so once, then drop quietly
+        verdict = admission.messages.admit(sender)
+        if verdict != admission.ADMIT:
+            if verdict == admission.SHED_NOTIFY:
+                whatsapp_transport(phone_id).send_text(sender, admission.RATE_LIMIT_REPLY)
+            return "ok", 200
+
+        # Replies go out through the number the message arrived on
+        bot = machines.get((phone_id, sender))
+        if bot is None:
+            bot = machines.setdefault((phone_id, sender),
+                                      ChatBot(sender=sender, transport=whatsapp_transport(phone_id)))
+        root = tracing.current_span()
+        root.set(msg_type=msg_type, sender=sender, phone_id=phone_id,
+                 state_before=bot.current_state.id)
 
         if msg_type == "text":
             bot.text_op(value)
@@ -67,15 +131,24 @@ def incoming():
             bot.button_op(value)
         elif msg_type == "list":
             bot.list_op(value)
+        elif msg_type == "media":
+            bot.media_op(media.parse_media(payload))
         else:
             bot.unsupported()
 
+        root.set(state_after=bot.current_state.id)
         return "ok", 200
     
     except Exception as e:
-        print(f"Webhook error: {e}")
+        log.exception("Webhook error: %s", e)
         return "Internal error", 500
     
 @app.route("/ping")
 def ping():
     return "pong", 200
+
+@app.route("/metrics")
+def metrics_endpoint():
+    if METRICS_TOKEN and request.headers.get("Authorization") != f"Bearer {METRICS_TOKEN}":
+        return abort(401)
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
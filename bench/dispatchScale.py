@@ -0,0 +1,103 @@
+"""How webhook throughput scales with worker processes behind the dispatcher.
+
+    python -m bench.dispatchScale --workers 1,2,4,8 --patients 400 --concurrency 64 \
+        --latency docapi=200 --latency graph=60
+
+For each worker count a dispatcher front with that many worker processes
+is started against bench.fakeUpstreams, the same simulated patients as
+bench.loadTest are driven through it, and req/s, p50/p99 and the speedup
+over the first row are reported. The fakes and the front share the
+benchmark's own process, so leave a core for them when reading the
+largest counts.
+"""
+from __future__ import annotations
+
+import os
+import sys
+import json
+import time
+import argparse
+import threading
+
+from bench.fakeUpstreams import FakeUpstreams, parse_profiles
+from bench.loadTest import run_patients
+from bench.report import summarize, percentile
+
+def run_once(workers: int, env: dict, args) -> dict:
+    import dispatcher
+
+    os.environ.update(env)
+    os.environ.setdefault("LOG_LEVEL", "WARNING")
+    os.environ["FUNNEL_FILE"] = ""     # inherited by the workers: keep bench traffic out of the funnel
+    d = dispatcher.Dispatcher(workers, args.lanes).start()
+    server = dispatcher.make_front(d, "127.0.0.1", 0)
+    threading.Thread(target=server.serve_forever, name="front", daemon=True).start()
+    base_url = f"http://127.0.0.1:{server.server_port}"
+    try:
+        _wait_ready(base_url, args.startup_timeout)
+        samples, errors, elapsed = run_patients(base_url, args.patients, args.concurrency,
+                                                args.channel, args.think_time)
+    finally:
+        server.shutdown()
+        for w in d.workers:
+            if w.process is not None:
+                w.process.terminate()
+    summary = summarize(samples, elapsed)
+    every = sorted(v for values in samples.values() for v in values)
+    return {
+        "workers": workers,
+        "rps": summary["rps"],
+        "p50_ms": round(percentile(every, 50) * 1000, 1),
+        "p99_ms": round(percentile(every, 99) * 1000, 1),
+        "errors": sum(errors.values()),
+    }
+
+def _wait_ready(base_url: str, timeout: float):
+    """Worker processes import the whole app; wait until every one answers."""
+    import requests
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if requests.get(f"{base_url}/ping", timeout=2).status_code == 200:
+                return
+        except requests.RequestException:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError("workers did not come up in time")
+
+def main(argv=None) -> int:
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument("--workers", default="1,2,4", help="comma-separated worker counts")
+    ap.add_argument("--lanes", type=int, default=16)
+    ap.add_argument("--patients", type=int, default=200)
+    ap.add_argument("--concurrency", type=int, default=32)
+    ap.add_argument("--channel", choices=("whatsapp", "chatwoot", "both"), default="whatsapp")
+    ap.add_argument("--latency", action="append", default=[], metavar="UPSTREAM=MS[:P_ERR]")
+    ap.add_argument("--think-time", type=float, default=0.0)
+    ap.add_argument("--startup-timeout", type=float, default=30.0)
+    ap.add_argument("--json", dest="json_out", help="also write the rows to this file")
+    args = ap.parse_args(argv)
+
+    fakes = FakeUpstreams(parse_profiles(args.latency)).start()
+    rows = []
+    try:
+        for n in (int(x) for x in args.workers.split(",")):
+            rows.append(run_once(n, fakes.env(), args))
+            # let the previous workers' sockets and threads wind down
+            time.sleep(1.0)
+    finally:
+        fakes.stop()
+
+    base = rows[0]["rps"] or 1.0
+    print(f"{'workers':>8}{'req/s':>10}{'speedup':>9}{'p50 ms':>9}{'p99 ms':>9}{'errors':>8}")
+    for r in rows:
+        print(f"{r['workers']:>8}{r['rps']:>10}{r['rps'] / base:>8.2f}x{r['p50_ms']:>9}"
+              f"{r['p99_ms']:>9}{r['errors']:>8}")
+    print(f"({os.cpu_count()} CPUs on this machine)")
+    if args.json_out:
+        with open(args.json_out, "w") as fh:
+            json.dump(rows, fh, indent=2)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
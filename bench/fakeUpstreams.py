@@ -0,0 +1,181 @@
+"""Local stand-ins for every upstream the bot calls.
+
+One threaded HTTP server answers Graph, Chatwoot, Medicar (login, history,
+inventory), DOC_API and the rights service under fixed path prefixes.
+Each upstream gets its own latency and error profile so a load test can
+reproduce a slow DOC_API or a flaky Graph without touching production.
+"""
+from __future__ import annotations
+
+import json
+import math
+import random
+import threading
+import time
+import itertools
+
+from dataclasses import dataclass
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from typing import Dict, Optional
+
+UPSTREAMS = ("graph", "chatwoot", "login", "history", "inventory", "docapi", "rights")
+
+@dataclass
+class Profile:
+    """Latency is log-normal around `median_ms`; `p_error` of calls return 500."""
+    median_ms: float = 20.0
+    sigma: float = 0.5
+    p_error: float = 0.0
+
+    def delay(self) -> float:
+        if self.median_ms <= 0:
+            return 0.0
+        return self.median_ms * math.exp(random.gauss(0.0, self.sigma)) / 1000.0
+
+def parse_profiles(specs: list[str]) -> Dict[str, Profile]:
+    """Parse ["docapi=300:0.05", "graph=80"] into profiles (median_ms[:p_error])."""
+    profiles = {name: Profile() for name in UPSTREAMS}
+    for spec in specs:
+        name, _, rest = spec.partition("=")
+        if name not in profiles:
+            raise ValueError(f"unknown upstream {name!r}; expected one of {UPSTREAMS}")
+        median, _, p_err = rest.partition(":")
+        profiles[name] = Profile(float(median), p_error=float(p_err or 0))
+    return profiles
+
+# ────────────────────────────── Canned responses ─────────────────────────────
+_ids = itertools.count(1)
+
+def _affiliate(doc: str) -> dict:
+    return {"TIPODOCUMENTO": "CC", "DOCUMENTO": doc, "PRIMER_NOMBRE": "PACIENTE",
+            "PRIMER_APELLIDO": "PRUEBA", "ESTADO": "ACTIVO"}
+
+def _history(doc: str) -> dict:
+    return {"data": [{"SSCs": [
+        {"Centro": "101", "NombCaf": "SEDE PRUEBA 000101", "FecSol": "01/01/2025",
+         "Articulos": [
+             {"Plu": "P1", "Descripcion": "ACETAMINOFEN 500MG", "CantidadPendiente": 2,
+              "CodMol": "M1", "InventarioMoleculaCentro": 0, "TotalPendienteMoleculaCentro": 2},
+             {"Plu": "P2", "Descripcion": "LOSARTAN 50MG", "CantidadPendiente": 30,
+              "CodMol": "M2", "InventarioMoleculaCentro": 0, "TotalPendienteMoleculaCentro": 30},
+         ]},
+        {"Centro": "920", "NombCaf": "CENTRAL DOMICILIO 000920", "FecSol": "02/01/2025",
+         "Articulos": [
+             {"Plu": "P3", "Descripcion": "METFORMINA 850MG", "CantidadPendiente": 60,
+              "CodMol": "M3", "InventarioMoleculaCentro": 0, "TotalPendienteMoleculaCentro": 60},
+         ]},
+    ]}]}
+
+def _route(method: str, path: str, body: dict) -> tuple[str, object]:
+    """Map a request to (upstream name, JSON response)."""
+    if path.startswith("/graph/"):
+        return "graph", {"messaging_product": "whatsapp",
+                         "messages": [{"id": f"wamid.fake{next(_ids)}"}]}
+    if path.startswith("/chatwoot/"):
+        if path.endswith("/agents"):
+            return "chatwoot", [{"id": i, "name": f"Agente {i}", "availability_status": "online"}
+                                for i in range(2, 7)]
+        if path.endswith("/conversations") and method == "GET":
+            return "chatwoot", {"data": {"meta": {}, "payload": []}}
+        return "chatwoot", {"id": next(_ids)}
+    if path == "/medicar/auth/login":
+        return "login", {"access_token": "fake-token"}
+    if path.startswith("/medicar/historico-dispensaciones"):
+        return "history", _history(str(body.get("NumeroDocumento", "")))
+    if path == "/inventory":
+        return "inventory", [{"Inventario": random.choice((0, 5, 100))}]
+    if path == "/docapi":
+        return "docapi", _affiliate(str(body.get("documento", "")))
+    if path == "/rights/token":
+        return "rights", {"access_token": "fake-rights-token"}
+    if path == "/rights/validate":
+        return "rights", {"resourceType": "Bundle", "entry": []}
+    return "", None
+
+# ────────────────────────────── Server ─────────────────────────────
+class FakeUpstreams:
+    def __init__(self, profiles: Optional[Dict[str, Profile]] = None,
+                 host: str = "127.0.0.1", port: int = 0):
+        self.profiles = profiles or {name: Profile() for name in UPSTREAMS}
+        self.calls: Dict[str, int] = {name: 0 for name in UPSTREAMS}
+        self._lock = threading.Lock()
+        fakes = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def _handle(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                raw = self.rfile.read(length) if length else b""
+                try:
+                    body = json.loads(raw) if raw and raw[:1] in b"{[" else {}
+                except ValueError:
+                    body = {}
+                if not body and raw and b"=" in raw:
+                    from urllib.parse import parse_qsl
+                    body = dict(parse_qsl(raw.decode()))
+
+                name, payload = _route(self.command, self.path.split("?")[0], body)
+                if not name:
+                    return self._reply(404, {"error": "unknown path"})
+
+                with fakes._lock:
+                    fakes.calls[name] += 1
+                profile = fakes.profiles[name]
+                time.sleep(profile.delay())
+                if profile.p_error and random.random() < profile.p_error:
+                    return self._reply(500, {"error": "injected failure"})
+                self._reply(200, payload)
+
+            def _reply(self, status: int, payload):
+                data = json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            do_GET = do_POST = do_PATCH = do_PUT = _handle
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever,
+                                       name="fake-upstreams", daemon=True)
+
+    @property
+    def url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def env(self) -> Dict[str, str]:
+        """Environment that points the app at these fakes."""
+        base = self.url
+        return {
+            "GRAPH_API_URL": f"{base}/graph",
+            "WA_PHONE_ID": "100000000000001",
+            "WA_TOKEN": "fake",
+            "VERIFY_TOKEN": "fake",
+            "CHATWOOT_URL": f"{base}/chatwoot",
+            "CHATWOOT_ACCOUNT_ID": "1",
+            "CHATWOOT_BOT_TOKEN": "fake",
+            "CHATWOOT_WEBHOOK_TOKEN": "SKIP",
+            "MEDICAR_BASE_URL": f"{base}/medicar",
+            "MEDICAR_EMAIL": "bench@example.com",
+            "MEDICAR_PASSWORD": "fake",
+            "INV_URL": f"{base}/inventory",
+            "DOC_API_URL": f"{base}/docapi",
+            "RIGHTS_TOKEN_URL": f"{base}/rights/token",
+            "RIGHTS_VALIDATE_URL": f"{base}/rights/validate",
+            "HUMAN_AGENTS": "",
+        }
+
+    def start(self) -> "FakeUpstreams":
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
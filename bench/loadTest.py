@@ -0,0 +1,174 @@
+"""Drive simulated patients through the full bot against local fake upstreams.
+
+    python -m bench.loadTest --patients 50 --channel both \
+        --latency docapi=300:0.02 --latency graph=80
+
+Every upstream (Graph, Chatwoot, Medicar, DOC_API, rights, inventory) is
+served by bench.fakeUpstreams, so nothing leaves the machine. Each patient
+walks welcome -> terms -> doc type -> doc number -> medication status
+through /webhook or /chatwoot/webhook, and the webhook latency of every
+turn is reported as p50/p95/p99 per turn type, plus requests per second.
+"""
+from __future__ import annotations
+
+import os
+import sys
+import json
+import time
+import argparse
+import threading
+
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Tuple
+
+from bench.fakeUpstreams import FakeUpstreams, parse_profiles
+from bench.report import summarize, print_table
+
+# (turn name, message type, value) for one patient, in order
+WHATSAPP_TURNS = [
+    ("hello", "text", "hola"),
+    ("terms", "button", "yes"),
+    ("doc_type", "list", "CC"),
+    ("doc_num", "text", "{doc}"),
+    ("menu_med_status", "list", "ESTADO_MED"),
+]
+CHATWOOT_TURNS = [
+    ("hello", "hola"),
+    ("terms", "acepto"),
+    ("doc_type", "CC"),
+    ("doc_num", "{doc}"),
+    ("menu_med_status", "1"),
+]
+
+def whatsapp_payload(sender: str, msg_type: str, value: str) -> dict:
+    if msg_type == "text":
+        msg = {"type": "text", "text": {"body": value}}
+    elif msg_type == "button":
+        msg = {"type": "interactive",
+               "interactive": {"type": "button_reply", "button_reply": {"id": value, "title": value}}}
+    else:
+        msg = {"type": "interactive",
+               "interactive": {"type": "list_reply", "list_reply": {"id": value, "title": value}}}
+    msg.update({"from": sender, "id": f"wamid.in.{sender}.{time.monotonic_ns()}",
+                "timestamp": str(int(time.time()))})
+    return {"object": "whatsapp_business_account", "entry": [{"id": "0", "changes": [{
+        "field": "messages",
+        "value": {"messaging_product": "whatsapp",
+                  "metadata": {"display_phone_number": "570000000000",
+                               "phone_number_id": os.environ.get("WA_PHONE_ID", "")},
+                  "contacts": [{"wa_id": sender, "profile": {"name": "Paciente"}}],
+                  "messages": [msg]}}]}]}
+
+def chatwoot_payload(contact_id: int, conversation_id: int, phone: str, content: str) -> dict:
+    return {
+        "event": "message_created",
+        "id": time.monotonic_ns(),
+        "content": content,
+        "message_type": "incoming",
+        "conversation": {"id": conversation_id, "status": "pending", "inbox_id": 1},
+        "sender": {"id": contact_id, "name": "Paciente", "phone_number": f"+{phone}", "type": "contact"},
+        "inbox": {"id": 1, "name": "WhatsApp"},
+        "account": {"id": 1},
+    }
+
+# ────────────────────────────── App under test ─────────────────────────────
+def start_app(env: Dict[str, str], host: str = "127.0.0.1"):
+    """Import the app with `env` applied and serve it on a free local port."""
+    os.environ.update(env)
+    os.environ.setdefault("LOG_LEVEL", "WARNING")
+    os.environ["FUNNEL_FILE"] = ""     # simulated patients are not funnel traffic
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+    from werkzeug.serving import make_server
+    from app import app
+    from chatwootWebhook import cw_bp
+    if "chatwoot" not in app.blueprints:
+        app.register_blueprint(cw_bp)
+
+    server = make_server(host, 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, name="app-under-test", daemon=True).start()
+    return server, f"http://{host}:{server.server_port}"
+
+# ────────────────────────────── Patients ─────────────────────────────
+def run_patients(base_url: str, patients: int, concurrency: int, channel: str,
+                 think_time: float = 0.0) -> Tuple[Dict[str, List[float]], Dict[str, int], float]:
+    import requests
+
+    samples: Dict[str, List[float]] = defaultdict(list)
+    errors: Dict[str, int] = defaultdict(int)
+    lock = threading.Lock()
+
+    def record(turn: str, started: float, ok: bool):
+        elapsed = time.perf_counter() - started
+        with lock:
+            samples[turn].append(elapsed)
+            if not ok:
+                errors[turn] += 1
+
+    def patient(i: int):
+        http = requests.Session()
+        phone = f"57300{i:07d}"
+        doc = f"{1000000000 + i}"
+        use_chatwoot = channel == "chatwoot" or (channel == "both" and i % 2)
+        prefix = "cw_" if use_chatwoot else "wa_"
+        turns: List[Tuple[str, Callable[[], object]]] = []
+        if use_chatwoot:
+            for name, content in CHATWOOT_TURNS:
+                body = chatwoot_payload(100000 + i, 500000 + i, phone, content.format(doc=doc))
+                turns.append((name, lambda b=body: http.post(f"{base_url}/chatwoot/webhook", json=b)))
+        else:
+            for name, kind, value in WHATSAPP_TURNS:
+                body = whatsapp_payload(phone, kind, value.format(doc=doc))
+                turns.append((name, lambda b=body: http.post(f"{base_url}/webhook", json=b)))
+
+        for name, send in turns:
+            started = time.perf_counter()
+            try:
+                resp = send()
+                ok = resp.status_code < 400
+            except Exception:
+                ok = False
+            record(prefix + name, started, ok)
+            if think_time:
+                time.sleep(think_time)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(patient, range(patients)))
+    return samples, errors, time.perf_counter() - started
+
+def main(argv=None) -> int:
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument("--patients", type=int, default=20)
+    ap.add_argument("--concurrency", type=int, default=10)
+    ap.add_argument("--channel", choices=("whatsapp", "chatwoot", "both"), default="whatsapp")
+    ap.add_argument("--latency", action="append", default=[], metavar="UPSTREAM=MS[:P_ERR]",
+                    help="median latency and error rate per upstream; repeatable")
+    ap.add_argument("--think-time", type=float, default=0.0, help="seconds between a patient's turns")
+    ap.add_argument("--json", dest="json_out", help="also write the summary to this file")
+    args = ap.parse_args(argv)
+
+    fakes = FakeUpstreams(parse_profiles(args.latency)).start()
+    server, base_url = start_app(fakes.env())
+    try:
+        samples, errors, elapsed = run_patients(base_url, args.patients, args.concurrency,
+                                                args.channel, args.think_time)
+    finally:
+        server.shutdown()
+        fakes.stop()
+
+    summary = summarize(samples, elapsed)
+    summary["errors"] = dict(errors)
+    summary["upstream_calls"] = fakes.calls
+    print_table(summary)
+    if errors:
+        print(f"errors: {dict(errors)}")
+    print(f"upstream calls: {fakes.calls}")
+    if args.json_out:
+        with open(args.json_out, "w") as fh:
+            json.dump(summary, fh, indent=2)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
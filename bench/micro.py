@@ -0,0 +1,303 @@
+"""Microbenchmarks for the pure-Python code that runs on every message.
+
+    python -m bench.micro                       # run and print
+    python -m bench.micro --save                # record bench/baseline.json
+    python -m bench.micro --compare             # run and flag regressions vs the baseline
+    python -m bench.micro -k extract --samples 50
+
+No network is touched: inventory lookups, record lookups and sends are
+stubbed. Each bench is calibrated so one sample takes ~SAMPLE_MS, and
+every sample is stored, so --compare can run a Mann-Whitney test against
+the baseline instead of eyeballing medians. A bench is flagged when it is
+both significantly slower (p < --alpha) and slower by more than
+--threshold; --compare exits 1 if anything is flagged, for CI.
+
+Baselines are machine-specific: record and compare on the same box. The
+committed bench/baseline.json names the machine it was recorded on
+(python, cpu, cpus); re-record it with --save before comparing elsewhere.
+"""
+from __future__ import annotations
+
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import statistics
+
+from typing import Callable, Dict, List, Tuple
+
+from bench.report import mann_whitney_greater
+
+# utils and chatwootWebhook read these at import time; nothing is ever sent to them here
+for _var in ("DOC_API_URL", "MEDICAR_BASE_URL", "INV_URL", "CHATWOOT_URL"):
+    os.environ.setdefault(_var, "http://127.0.0.1:9")
+for _var, _value in (("CHATWOOT_ACCOUNT_ID", "1"), ("CHATWOOT_BOT_TOKEN", "bench"),
+                     ("CHATWOOT_WEBHOOK_TOKEN", "bench")):
+    os.environ.setdefault(_var, _value)
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+# the FSM walks would otherwise append fake windows to the production funnel file
+os.environ["FUNNEL_FILE"] = ""
+
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+SAMPLE_MS = 20.0
+
+# ────────────────────────────── Fixtures ─────────────────────────────
+def _wa_message(msg: dict) -> dict:
+    msg = {"from": "573001234567", "id": "wamid.HBgMNTczMDAxMjM0NTY3FQIAEhgUM0FCRDE=",
+           "timestamp": "1718049600", **msg}
+    return {"object": "whatsapp_business_account", "entry": [{
+        "id": "102290129340398",
+        "changes": [{"field": "messages", "value": {
+            "messaging_product": "whatsapp",
+            "metadata": {"display_phone_number": "573000000000", "phone_number_id": "106540352242922"},
+            "contacts": [{"profile": {"name": "Maria Lopez"}, "wa_id": "573001234567"}],
+            "messages": [msg],
+        }}],
+    }]}
+
+WA_PAYLOADS = [
+    _wa_message({"type": "text", "text": {"body": "1.023.456.789"}}),
+    _wa_message({"type": "interactive", "interactive": {
+        "type": "button_reply", "button_reply": {"id": "yes", "title": "Acepto"}}}),
+    _wa_message({"type": "interactive", "interactive": {
+        "type": "list_reply", "list_reply": {"id": "ESTADO_MED", "title": "Estado del Medicamento"}}}),
+    _wa_message({"type": "image", "image": {"id": "1479537139650973", "mime_type": "image/jpeg"}}),
+]
+
+def _wa_statuses(*statuses: str) -> bytes:
+    import jsonCodec
+    value = {"messaging_product": "whatsapp",
+             "metadata": {"display_phone_number": "573000000000", "phone_number_id": "106540352242922"},
+             "statuses": [{"id": f"wamid.HBgMNTczMDAxMjM0NTY3FQIAERgS{i:04d}", "status": s,
+                           "timestamp": "1718049600", "recipient_id": "573001234567",
+                           "conversation": {"id": "c1", "origin": {"type": "service"}},
+                           "pricing": {"billable": True, "pricing_model": "CBP", "category": "service"}}
+                          for i, s in enumerate(statuses)]}
+    return jsonCodec.dumps({"object": "whatsapp_business_account", "entry": [{
+        "id": "102290129340398", "changes": [{"field": "messages", "value": value}]}]})
+
+STATUS_PAYLOADS = [_wa_statuses("sent"), _wa_statuses("delivered"), _wa_statuses("read", "read")]
+
+PHONES = ["+57 300 123 4567", "+573001234567", "(300) 123-4567", "57 300-123-4567"]
+DATES = ["03/06/2024 08:15:00", "28/02/2024", "", None, "2024-06-03"]
+
+# what patients actually type at the Chatwoot doc-type and menu prompts
+DOC_TYPE_INPUTS = ["CC", "cc", "1", "Cédula de Ciudadanía", "cedula", "TI - Tarjeta de Identidad",
+                   "tarjeta de identidad", "registro civil", "pasaporte", "CE 1023456"]
+MENU_INPUTS = ["1", "2)", "Estado del Medicamento", "quiero saber de mi medicamento",
+               "horarios", "a domicilio por favor", "hablar con un asesor", "OTROS", "gracias"]
+
+HANDOFF_CONTEXT = {
+    "doc_type": "CC", "doc_num": "1023456789", "first_name": "Maria",
+    "status": "Activo", "current_state": "Menu", "last_query": "Necesito hablar con alguien",
+}
+
+def _history():
+    from utils import HistoryRecord
+    return [
+        HistoryRecord(plu="P1", descripcion="LOSARTAN 50MG TABLETA", cant_pendiente=30,
+                      inventario_centro=0, centro="920", total_pendiente_centro=30,
+                      cod_mol="M1", nom_centro="CENTRAL DOMICILIO 000920"),
+        HistoryRecord(plu="P2", descripcion="METFORMINA 850MG TABLETA", cant_pendiente=60,
+                      inventario_centro=0, centro="101", total_pendiente_centro=60,
+                      cod_mol="M2", nom_centro="BARRANQUILLA NORTE 000101"),
+        HistoryRecord(plu="P3", descripcion="ATORVASTATINA 20MG TABLETA", cant_pendiente=30,
+                      inventario_centro=0, centro="101", total_pendiente_centro=30,
+                      cod_mol="M3", nom_centro="BARRANQUILLA NORTE 000101"),
+        HistoryRecord(plu="P4", descripcion="INSULINA GLARGINA 100UI/ML", cant_pendiente=0,
+                      inventario_centro=0, centro="102", total_pendiente_centro=0,
+                      cod_mol="M4", nom_centro="SOLEDAD 000102"),
+    ]
+
+# ────────────────────────────── Benches ─────────────────────────────
+class _NullTransport:
+    """Accepts every send and does nothing; keeps Graph/Chatwoot out of FSM benches."""
+    channel = "bench"
+
+    def send_text(self, *a, **kw):
+        return None
+
+    send_two_buttons = sendDocType = sendMenu = relay_to_agents = send_text
+
+def _stub(module, **attrs):
+    for name, value in attrs.items():
+        setattr(module, name, value)
+
+def build_benches() -> Dict[str, Callable[[], object]]:
+    """name -> zero-argument callable doing one representative unit of work."""
+    import utils
+    import botFSM
+    import delivery
+    import jsonCodec
+    import admission
+    import chatwootWebhook
+    from agentLoad import AgentLoadIndex, AgentRoster
+
+    inventory = {("920", "M1"): 10, ("101", "M2"): 60, ("101", "M3"): 0}
+    _stub(utils, get_token=lambda *a: "token",
+          get_inventory=lambda centro, cod_mol, token, **kw: inventory.get((centro, cod_mol), 0))
+    _stub(botFSM, fetch_record=lambda doc_type, doc_num: {"PRIMER_NOMBRE": "MARIA", "ESTADO": "ACTIVO"})
+    _stub(admission.lookups, rate=0)    # the dispatch walk would otherwise be rate limited
+
+    for raw in STATUS_PAYLOADS:
+        for wamid, _, _ in jsonCodec.peek_statuses(raw):
+            delivery.tracker.sent(wamid, "106540352242922")
+
+    history = _history()
+    transport = _NullTransport()
+    handoff = chatwootWebhook.AgentHandoff(None, AgentLoadIndex(None), AgentRoster(None))
+
+    def fsm_walk():
+        bot = botFSM.ChatBot("573001234567", transport=transport)
+        bot.text_op("hola")
+        bot.button_op("yes")
+        bot.list_op("CC")
+        bot.text_op("1.023.456.789")
+        return bot
+
+    return {
+        "parse_incoming": lambda: [utils.parse_incoming(p) for p in WA_PAYLOADS],
+        "status_fast_path": lambda: [delivery.observe(jsonCodec.peek_statuses(raw))
+                                     for raw in STATUS_PAYLOADS],
+        "clean_phone_number": lambda: [utils.clean_phone_number(p) for p in PHONES],
+        "parse_date": lambda: [utils._parse_date(d) for d in DATES],
+        "extract_doc_type": lambda: [chatwootWebhook.extract_doc_type(t) for t in DOC_TYPE_INPUTS],
+        "extract_menu_option": lambda: [chatwootWebhook.extract_menu_option(t) for t in MENU_INPUTS],
+        "chatbot_construct": lambda: botFSM.ChatBot("573001234567", transport=transport),
+        "chatbot_dispatch": fsm_walk,
+        "med_status_msg": lambda: utils.med_status_msg(history),
+        "format_context_message": lambda: handoff._format_context_message(HANDOFF_CONTEXT),
+    }
+
+# ────────────────────────────── Runner ─────────────────────────────
+def _calibrate(fn: Callable[[], object], warmup_calls: int = 10) -> int:
+    # The first calls fill caches and compile regexes; sizing the loop from
+    # them would pick far too few loops for the cheap benches
+    for _ in range(warmup_calls):
+        fn()
+    loops = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(loops):
+            fn()
+        if (time.perf_counter() - start) * 1000 >= SAMPLE_MS / 10 or loops >= 1 << 20:
+            break
+        loops *= 2
+    per_call = (time.perf_counter() - start) / loops
+    return max(1, int(SAMPLE_MS / 1000 / per_call))
+
+def measure(fn: Callable[[], object], samples: int, warmup: int = 3) -> Tuple[List[float], int]:
+    """Per-call seconds for `samples` samples of `loops` calls each."""
+    loops = _calibrate(fn)
+    out: List[float] = []
+    for i in range(warmup + samples):
+        start = time.perf_counter()
+        for _ in range(loops):
+            fn()
+        if i >= warmup:
+            out.append((time.perf_counter() - start) / loops)
+    return out, loops
+
+def _cpu_model() -> str:
+    try:
+        with open("/proc/cpuinfo") as fh:
+            for line in fh:
+                if line.startswith("model name"):
+                    return line.split(":", 1)[1].strip()
+    except OSError:
+        pass
+    return platform.processor()
+
+def run(names: List[str], benches: Dict[str, Callable[[], object]], samples: int) -> dict:
+    results = {}
+    for name in names:
+        values, loops = measure(benches[name], samples)
+        results[name] = {"loops": loops, "samples": values}
+    return {
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "cpu": _cpu_model(),
+        "cpus": os.cpu_count(),
+        "node": platform.node(),
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "results": results,
+    }
+
+def compare(baseline: dict, current: dict, alpha: float, threshold: float) -> List[dict]:
+    rows = []
+    for name, cur in current["results"].items():
+        base = baseline["results"].get(name)
+        if base is None:
+            rows.append({"name": name, "status": "new", "now_us": statistics.median(cur["samples"]) * 1e6})
+            continue
+        b_med = statistics.median(base["samples"])
+        c_med = statistics.median(cur["samples"])
+        change = c_med / b_med - 1 if b_med else 0.0
+        p = mann_whitney_greater(base["samples"], cur["samples"])
+        status = "SLOWER" if p < alpha and change > threshold else "ok"
+        rows.append({"name": name, "status": status, "base_us": b_med * 1e6,
+                     "now_us": c_med * 1e6, "change": change, "p": p})
+    return rows
+
+def _print_results(data: dict):
+    print(f"{'bench':<26}{'loops':>9}{'median us':>12}{'p5 us':>10}{'p95 us':>10}")
+    for name, row in data["results"].items():
+        vals = sorted(row["samples"])
+        q = statistics.quantiles(vals, n=20) if len(vals) > 1 else [vals[0], vals[0]]
+        print(f"{name:<26}{row['loops']:>9}{statistics.median(vals) * 1e6:>12.2f}"
+              f"{q[0] * 1e6:>10.2f}{q[-1] * 1e6:>10.2f}")
+
+def _print_comparison(rows: List[dict]):
+    print(f"{'bench':<26}{'base us':>10}{'now us':>10}{'change':>9}{'p':>10}  status")
+    for r in rows:
+        if r["status"] == "new":
+            print(f"{r['name']:<26}{'-':>10}{r['now_us']:>10.2f}{'-':>9}{'-':>10}  new")
+            continue
+        print(f"{r['name']:<26}{r['base_us']:>10.2f}{r['now_us']:>10.2f}"
+              f"{r['change']:>+9.1%}{r['p']:>10.2g}  {r['status']}")
+
+def main(argv=None) -> int:
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument("-k", dest="match", default="", help="only benches whose name contains this")
+    ap.add_argument("--samples", type=int, default=30)
+    ap.add_argument("--save", action="store_true", help="write results as the new baseline")
+    ap.add_argument("--compare", action="store_true", help="compare against the baseline")
+    ap.add_argument("--baseline", default=BASELINE_FILE)
+    ap.add_argument("--alpha", type=float, default=0.01, help="significance level for --compare")
+    ap.add_argument("--threshold", type=float, default=0.05,
+                    help="minimum relative slowdown worth flagging (0.05 = 5%%)")
+    args = ap.parse_args(argv)
+
+    benches = build_benches()
+    names = [n for n in benches if args.match in n]
+    current = run(names, benches, args.samples)
+
+    if args.compare:
+        try:
+            with open(args.baseline) as fh:
+                baseline = json.load(fh)
+        except FileNotFoundError:
+            print(f"no baseline at {args.baseline}; record one with --save")
+            return 2
+        if baseline.get("python") != current["python"] or baseline.get("node") != current["node"]:
+            print(f"warning: baseline was recorded on {baseline.get('node')} / Python "
+                  f"{baseline.get('python')}; timings may not be comparable")
+        rows = compare(baseline, current, args.alpha, args.threshold)
+        _print_comparison(rows)
+        slower = [r["name"] for r in rows if r["status"] == "SLOWER"]
+        if slower:
+            print(f"\nsignificant slowdowns: {', '.join(slower)}")
+            return 1
+    else:
+        _print_results(current)
+
+    if args.save:
+        with open(args.baseline, "w") as fh:
+            json.dump(current, fh, indent=1)
+        print(f"\nbaseline written to {args.baseline}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
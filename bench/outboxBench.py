@@ -0,0 +1,130 @@
+"""Measure outbox enqueue and drain throughput.
+
+    python -m bench.outboxBench --messages 20000 --threads 16 --recipients 500
+    python -m bench.outboxBench --sync FULL --commit-ms 2 --send-ms 80
+
+Enqueue: --threads request threads each put their share of --messages,
+waiting for the group commit like a webhook does; reports puts/s and
+p50/p99 put latency. Drain: a fake channel that takes --send-ms per
+message (and fails --error-rate of them) is registered and the outbox is
+drained to empty; reports deliveries/s and checks that every recipient
+received its messages in order.
+"""
+from __future__ import annotations
+
+import os
+import sys
+import time
+import random
+import argparse
+import tempfile
+import threading
+
+from collections import defaultdict
+from typing import Dict, List
+
+from bench.report import percentile
+from outbox import Outbox
+
+def run_enqueue(box: Outbox, messages: int, threads: int, recipients: int) -> dict:
+    latencies: List[float] = []
+    lock = threading.Lock()
+
+    def worker(t: int):
+        mine = []
+        for i in range(t, messages, threads):
+            start = time.perf_counter()
+            recipient = f"r{i % recipients}"
+            box.put("bench", recipient, "send", [recipient, i], idem_key=f"m{i}")
+            mine.append(time.perf_counter() - start)
+        with lock:
+            latencies.extend(mine)
+
+    started = time.perf_counter()
+    pool = [threading.Thread(target=worker, args=(t,)) for t in range(threads)]
+    for t in pool:
+        t.start()
+    for t in pool:
+        t.join()
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+    return {
+        "messages": messages,
+        "elapsed_s": round(elapsed, 3),
+        "puts_per_s": round(messages / elapsed, 1),
+        "p50_ms": round(percentile(latencies, 50) * 1000, 3),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 3),
+    }
+
+def run_drain(box: Outbox, messages: int, send_ms: float, error_rate: float) -> dict:
+    received: Dict[str, List[int]] = defaultdict(list)
+    lock = threading.Lock()
+    attempts = [0]
+
+    def deliver(call: str, args: list, key: str):
+        with lock:
+            attempts[0] += 1
+        if send_ms:
+            time.sleep(send_ms / 1000)
+        if error_rate and random.random() < error_rate:
+            raise RuntimeError("injected failure")
+        with lock:
+            received[args[0]].append(args[1])
+
+    box.register("bench", deliver)
+    started = time.perf_counter()
+    delivered = 0
+    while delivered < messages:
+        n = box.drain_once()
+        delivered += n
+        if not n:
+            # everything left is waiting out a retry backoff; make it due now
+            box._db().execute("UPDATE outbox SET next_at = 0 WHERE state = 'pending'")
+    elapsed = time.perf_counter() - started
+    in_order = all(seq == sorted(seq) for seq in received.values())
+    return {
+        "delivered": delivered,
+        "attempts": attempts[0],
+        "elapsed_s": round(elapsed, 3),
+        "deliveries_per_s": round(delivered / elapsed, 1),
+        "per_recipient_order": "ok" if in_order else "VIOLATED",
+    }
+
+def main(argv=None) -> int:
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument("--messages", type=int, default=10000)
+    ap.add_argument("--threads", type=int, default=16)
+    ap.add_argument("--recipients", type=int, default=500)
+    ap.add_argument("--sync", default="NORMAL", choices=["OFF", "NORMAL", "FULL"])
+    ap.add_argument("--commit-ms", type=float, default=1.0, help="group commit window")
+    ap.add_argument("--workers", type=int, default=8, help="drain workers")
+    ap.add_argument("--send-ms", type=float, default=0.0, help="simulated upstream latency")
+    ap.add_argument("--error-rate", type=float, default=0.0)
+    ap.add_argument("--path", help="outbox file (default: a temp file)")
+    args = ap.parse_args(argv)
+
+    tmpdir = None
+    path = args.path
+    if not path:
+        tmpdir = tempfile.TemporaryDirectory()
+        path = os.path.join(tmpdir.name, "outbox.db")
+    box = Outbox(path, sync=args.sync, commit_window=args.commit_ms / 1000,
+                 drain_workers=args.workers, max_attempts=1_000)
+    box.start(drain=False)   # drained by hand below, so enqueue is measured alone
+
+    enq = run_enqueue(box, args.messages, args.threads, args.recipients)
+    print(f"enqueue: {enq['messages']} msgs from {args.threads} threads in {enq['elapsed_s']}s "
+          f"-> {enq['puts_per_s']} puts/s, p50 {enq['p50_ms']} ms, p99 {enq['p99_ms']} ms "
+          f"(sync={args.sync}, commit window {args.commit_ms} ms)")
+
+    drain = run_drain(box, args.messages, args.send_ms, args.error_rate)
+    print(f"drain:   {drain['delivered']} msgs ({drain['attempts']} attempts) in {drain['elapsed_s']}s "
+          f"-> {drain['deliveries_per_s']} deliveries/s with {args.workers} workers, "
+          f"per-recipient order {drain['per_recipient_order']}")
+
+    if tmpdir:
+        tmpdir.cleanup()
+    return 0 if drain["per_recipient_order"] == "ok" else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
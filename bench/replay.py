@@ -0,0 +1,139 @@
+"""Replay captured webhook traffic against a local instance with fake upstreams.
+
+    CAPTURE_FILE=capture/traffic.jsonl.gz gunicorn app:app    # capture in prod
+    python -m bench.replay capture/traffic.jsonl.gz --speed 1     # original pacing
+    python -m bench.replay capture/traffic.jsonl.gz --speed 10    # 10x faster
+    python -m bench.replay capture/traffic.jsonl.gz --speed 0     # as fast as possible
+
+Events for the same patient are replayed in order on the same lane, so
+conversations keep their shape; different patients run concurrently.
+Reports latency per turn type, like bench.loadTest, so results from two
+releases replaying the same file can be compared directly.
+"""
+from __future__ import annotations
+
+import sys
+import json
+import time
+import queue
+import argparse
+import threading
+
+from collections import defaultdict
+from typing import Dict, List
+
+import capture
+from bench.fakeUpstreams import FakeUpstreams, parse_profiles
+from bench.loadTest import start_app
+from bench.report import summarize, print_table, percentile
+
+def turn_type(event: dict) -> str:
+    payload = event["payload"]
+    if event["channel"] == "chatwoot":
+        return f"cw_{payload.get('event', 'unknown')}"
+    try:
+        value = payload["entry"][0]["changes"][0]["value"]
+    except (KeyError, IndexError, TypeError):
+        return "wa_unknown"
+    if value.get("statuses"):
+        return "wa_status"
+    msg = (value.get("messages") or [{}])[0]
+    kind = msg.get("type", "unknown")
+    if kind == "interactive":
+        kind = (msg.get("interactive") or {}).get("type", kind)
+    return f"wa_{kind}"
+
+def replay(base_url: str, events: List[dict], speed: float, lanes: int):
+    import requests
+
+    samples: Dict[str, List[float]] = defaultdict(list)
+    lag: List[float] = []
+    errors: Dict[str, int] = defaultdict(int)
+    lock = threading.Lock()
+    queues = [queue.SimpleQueue() for _ in range(lanes)]
+    t0_capture = events[0]["ts"] if events else 0.0
+    t0 = time.perf_counter()
+
+    def lane(q: queue.SimpleQueue):
+        http = requests.Session()
+        while True:
+            event = q.get()
+            if event is None:
+                return
+            if speed > 0:
+                due = t0 + (event["ts"] - t0_capture) / speed
+                wait = due - time.perf_counter()
+                if wait > 0:
+                    time.sleep(wait)
+                late = time.perf_counter() - due
+            else:
+                late = 0.0
+            path = "/chatwoot/webhook" if event["channel"] == "chatwoot" else "/webhook"
+            started = time.perf_counter()
+            try:
+                ok = http.post(base_url + path, json=event["payload"]).status_code < 400
+            except Exception:
+                ok = False
+            elapsed = time.perf_counter() - started
+            kind = turn_type(event)
+            with lock:
+                samples[kind].append(elapsed)
+                lag.append(late)
+                if not ok:
+                    errors[kind] += 1
+
+    threads = [threading.Thread(target=lane, args=(q,), daemon=True) for q in queues]
+    for t in threads:
+        t.start()
+    for event in events:
+        queues[hash(event.get("key", "")) % lanes].put(event)
+    for q in queues:
+        q.put(None)
+    for t in threads:
+        t.join()
+    return samples, errors, sorted(lag), time.perf_counter() - t0
+
+def main(argv=None) -> int:
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument("capture_file")
+    ap.add_argument("--speed", type=float, default=1.0,
+                    help="time scale; 1 = original pacing, 0 = as fast as possible")
+    ap.add_argument("--lanes", type=int, default=16, help="concurrent patients in flight")
+    ap.add_argument("--limit", type=int, default=0, help="replay only the first N events")
+    ap.add_argument("--latency", action="append", default=[], metavar="UPSTREAM=MS[:P_ERR]")
+    ap.add_argument("--json", dest="json_out", help="also write the summary to this file")
+    args = ap.parse_args(argv)
+
+    events = sorted(capture.read(args.capture_file), key=lambda e: e["ts"])
+    if args.limit:
+        events = events[:args.limit]
+    if not events:
+        print("no events in capture file")
+        return 1
+
+    fakes = FakeUpstreams(parse_profiles(args.latency)).start()
+    server, base_url = start_app(fakes.env())
+    try:
+        samples, errors, lag, elapsed = replay(base_url, events, args.speed, args.lanes)
+    finally:
+        server.shutdown()
+        fakes.stop()
+
+    summary = summarize(samples, elapsed)
+    summary["errors"] = dict(errors)
+    summary["upstream_calls"] = fakes.calls
+    if args.speed > 0 and lag:
+        summary["schedule_lag_p99_ms"] = round(percentile(lag, 99) * 1000, 1)
+    print_table(summary)
+    if errors:
+        print(f"errors: {dict(errors)}")
+    if "schedule_lag_p99_ms" in summary:
+        print(f"p99 schedule lag: {summary['schedule_lag_p99_ms']} ms "
+              "(high values mean the instance could not keep up with this speed)")
+    if args.json_out:
+        with open(args.json_out, "w") as fh:
+            json.dump(summary, fh, indent=2)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,71 @@
+from __future__ import annotations
+
+import math
+
+from typing import Dict, Iterable, List
+
+
+def percentile(sorted_values: List[float], q: float) -> float:
+    """Nearest-rank percentile of an already sorted list (q in 0..100)."""
+    if not sorted_values:
+        return 0.0
+    k = max(0, min(len(sorted_values) - 1, math.ceil(q / 100 * len(sorted_values)) - 1))
+    return sorted_values[k]
+
+
+def summarize(samples: Dict[str, Iterable[float]], elapsed: float) -> dict:
+    """p50/p95/p99 (ms) per key, plus overall requests per second."""
+    out = {"turns": {}, "requests": 0, "elapsed_s": round(elapsed, 3)}
+    for key, values in sorted(samples.items()):
+        vals = sorted(values)
+        out["requests"] += len(vals)
+        out["turns"][key] = {
+            "n": len(vals),
+            "p50_ms": round(percentile(vals, 50) * 1000, 1),
+            "p95_ms": round(percentile(vals, 95) * 1000, 1),
+            "p99_ms": round(percentile(vals, 99) * 1000, 1),
+            "max_ms": round(vals[-1] * 1000, 1) if vals else 0.0,
+        }
+    out["rps"] = round(out["requests"] / elapsed, 1) if elapsed > 0 else 0.0
+    return out
+
+
+def print_table(summary: dict) -> None:
+    print(f"{'turn':<22}{'n':>7}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    for key, row in summary["turns"].items():
+        print(f"{key:<22}{row['n']:>7}{row['p50_ms']:>10}{row['p95_ms']:>10}"
+              f"{row['p99_ms']:>10}{row['max_ms']:>10}")
+    print(f"\n{summary['requests']} requests in {summary['elapsed_s']}s "
+          f"-> {summary['rps']} req/s")
+
+
+def mann_whitney_greater(a: List[float], b: List[float]) -> float:
+    """One-sided p-value that values in `b` tend to be larger than in `a`.
+
+    Mann-Whitney U with the normal approximation and tie correction; fine
+    for the 20+ samples per side the benches collect.
+    """
+    n1, n2 = len(a), len(b)
+    if not n1 or not n2:
+        return 1.0
+    pooled = sorted([(v, 0) for v in a] + [(v, 1) for v in b])
+    ranks = [0.0] * len(pooled)
+    ties = 0.0
+    i = 0
+    while i < len(pooled):
+        j = i
+        while j + 1 < len(pooled) and pooled[j + 1][0] == pooled[i][0]:
+            j += 1
+        for k in range(i, j + 1):
+            ranks[k] = (i + j) / 2 + 1
+        t = j - i + 1
+        ties += t ** 3 - t
+        i = j + 1
+    r2 = sum(r for r, (_, side) in zip(ranks, pooled) if side == 1)
+    u2 = r2 - n2 * (n2 + 1) / 2
+    n = n1 + n2
+    sigma = math.sqrt(n1 * n2 / 12 * ((n + 1) - ties / (n * (n - 1))))
+    if sigma == 0:
+        return 1.0
+    z = (u2 - n1 * n2 / 2 - 0.5) / sigma
+    return 0.5 * math.erfc(z / math.sqrt(2))
@@ -2,15 +2,21 @@ from statemachine import StateMachine, State
 
 import random
 import re
+import logging
 
 from enum import Enum
 from enum import auto
 
-from whatsappAPI import (
-    send_text, confirm_text, send_two_buttons, sendDocType,
-    sendMenu, forward_to_agent
-    )
-from utils import fetch_record, fetch_history, med_status_msg
+from utils import fetch_record, fetch_history, stream_med_status
+from transports import Transport, default_whatsapp_transport
+from metrics import FSM_TRANSITIONS, FSM_REPROMPTS
+from tracing import traced
+import restock
+import admission
+import media
+import funnel
+
+log = logging.getLogger(__name__)
 
 ALLOWED = (
         "Tarjeta de Identidad",
@@ -168,12 +174,30 @@ class ChatBot(StateMachine):
    
     toIdle      = medState.to(idle)
 
-    def __init__(self, sender: str):
+    def __init__(self, sender: str, transport: Transport | None = None):
+        self.transport = transport or default_whatsapp_transport()
         super().__init__()
         self.sender = sender
         self.doc_type = None
         self.doc_num = None
         self.pending_records = []  # Changed from list[HistoryRecord]
+        self.awaiting_stock = []   # pending records still short of stock
+        self.attachments = []      # media.MediaFile received this session, for the handoff
+
+    def after_transition(self, source: State, target: State):
+        FSM_TRANSITIONS.inc(source=source.id, target=target.id)
+        funnel.transition(self.sender, source.id, target.id)
+
+    def reprompt(self, body: str):
+        """Ask again after invalid input in the current state."""
+        FSM_REPROMPTS.inc(state=self.current_state.id)
+        return self.transport.send_text(self.sender, body)
+
+    def shed(self, rejected: admission.Rejected):
+        """A lookup was refused by admission control; stay put and say so (once)."""
+        log.debug("Lookup shed in %s: %s", self.current_state.id, rejected.reason)
+        if rejected.notify:
+            self.transport.send_text(self.sender, rejected.reply)
 
     #on-enter
     def sendWelcome(self):
@@ -184,7 +208,7 @@ class ChatBot(StateMachine):
             "condiciones de WhatsApp."
         )
 
-        send_two_buttons(
+        self.transport.send_two_buttons(
             self.sender,
             question,
             "yes",
@@ -194,12 +218,39 @@ class ChatBot(StateMachine):
         ) 
     
     def promptType(self):
-        sendDocType(self.sender, "Por favor ingrese el tipo de documento")
+        self.transport.sendDocType(self.sender, "Por favor ingrese el tipo de documento")
     
     def promptDocNum(self):
-        send_text(self.sender, "Por favor ingrese el numero de documento")
+        self.transport.send_text(self.sender, "Por favor ingrese el numero de documento")
+
+    def offerRestockAlert(self):
+        self.transport.send_two_buttons(
+            self.sender,
+            "¿Quieres que te avisemos por aqui cuando este disponible?",
+            "yes",
+            "no",
+            "Avisarme",
+            "No, gracias",
+        )
+
+    def wantsRestockAlert(self, txt: str) -> bool:
+        return self.isYes(txt) or txt.strip().lower() == "avisarme"
+
+    def answerRestockAlert(self, txt: str):
+        if self.wantsRestockAlert(txt):
+            watched = restock.watch.subscribe(self.sender, self.doc_num, self.awaiting_stock,
+                                              self.transport.channel.split(":")[0],
+                                              getattr(self.transport, "phone_id", None))
+            log.debug("Restock alert requested for %d items", watched)
+            self.transport.send_text(self.sender,
+                      "Listo! Te escribiremos apenas tu medicamento este disponible.")
+        else:
+            self.transport.send_text(self.sender, "Entendido. Gracias por comunicarte con Logifarma.")
+        self.awaiting_stock = []
+        self.toIdle()
     
     #event methods
+    @traced("fsm.text_op")
     def text_op(self, body: str):
         if self.current_state is self.start:
             self.toWelcome()
@@ -211,7 +262,7 @@ class ChatBot(StateMachine):
             elif self.isNo(body):
                 self.toNoTerms(body)
             else:
-                send_text(self.sender, "Responde Acepto o No Acepto, por favor.")
+                self.reprompt("Responde Acepto o No Acepto, por favor.")
             return
 
         if self.current_state is self.docType:
@@ -219,22 +270,25 @@ class ChatBot(StateMachine):
                 self.doc_type = self.extractDocType(body)
                 self.toDocNum(body)
             else:
-                send_text(self.sender, "Ingrese un tipo de documento valido")
+                self.reprompt("Ingrese un tipo de documento valido")
             return
         
         if self.current_state is self.docNum:
             doc_num = self.isClean(body)
 
             if not doc_num.isdigit():
-                send_text(self.sender, "Por favor ingrese un numero de identificacion valido")
+                self.reprompt("Por favor ingrese un numero de identificacion valido")
                 return
             
-            record = fetch_record(self.doc_type, doc_num)
-            print(f"{record}")
+            try:
+                with admission.lookup(self.sender):
+                    record = fetch_record(self.doc_type, doc_num)
+            except admission.Rejected as rejected:
+                self.shed(rejected)
+                return
 
             if not record:
-                send_text(
-                    self.sender, 
+                self.reprompt(
                     f"No encontramos un afiliado con el numero de identificacion {self.doc_num}.\n"
                     "Verifica que el numero sea correcto e intentalo de nuevo."
                 )
@@ -249,23 +303,59 @@ class ChatBot(StateMachine):
             self._first_name = first_name
             self._status = estado
             
-            print(f"Nombre de Usuario: {first_name}\nEstado: {estado}")
+            log.debug("Affiliate found, status: %s", estado)
 
-            sendMenu(self.sender, 
+            self.transport.sendMenu(self.sender, 
                       f"Hola {first_name}!\n"
                       f"Como podemos ayudarte hoy?"
                     ) 
             self.toMenu()
             return
 
+        if self.current_state is self.medState and self.awaiting_stock:
+            if self.wantsRestockAlert(body) or self.isNo(body):
+                self.answerRestockAlert(body)
+            else:
+                self.reprompt("Responde Avisarme o No, gracias, por favor.")
+            return
+
         if self.current_state is self.human:
             if body.strip().lower() == "bot":
-                sendMenu(self.sender, "¡De vuelta! ¿Cómo puedo ayudarte?")
+                self.transport.sendMenu(self.sender, "¡De vuelta! ¿Cómo puedo ayudarte?")
                 self.backToBot()
             else:
-                forward_to_agent(self.sender, body)        # relay
+                self.transport.relay_to_agents(self.sender, body)        # relay
             return
 
+    @traced("fsm.media_op")
+    def media_op(self, ref: media.MediaRef):
+        """A prescription photo or PDF; stored off-thread, then acknowledged."""
+        if self.current_state is self.start:
+            self.toWelcome()
+            return
+
+        def stored(file, error):
+            if error is not None:
+                reply = error.reply if isinstance(error, media.MediaRejected) else media.FAILED_REPLY
+                self.transport.send_text(self.sender, reply)
+                return
+            self.attachments.append(file)
+            log.info("Stored %s from %s as %s", file.kind, self.sender, file.path)
+            self.transport.send_text(self.sender, "Recibimos tu archivo, gracias.")
+            if self.current_state is self.human:
+                self.transport.relay_to_agents(self.sender, f"📎 {file.label}")
+
+        if not media.ingest.submit(ref, stored, getattr(self.transport, "phone_id", None)):
+            self.transport.send_text(self.sender, media.BUSY_REPLY)
+
+    def unsupported(self):
+        """Audio, video, stickers, locations...: say what we can read."""
+        if self.current_state is self.start:
+            self.toWelcome()
+            return
+        self.reprompt("Solo podemos leer mensajes de texto, fotos y documentos PDF.")
+
+    @traced("fsm.button_op")
     def button_op(self, btn_id: str):
         if self.current_state is self.welcome:
             if self.isYes(btn_id):
@@ -273,9 +363,14 @@ class ChatBot(StateMachine):
             elif self.isNo(btn_id):
                 self.toNoTerms(btn_id)
             else:
-                send_text(self.sender, "Por favor elige Acepto o No Acepto.")
+                self.reprompt("Por favor elige Acepto o No Acepto.")
+            return
+
+        if self.current_state is self.medState and self.awaiting_stock:
+            self.answerRestockAlert(btn_id)
             return
         
+    @traced("fsm.list_op")
     def list_op(self, row_id: str):
         if self.current_state is self.docType:
             # Handle both codes and full text
@@ -283,8 +378,7 @@ class ChatBot(StateMachine):
                 self.doc_type = self.extractDocType(row_id)
                 self.toDocNum(row_id) 
             else:
-                send_text(self.sender,
-                        "Por favor elige un tipo de documento válido.")
+                self.reprompt("Por favor elige un tipo de documento válido.")
             return
 
         if self.current_state is self.menu:
@@ -312,25 +406,35 @@ class ChatBot(StateMachine):
                 menu_id = row_id
             
             if menu_id == "ESTADO_MED":
-                history = fetch_history(self.doc_num)
-
-                if history is None:
-                    send_text(self.sender,
-                              "Lo siento, no pude consultar su historial.")
-                    return
-                elif self.get_valid_history(history) is False:
-                    send_text(self.sender,
-                              f"El paciente con el numero de identificacion {self.doc_num} no existe. "
-                              "Por favor verifica el numero de documento.")
+                try:
+                    with admission.lookup(self.sender):
+                        history = fetch_history(self.doc_num)
+                        if history is None:
+                            self.transport.send_text(self.sender,
+                                      "Lo siento, no pude consultar su historial.")
+                            return
+                        elif self.get_valid_history(history) is False:
+                            self.transport.send_text(self.sender,
+                                      f"El paciente con el numero de identificacion {self.doc_num} no existe. "
+                                      "Por favor verifica el numero de documento.")
+                            return
+                        # replies go out as inventory lookups finish
+                        items = stream_med_status(
+                            history, lambda text: self.transport.send_text(self.sender, text))
+                except admission.Rejected as rejected:
+                    self.shed(rejected)
                     return
 
                 self.pending_records = history
-                send_text(self.sender, med_status_msg(history))
                 self.toMedState()  # Move to medState after showing status
+                if restock.watch is not None and self.transport.push_alerts:
+                    self.awaiting_stock = [r for r, available in items if r.cant_pendiente > available]
+                    if self.awaiting_stock:
+                        self.offerRestockAlert()
                 return
 
             elif menu_id == "HORARIO_UBI":
-                send_text(self.sender, "Nuestros horarios de atención son:\n\n"
+                self.transport.send_text(self.sender, "Nuestros horarios de atención son:\n\n"
                          "📍 Sede Principal:\n"
                          "Lunes a Viernes: 7:00 AM - 6:00 PM\n"
                          "Sábados: 8:00 AM - 12:00 PM\n\n"
@@ -340,14 +444,14 @@ class ChatBot(StateMachine):
                 # Stay in menu state
                 return
             elif menu_id == "MED_AUTORIZAR":
-                send_text(self.sender, "Para autorizar medicamentos a domicilio, "
+                self.transport.send_text(self.sender, "Para autorizar medicamentos a domicilio, "
                          "necesitamos validar tu solicitud. Un agente te contactará pronto.")
                 self.toHuman()
                 return
             elif menu_id == "OTROS":
-                send_text(self.sender, "Te voy a conectar con uno de nuestros agentes...")
+                self.transport.send_text(self.sender, "Te voy a conectar con uno de nuestros agentes...")
                 self.toHuman()
                 return
             else: 
-                send_text(self.sender, "Por favor ingrese una opcion valida")
+                self.reprompt("Por favor ingrese una opcion valida")
             return
\ No newline at end of file
@@ -0,0 +1,240 @@
+"""Validate many patient documents against the affiliate sources.
+
+    python -m bulkValidate documentos.csv -o resultados.jsonl --workers 16
+    curl -H "Authorization: Bearer $BULK_TOKEN" --data-binary @documentos.csv \
+        https://.../bulk/validate?format=csv
+
+Input is CSV (a doc_type,doc_num header or just those two columns) or
+JSONL ({"doc_type": "CC", "doc_num": "123"} per line); the format is
+taken from the first line. Rows are read lazily and at most 2 x workers
+are in flight, so results stream out in input order while the rest of
+the file is still arriving. Lookups go through utils.lookup_record and so
+share its record cache, token caches and connection pool with the bot, and
+through admission.bulk_lookup, so a run holds at most BULK_UPSTREAM_SHARE of
+the upstream gate the bot's lookups use.
+"""
+from __future__ import annotations
+
+import io
+import os
+import csv
+import sys
+import hmac
+import time
+import logging
+import argparse
+import itertools
+
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, Iterator, Optional, Tuple
+
+from flask import Blueprint, Response, abort, request, stream_with_context
+
+import admission
+import jsonCodec
+import metrics
+import utils
+
+log = logging.getLogger(__name__)
+
+# BULK_TOKEN   - Bearer token for POST /bulk/validate; unset disables the endpoint
+# BULK_WORKERS - Lookups in flight per bulk run (default: 8)
+BULK_TOKEN = os.getenv("BULK_TOKEN")
+BULK_WORKERS = int(os.getenv("BULK_WORKERS", "8"))
+MAX_WORKERS = 64
+
+BULK_ROWS = metrics.counter("bulk_rows_total", "Bulk validation rows by status")
+
+NAME_FIELDS = ("PRIMER_NOMBRE", "SEGUNDO_NOMBRE", "PRIMER_APELLIDO", "SEGUNDO_APELLIDO")
+CSV_FIELDS = ("row", "doc_type", "doc_num", "status", "name", "estado", "ms", "error")
+
+# ────────────────────────────── Input ─────────────────────────────
+def read_rows(lines: Iterable[str]) -> Iterator[Tuple[str, str]]:
+    """Yield (doc_type, doc_num) per data row; malformed rows yield ("", "")."""
+    it = iter(lines)
+    first = next((line for line in it if line.strip()), None)
+    if first is None:
+        return
+    rest = itertools.chain([first], it)
+
+    if first.lstrip().startswith("{"):
+        for line in rest:
+            if not line.strip():
+                continue
+            try:
+                obj = jsonCodec.loads(line)
+            except jsonCodec.DecodeError:
+                yield "", ""
+                continue
+            if not isinstance(obj, dict):
+                yield "", ""
+                continue
+            yield str(obj.get("doc_type") or "").strip(), str(obj.get("doc_num") or "").strip()
+        return
+
+    reader = csv.reader(rest)
+    first_row = next(reader)
+    header = [c.strip().lower() for c in first_row]
+    if "doc_type" in header and "doc_num" in header:
+        ti, ni = header.index("doc_type"), header.index("doc_num")
+    else:
+        ti, ni = 0, 1
+        reader = itertools.chain([first_row], reader)
+    for cols in reader:
+        if not any(c.strip() for c in cols):
+            continue
+        if len(cols) <= max(ti, ni):
+            yield "", ""
+            continue
+        yield cols[ti].strip(), cols[ni].strip()
+
+# ────────────────────────────── Validation ─────────────────────────────
+class BulkStats:
+    """Running totals for one bulk run."""
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.counts: Counter = Counter()
+
+    def add(self, result: dict) -> dict:
+        self.counts[result["status"]] += 1
+        BULK_ROWS.inc(status=result["status"])
+        return result
+
+    def summary(self) -> dict:
+        rows = sum(self.counts.values())
+        elapsed = time.monotonic() - self.started
+        return {
+            "rows": rows,
+            "found": self.counts["found"],
+            "not_found": self.counts["not_found"],
+            "invalid": self.counts["invalid"],
+            "errors": self.counts["error"],
+            "error_rate": round(self.counts["error"] / rows, 4) if rows else 0.0,
+            "elapsed_s": round(elapsed, 3),
+            "rows_per_s": round(rows / elapsed, 1) if elapsed > 0 else 0.0,
+        }
+
+def _check(n: int, doc_type: str, doc_num: str) -> dict:
+    result = {"row": n, "doc_type": doc_type, "doc_num": doc_num}
+    if not doc_type or not doc_num:
+        result.update(status="invalid", error="missing doc_type or doc_num")
+        return result
+    start = time.perf_counter()
+    try:
+        with admission.bulk_lookup():
+            record = utils.lookup_record(doc_type, doc_num)
+    except Exception as exc:
+        result.update(status="error", error=str(exc) or exc.__class__.__name__)
+    else:
+        if record is None:
+            result["status"] = "not_found"
+        else:
+            result["status"] = "found"
+            result["name"] = " ".join(str(record[f]) for f in NAME_FIELDS if record.get(f))
+            if record.get("ESTADO"):
+                result["estado"] = record["ESTADO"]
+    result["ms"] = round((time.perf_counter() - start) * 1000, 1)
+    return result
+
+def validate(rows: Iterable[Tuple[str, str]], workers: int = BULK_WORKERS,
+             stats: Optional[BulkStats] = None) -> Iterator[dict]:
+    """Look up every row with bounded concurrency; yield results in input order."""
+    stats = stats if stats is not None else BulkStats()
+    workers = max(1, min(workers, MAX_WORKERS))
+    window: deque = deque()
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="bulk") as pool:
+        try:
+            for n, (doc_type, doc_num) in enumerate(rows, 1):
+                window.append(pool.submit(_check, n, doc_type, doc_num))
+                if len(window) >= 2 * workers:
+                    yield stats.add(window.popleft().result())
+            while window:
+                yield stats.add(window.popleft().result())
+        finally:
+            # consumer went away: don't start lookups nobody will read
+            for fut in window:
+                fut.cancel()
+
+# ────────────────────────────── Output ─────────────────────────────
+def render(results: Iterable[dict], fmt: str, stats: BulkStats) -> Iterator[str]:
+    """Serialize results line by line, ending with the run summary."""
+    if fmt == "csv":
+        buf = io.StringIO()
+        writer = csv.DictWriter(buf, CSV_FIELDS, extrasaction="ignore")
+        writer.writeheader()
+        for result in results:
+            writer.writerow(result)
+            yield buf.getvalue()
+            buf.seek(0)
+            buf.truncate()
+        summary = stats.summary()
+        yield "# " + " ".join(f"{k}={v}" for k, v in summary.items()) + "\n"
+    else:
+        for result in results:
+            yield _json_line(result)
+        yield _json_line({"summary": stats.summary()})
+
+def _json_line(obj: Dict) -> str:
+    raw = jsonCodec.dumps(obj)
+    return (raw.decode() if isinstance(raw, bytes) else raw) + "\n"
+
+# ────────────────────────────── HTTP endpoint ─────────────────────────────
+bulk_bp = Blueprint("bulk", __name__, url_prefix="/bulk")
+
+@bulk_bp.before_request
+def _check_token():
+    if not BULK_TOKEN:
+        abort(404)
+    given = request.headers.get("Authorization", "")
+    if not hmac.compare_digest(given, f"Bearer {BULK_TOKEN}"):
+        abort(401)
+
+@bulk_bp.route("/validate", methods=["POST"])
+def bulk_validate():
+    """Stream a CSV/JSONL body in, stream results out (?format=csv|jsonl&workers=N)."""
+    fmt = request.args.get("format", "jsonl")
+    if fmt not in ("csv", "jsonl"):
+        return {"error": "format must be csv or jsonl"}, 400
+    workers = request.args.get("workers", BULK_WORKERS, type=int)
+    lines = (line.decode("utf-8-sig", errors="replace") for line in request.stream)
+    stats = BulkStats()
+
+    def generate():
+        yield from render(validate(read_rows(lines), workers, stats), fmt, stats)
+        log.info("Bulk validation done: %s", stats.summary())
+
+    mimetype = "text/csv" if fmt == "csv" else "application/x-ndjson"
+    return Response(stream_with_context(generate()), mimetype=mimetype)
+
+# ────────────────────────────── CLI ─────────────────────────────
+def main(argv=None) -> int:
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument("input", help="CSV or JSONL file, or - for stdin")
+    ap.add_argument("-o", "--output", default="-", help="results file (default: stdout)")
+    ap.add_argument("--format", choices=("csv", "jsonl"), help="output format (default: from -o, else jsonl)")
+    ap.add_argument("--workers", type=int, default=BULK_WORKERS)
+    args = ap.parse_args(argv)
+
+    fmt = args.format or ("csv" if args.output.endswith(".csv") else "jsonl")
+    src = sys.stdin if args.input == "-" else open(args.input, encoding="utf-8-sig", newline="")
+    dst = sys.stdout if args.output == "-" else open(args.output, "w", encoding="utf-8", newline="")
+    stats = BulkStats()
+    try:
+        for chunk in render(validate(read_rows(src), args.workers, stats), fmt, stats):
+            dst.write(chunk)
+    finally:
+        if src is not sys.stdin:
+            src.close()
+        if dst is not sys.stdout:
+            dst.close()
+
+    s = stats.summary()
+    print(f"{s['rows']} rows in {s['elapsed_s']}s -> {s['rows_per_s']} rows/s; "
+          f"found {s['found']}, not found {s['not_found']}, invalid {s['invalid']}, "
+          f"errors {s['errors']} ({s['error_rate']:.1%})", file=sys.stderr)
+    return 1 if s["errors"] else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
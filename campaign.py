@@ -0,0 +1,307 @@
+"""Send one announcement to a long list of patients, resumably.
+
+    python -m campaign pacientes.csv --text "Hola {nombre}, la sede ... cambia de horario" \
+        --log campana-horario.log
+    python -m campaign pacientes.csv --template cambio_horario:es --rate 30 --log recall.log
+
+Recipients stream from a CSV with a phone/telefono column (other columns
+fill {placeholders} in --text, or become the template's body parameters
+in order) or from a plain file with one phone per line. Sends go through
+whatsappAPI on a keep-alive pool (each bounded by WA_TIMEOUT), paced to
+--rate messages/s on the chosen number; --concurrency only needs to cover
+Graph's latency. Only connection failures and rate-limit answers are
+retried.
+
+Every outcome is appended to the --log file as one tab-separated line
+(row, phone, sent|failed|invalid, wamid or error) and the highest row
+below which everything is done is checkpointed next to it. Running the
+same command again - after an interruption, or to retry failures -
+skips rows already sent or found invalid and retries the failed ones.
+A crash between Graph accepting a message and its log line being
+written can resend that one message.
+"""
+from __future__ import annotations
+
+import os
+import csv
+import sys
+import json
+import time
+import hashlib
+import signal
+import logging
+import argparse
+import itertools
+import threading
+
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Dict, Iterable, Iterator, Optional, Set, Tuple
+
+import requests
+from urllib3.exceptions import NewConnectionError
+
+import whatsappAPI as wa
+from transports import pooled_session
+
+log = logging.getLogger(__name__)
+
+# CAMPAIGN_RATE        - Messages/s a campaign may use on its number (default: 20). It is
+#                        paced in this process only and shares no budget with the bot,
+#                        which paces the same number at WA_RATE on its own: keep
+#                        CAMPAIGN_RATE + WA_RATE within what the number may send.
+# CAMPAIGN_CONCURRENCY - Sends in flight (default: 16)
+CAMPAIGN_RATE = float(os.getenv("CAMPAIGN_RATE", "20"))
+CAMPAIGN_CONCURRENCY = int(os.getenv("CAMPAIGN_CONCURRENCY", "16"))
+CHECKPOINT_EVERY = 1.0      # seconds between checkpoint writes
+RETRIES = 3
+
+# Graph error codes that mean "slow down", worth retrying after a pause
+RETRYABLE_CODES = {4, 80007, 130429, 131048, 131056}
+RETRYABLE_STATUS = {429}
+
+PHONE_COLUMNS = ("phone", "telefono", "celular", "to")
+
+# ────────────────────────────── Message ─────────────────────────────
+@dataclass
+class Message:
+    text: str = ""
+    template: str = ""      # "name" or "name:lang"
+
+    @property
+    def fingerprint(self) -> str:
+        return hashlib.sha256(f"{self.text}\0{self.template}".encode()).hexdigest()[:16]
+
+    def send(self, to: str, fields: Dict[str, str], session, phone_id: Optional[str]) -> str:
+        if self.template:
+            name, _, lang = self.template.partition(":")
+            return wa.send_template(to, name, list(fields.values()), lang or "es",
+                                    session=session, phone_id=phone_id)
+        return wa.send_text(to, self.text.format_map(fields), session=session, phone_id=phone_id)
+
+def _retryable(exc: Exception) -> bool:
+    """Only errors where Graph surely did not take the message, or asked us to slow down.
+
+    A read timeout or a dropped connection may come after Graph accepted
+    the send, and retrying those would message the patient twice.
+    """
+    if isinstance(exc, requests.ConnectTimeout):
+        return True
+    if isinstance(exc, requests.ConnectionError):
+        reason = getattr(exc.args[0], "reason", None) if exc.args else None
+        return isinstance(reason, NewConnectionError)
+    if isinstance(exc, requests.HTTPError):
+        return exc.response is not None and exc.response.status_code in RETRYABLE_STATUS
+    detail = exc.args[0] if exc.args else None
+    if isinstance(detail, dict):
+        return (detail.get("error") or {}).get("code") in RETRYABLE_CODES
+    return False
+
+# ────────────────────────────── Recipients ─────────────────────────────
+def read_recipients(lines: Iterable[str]) -> Iterator[Tuple[int, str, Dict[str, str]]]:
+    """Yield (row, phone digits, other columns) for every data row, numbered from 1."""
+    reader = csv.reader(line for line in lines if line.strip())
+    first = next(reader, None)
+    if first is None:
+        return
+    header = [c.strip().lower() for c in first]
+    phone_col = next((header.index(c) for c in PHONE_COLUMNS if c in header), None)
+    if phone_col is None:
+        phone_col, header = 0, []
+        reader = itertools.chain([first], reader)
+    for row, cols in enumerate(reader, 1):
+        phone = "".join(c for c in (cols[phone_col] if phone_col < len(cols) else "") if c.isdigit())
+        fields = {name: cols[i].strip() for i, name in enumerate(header)
+                  if i != phone_col and i < len(cols)}
+        yield row, phone, fields
+
+# ────────────────────────────── Progress ─────────────────────────────
+class Progress:
+    """Result log plus a checkpoint of the contiguous prefix of finished rows."""
+
+    def __init__(self, log_path: str, fingerprint: str):
+        self.log_path = log_path
+        self.ckpt_path = log_path + ".ckpt"
+        self.fingerprint = fingerprint
+        self.watermark = 0              # every row <= watermark is finished
+        self.done: Set[int] = set()     # finished rows above the watermark
+        self.retry: Set[int] = set()    # rows whose last outcome was "failed": sent again
+        self.counts: Counter = Counter()
+        self.this_run: Counter = Counter()
+        self._saved_at = 0.0
+        self._fh = None
+
+    def load(self, restart: bool = False):
+        if restart:
+            for path in (self.log_path, self.ckpt_path):
+                if os.path.exists(path):
+                    os.remove(path)
+        if os.path.exists(self.ckpt_path):
+            with open(self.ckpt_path) as fh:
+                ckpt = json.load(fh)
+            if ckpt.get("campaign") != self.fingerprint:
+                raise SystemExit(f"{self.ckpt_path} belongs to a different message; "
+                                 f"use another --log or --restart")
+            self.watermark = int(ckpt.get("watermark", 0))
+        if os.path.exists(self.log_path):
+            # totals come from the log; rows above the watermark were
+            # finished after the last checkpoint was written
+            with open(self.log_path, encoding="utf-8") as fh:
+                for line in fh:
+                    try:
+                        row, _, status = line.split("\t", 3)[:3]
+                        row = int(row)
+                    except ValueError:
+                        continue    # torn last line from a crash
+                    self._count(row, status)
+                    if row > self.watermark:
+                        self.done.add(row)
+            self._advance()
+            if self.retry:
+                log.info("Retrying %d recipients that failed before", len(self.retry))
+        self._fh = open(self.log_path, "a", encoding="utf-8")
+
+    def finished(self, row: int) -> bool:
+        return (row <= self.watermark or row in self.done) and row not in self.retry
+
+    def _count(self, row: int, status: str):
+        # a retried row counts once, with its latest outcome
+        if row in self.retry:
+            self.retry.discard(row)
+            self.counts["failed"] -= 1
+        if status == "failed":
+            self.retry.add(row)
+        self.counts[status] += 1
+
+    def record(self, row: int, phone: str, status: str, detail: str):
+        self._fh.write(f"{row}\t{phone}\t{status}\t{detail}\n")
+        self._fh.flush()
+        self.done.add(row)
+        self._count(row, status)
+        self.this_run[status] += 1
+        self._advance()
+        if time.monotonic() - self._saved_at >= CHECKPOINT_EVERY:
+            self.save()
+
+    def _advance(self):
+        while self.watermark + 1 in self.done:
+            self.watermark += 1
+            self.done.discard(self.watermark)
+
+    def save(self):
+        tmp = self.ckpt_path + ".tmp"
+        with open(tmp, "w") as fh:
+            json.dump({"campaign": self.fingerprint, "watermark": self.watermark,
+                       "counts": dict(self.counts), "updated": time.time()}, fh)
+            fh.flush()
+            os.fsync(fh.fileno())
+        os.replace(tmp, self.ckpt_path)
+        self._saved_at = time.monotonic()
+
+    def close(self):
+        if self._fh is not None:
+            self.save()
+            self._fh.close()
+            self._fh = None
+
+# ────────────────────────────── Runner ─────────────────────────────
+def _send_one(message: Message, row: int, phone: str, fields: Dict[str, str],
+              session, phone_id: Optional[str]) -> Tuple[int, str, str, str]:
+    if not 8 <= len(phone) <= 15:
+        return row, phone, "invalid", "bad phone number"
+    for attempt in range(RETRIES + 1):
+        try:
+            return row, phone, "sent", message.send(phone, fields, session, phone_id)
+        except Exception as exc:
+            if attempt == RETRIES or not _retryable(exc):
+                return row, phone, "failed", " ".join(str(exc).split())[:200]
+            time.sleep(2 ** attempt)
+    raise AssertionError("unreachable")
+
+def run(message: Message, recipients: Iterable[Tuple[int, str, Dict[str, str]]],
+        progress: Progress, *, concurrency: int = CAMPAIGN_CONCURRENCY,
+        phone_id: Optional[str] = None, stop: Optional[threading.Event] = None) -> bool:
+    """Send to every unfinished recipient, recording each outcome as it completes.
+
+    Returns False when `stop` was set before the list was exhausted; sends
+    already in flight are still waited for and recorded.
+    """
+    stop = stop or threading.Event()
+    session = pooled_session(concurrency)
+    window: deque = deque()
+
+    def collect(fut):
+        progress.record(*fut.result())
+
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="campaign") as pool:
+        for row, phone, fields in recipients:
+            if stop.is_set():
+                break
+            if progress.finished(row):
+                continue
+            window.append(pool.submit(_send_one, message, row, phone, fields, session, phone_id))
+            while window and (len(window) >= 2 * concurrency or window[0].done()):
+                collect(window.popleft())
+        if stop.is_set():
+            log.warning("Stopping; waiting for sends already in flight")
+            for fut in window:
+                fut.cancel()
+        for fut in window:
+            if not fut.cancelled():
+                collect(fut)
+    return not stop.is_set()
+
+def main(argv=None) -> int:
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument("recipients", help="CSV with a phone column, or one phone per line")
+    what = ap.add_mutually_exclusive_group(required=True)
+    what.add_argument("--text", help="message body; {column} placeholders are filled per row")
+    what.add_argument("--template", help="approved template as name or name:lang")
+    ap.add_argument("--log", required=True, help="per-recipient result log (checkpoint goes next to it)")
+    ap.add_argument("--phone-id", default=None, help="business number to send from (default: WA_PHONE_ID)")
+    ap.add_argument("--rate", type=float, default=CAMPAIGN_RATE, help="messages per second")
+    ap.add_argument("--concurrency", type=int, default=CAMPAIGN_CONCURRENCY)
+    ap.add_argument("--restart", action="store_true", help="discard earlier progress for this log")
+    args = ap.parse_args(argv)
+
+    from logConfig import configure_logging
+    configure_logging()
+
+    # This process only sends the campaign, so its pacing on the number is the campaign rate
+    number = wa.number_for(args.phone_id)
+    wa.NUMBERS[number.phone_id] = wa.PhoneNumber(number.phone_id, args.rate,
+                                                 burst=min(wa.WA_BURST, args.rate))
+
+    message = Message(text=args.text or "", template=args.template or "")
+    progress = Progress(args.log, message.fingerprint)
+    progress.load(restart=args.restart)
+    if progress.watermark:
+        log.info("Resuming after row %d", progress.watermark)
+
+    # Ctrl-C / SIGTERM finish the sends in flight and checkpoint instead of dying mid-send
+    stop = threading.Event()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(sig, lambda *_: stop.set())
+
+    started = time.monotonic()
+    try:
+        with open(args.recipients, encoding="utf-8-sig", newline="") as fh:
+            completed = run(message, read_recipients(fh), progress, concurrency=args.concurrency,
+                            phone_id=number.phone_id, stop=stop)
+    finally:
+        progress.close()
+
+    elapsed = time.monotonic() - started
+    attempted = sum(progress.this_run.values())
+    total = progress.counts
+    print(f"this run: {attempted} recipients in {elapsed:.1f}s "
+          f"({attempted / elapsed if elapsed else 0:.1f}/s); "
+          f"overall sent {total['sent']}, failed {total['failed']}, invalid {total['invalid']}"
+          + ("" if completed else "; stopped, run again to resume"), file=sys.stderr)
+    if not completed:
+        return 130
+    return 1 if total["failed"] else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,156 @@
+from __future__ import annotations
+
+import os
+import re
+import gzip
+import hmac
+import time
+import queue
+import random
+import hashlib
+import logging
+import threading
+
+from typing import Any, Optional
+
+import jsonCodec
+
+log = logging.getLogger(__name__)
+
+# CAPTURE_FILE   - Append inbound webhook payloads here (.jsonl.gz); unset disables capture
+# CAPTURE_SECRET - Key for pseudonymizing phones, ids and document numbers; required
+# CAPTURE_SAMPLE - Fraction of webhooks captured (default: 1)
+CAPTURE_FILE = os.getenv("CAPTURE_FILE")
+CAPTURE_SECRET = os.getenv("CAPTURE_SECRET", "").encode()
+CAPTURE_SAMPLE = float(os.getenv("CAPTURE_SAMPLE", "1"))
+
+# ────────────────────────────── Pseudonymization ─────────────────────────────
+# The same input always maps to the same pseudonym (within one secret) and
+# digit strings keep their length, so a replayed patient still walks the
+# same flow: a 10-digit document number stays a valid 10-digit number.
+#
+# Only the structural keys below keep their string values. Message text
+# keeps its words but not its numbers (one- and two-digit runs stay, they
+# are menu choices); every other string is replaced: number-like values
+# (phones, source ids) digit for digit, anything else by an opaque token.
+_DIGITS_RE = re.compile(r"\d{3,}")
+_NUMBERISH_RE = re.compile(r"[+\d\s().-]+")
+_STRUCTURAL_KEYS = {
+    "object", "event", "field", "type", "status", "messaging_product", "message_type",
+    "content_type", "channel", "id", "inbox_id", "account_id", "assignee_id",
+    "phone_number_id", "display_phone_number", "timestamp", "created_at", "updated_at",
+    "mime_type", "sha256", "category", "pricing_model", "code", "availability_status",
+    "title", "description",     # interactive replies echo our own button/list labels
+}
+_TEXT_KEYS = {"body", "content", "caption", "processed_message_content"}
+_URL_KEYS = {"link", "url", "data_url", "thumb_url", "thumbnail", "avatar_url"}  # may embed access tokens
+
+def _digest(value: str) -> bytes:
+    return hmac.new(CAPTURE_SECRET, value.encode(), hashlib.sha256).digest()
+
+def pseudo_digits(digits: str) -> str:
+    d = _digest(digits)
+    return "".join(str(d[i % len(d)] % 10) for i in range(len(digits)))
+
+def pseudo_text(text: str) -> str:
+    return _DIGITS_RE.sub(lambda m: pseudo_digits(m.group(0)), text)
+
+def pseudonymize(obj: Any, key: str = "") -> Any:
+    if isinstance(obj, dict):
+        return {k: pseudonymize(v, k) for k, v in obj.items()}
+    if isinstance(obj, list):
+        return [pseudonymize(v, key) for v in obj]
+    if not isinstance(obj, str) or not obj or key in _STRUCTURAL_KEYS:
+        return obj
+    if key in _TEXT_KEYS:
+        return pseudo_text(obj)
+    if key in _URL_KEYS:
+        return ""
+    if _NUMBERISH_RE.fullmatch(obj):
+        return re.sub(r"\d+", lambda m: pseudo_digits(m.group(0)), obj)
+    return f"anon-{_digest(obj).hex()[:8]}"
+
+def replay_key(channel: str, payload: dict) -> str:
+    """Ordering key on replay: the (pseudonymized) patient behind an event."""
+    try:
+        if channel == "whatsapp":
+            value = payload["entry"][0]["changes"][0]["value"]
+            msgs = value.get("messages") or value.get("statuses") or [{}]
+            return msgs[0].get("from") or msgs[0].get("recipient_id") or ""
+        sender = payload.get("sender") or {}
+        return str(sender.get("id") or (payload.get("conversation") or {}).get("id") or "")
+    except (KeyError, IndexError, AttributeError):
+        return ""
+
+# ────────────────────────────── Writer ─────────────────────────────
+class TrafficRecorder:
+    """Appends captured webhooks to a gzip JSONL file from a background thread.
+
+    The request thread only enqueues the raw body; decoding and
+    pseudonymization happen on the writer thread. Each flush writes a new
+    gzip member, which gzip readers concatenate transparently.
+    """
+
+    def __init__(self, path: str, sample: float = CAPTURE_SAMPLE):
+        self.path = path
+        self.sample = sample
+        if not CAPTURE_SECRET:
+            raise ValueError("CAPTURE_SECRET is required: without it pseudonyms can be reversed by brute force")
+        self._queue: queue.SimpleQueue = queue.SimpleQueue()
+        self._thread = threading.Thread(target=self._run, name="traffic-capture", daemon=True)
+        self._count = 0
+        self._thread.start()
+
+    def record(self, channel: str, raw: bytes):
+        if self.sample < 1.0 and random.random() >= self.sample:
+            return
+        self._queue.put((time.time(), channel, raw))
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + 1.0
+            while len(batch) < 500:
+                try:
+                    batch.append(self._queue.get(timeout=max(0.0, deadline - time.monotonic())))
+                except queue.Empty:
+                    break
+            lines = []
+            for ts, channel, raw in batch:
+                try:
+                    payload = pseudonymize(jsonCodec.loads(raw))
+                except Exception:
+                    continue
+                lines.append(jsonCodec.dumps({
+                    "ts": round(ts, 4),
+                    "channel": channel,
+                    "key": replay_key(channel, payload),
+                    "payload": payload,
+                }) + b"\n")
+            if not lines:
+                continue
+            try:
+                os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+                with gzip.open(self.path, "ab") as fh:
+                    fh.writelines(lines)
+                self._count += len(lines)
+            except OSError as e:
+                log.warning("Traffic capture write failed: %s", e)
+
+recorder: Optional[TrafficRecorder] = None
+if CAPTURE_FILE and not CAPTURE_SECRET:
+    log.error("CAPTURE_FILE is set but CAPTURE_SECRET is not; traffic capture stays off")
+elif CAPTURE_FILE:
+    recorder = TrafficRecorder(CAPTURE_FILE)
+
+def record(channel: str, raw: bytes):
+    """Capture an inbound webhook body if capture is enabled."""
+    if recorder is not None and raw:
+        recorder.record(channel, raw)
+
+def read(path: str):
+    """Yield captured events (dicts) from a capture file, in order."""
+    with gzip.open(path, "rb") as fh:
+        for line in fh:
+            if line.strip():
+                yield jsonCodec.loads(line)
@@ -2,10 +2,12 @@ from __future__ import annotations
 
 import logging
 import os
-import json
+import time
 import requests
 
 from typing import Dict, Optional, Any
+from concurrent.futures import Future
+from dataclasses import dataclass, field
 from datetime import datetime, timedelta
 from dotenv import load_dotenv
 from flask import Blueprint, request, jsonify
@@ -13,6 +15,19 @@ from flask import Blueprint, request, jsonify
 from botFSM import ChatBot
 from whatsappAPI import AGENTS
 from utils import clean_phone_number
+from agentLoad import AgentLoadIndex, AgentRoster, HandoffIndex, CONVERSATION_EVENTS, ROSTER_EVENTS
+from fanout import run_graph
+from transports import Transport, OutboundPipeline, pooled_session
+from logConfig import log_event
+import jsonCodec
+import metrics
+import tracing
+import capture
+import admission
+import outbox
+import funnel
+from profiler import profiled
+from dispatcher import COPY_HEADER
 
 load_dotenv()
 
@@ -26,6 +41,9 @@ logger = logging.getLogger(__name__)
 # CHATWOOT_WEBHOOK_TOKEN - Webhook verification token (optional, set to "SKIP" to disable)
 # AGENT_ASSIGNMENT - Strategy for agent assignment: "round_robin", "least_busy", or "specific" (default: round_robin)
 # DEFAULT_AGENT_ID - Default agent ID for "specific" assignment strategy (optional)
+# CHATWOOT_SEND_LANES - Parallel outbound lanes for Chatwoot messages (default: 4)
+# CHATWOOT_ASYNC_SEND - "0" to send Chatwoot messages inline on the request thread
+# CHATWOOT_COALESCE - "1" to merge queued text messages for one conversation into one
 
 # ────────────────────────────── Configuration ─────────────────────────────
 class ChatwootConfig:
@@ -34,6 +52,9 @@ class ChatwootConfig:
     BOT_TOKEN = os.getenv("CHATWOOT_BOT_TOKEN")
     WEBHOOK_TOKEN = os.getenv("CHATWOOT_WEBHOOK_TOKEN")
     TIMEOUT = 15
+    SEND_LANES = int(os.getenv("CHATWOOT_SEND_LANES", "4"))
+    ASYNC_SEND = os.getenv("CHATWOOT_ASYNC_SEND", "1") != "0"
+    COALESCE = os.getenv("CHATWOOT_COALESCE", "0") == "1"
     
     @classmethod
     def validate(cls):
@@ -57,22 +78,35 @@ class ChatwootClient:
             "api_access_token": config.BOT_TOKEN,
             "Content-Type": "application/json"
         }
+        # Pooled keep-alive connections, shared by the send lanes and handoff steps
+        self.session = pooled_session(config.SEND_LANES + 8)
     
     def _request(self, method: str, endpoint: str, **kwargs) -> Optional[Dict]:
         url = f"{self.base_url}{endpoint}"
+        if "json" in kwargs:
+            kwargs["data"] = jsonCodec.dumps(kwargs.pop("json"))
+        start = time.perf_counter()
         try:
-            response = requests.request(
-                method=method,
-                url=url,
-                headers=self.headers,
-                timeout=self.config.TIMEOUT,
-                **kwargs
-            )
-            response.raise_for_status()
-            return response.json() if response.content else {}
+            with tracing.span("upstream.chatwoot", method=method, endpoint=endpoint):
+                response = self.session.request(
+                    method=method,
+                    url=url,
+                    headers=self.headers,
+                    timeout=self.config.TIMEOUT,
+                    **kwargs
+                )
+                response.raise_for_status()
+                return jsonCodec.loads(response.content) if response.content else {}
         except requests.RequestException as e:
-            logger.error(f"Chatwoot API error {method} {endpoint}: {e}")
+            metrics.UPSTREAM_ERRORS.inc(call="chatwoot")
+            logger.error("Chatwoot API error %s %s: %s", method, endpoint, e)
+            return None
+        except jsonCodec.DecodeError as e:
+            metrics.UPSTREAM_ERRORS.inc(call="chatwoot")
+            logger.error("Chatwoot API returned non-JSON %s %s: %s", method, endpoint, e)
             return None
+        finally:
+            metrics.UPSTREAM_SECONDS.observe(time.perf_counter() - start, call="chatwoot", method=method)
     
     def send_message(self, conversation_id: int, content: str, 
                     message_type: str = "outgoing") -> bool:
@@ -116,66 +150,101 @@ class ChatwootClient:
         result = self._request("PATCH", f"/conversations/{conversation_id}", json=data)
         return result is not None
 
-# ────────────────────────────── Bot Interface Adapter ─────────────────────────────
-class ChatwootBotInterface:
-    """Adapter that implements WhatsApp API interface for Chatwoot"""
+# ────────────────────────────── Chatwoot Transport ─────────────────────────────
+def _coalesce_texts(batch: list) -> list:
+    """Merge consecutive plain-text sends to the same conversation"""
+    groups: list = []
+    for item in batch:
+        prev = groups[-1][0] if groups else None
+        if prev is not None and item.kind == prev.kind == "text" and item.key == prev.key:
+            conv_id, body = prev.args
+            prev.args = (conv_id, f"{body}\n\n{item.args[1]}")
+            groups[-1].append(item)
+        else:
+            groups.append([item])
+    return groups
+
+class ChatwootTransport(Transport):
+    """Transport that delivers bot messages into Chatwoot conversations"""
+    channel = "chatwoot"
+    durable_calls = frozenset({"send_message", "send_interactive_message"})
     
     def __init__(self, client: ChatwootClient):
         self.client = client
         self.conversation_map: Dict[str, int] = {}
+        self.send_timeout = 2 * client.config.TIMEOUT   # connect + read
+        super().__init__(
+            OutboundPipeline("chatwoot", client.config.SEND_LANES,
+                             coalesce=_coalesce_texts if client.config.COALESCE else None),
+            client.config.ASYNC_SEND,
+            outbox.shared(),
+        )
+    
+    def _deliver(self, call: str, args: list, idem_key: str):
+        if not getattr(self.client, call)(*args):
+            raise RuntimeError(f"Chatwoot {call} failed")
     
     def set_conversation(self, contact_id: str, conversation_id: int):
         """Map contact to conversation ID"""
         self.conversation_map[contact_id] = conversation_id
     
-    def send_text(self, to: str, body: str, preview_url: bool = False) -> str:
-        """WhatsApp API compatible text sending"""
+    def _send(self, to: str, kind: str, body: str, options: Optional[list[str]] = None):
+        # Resolve the conversation now, not when the lane gets to it
         conv_id = self.conversation_map.get(to)
-        if conv_id:
-            success = self.client.send_message(conv_id, body)
-            return "msg_sent" if success else "msg_failed"
-        return "no_conversation"
+        if not conv_id:
+            return "no_conversation"
+        if options is None:
+            return self._dispatch(str(conv_id), kind, self.client.send_message, conv_id, body)
+        return self._dispatch(str(conv_id), kind, self.client.send_interactive_message,
+                              conv_id, body, options)
+    
+    def post_message(self, conversation_id: int, body: str) -> bool:
+        """Send to a conversation behind anything already queued for it, and wait"""
+        sent = self._dispatch(str(conversation_id), "text", self.client.send_message,
+                              conversation_id, body)
+        if isinstance(sent, Future):
+            sent = sent.result(timeout=self.client.config.TIMEOUT * 2)
+        return bool(sent)
+    
+    def send_text(self, to: str, body: str, preview_url: bool = False):
+        """WhatsApp API compatible text sending"""
+        return self._send(to, "text", body)
     
     def send_two_buttons(self, to: str, question: str, yes_id: str, no_id: str, 
-                        str1: str, str2: str) -> str:
+                        str1: str, str2: str):
         """Send interactive buttons (simplified for Chatwoot)"""
-        conv_id = self.conversation_map.get(to)
-        if conv_id:
-            options = [f"{str1} (responde: {yes_id})", f"{str2} (responde: {no_id})"]
-            success = self.client.send_interactive_message(conv_id, question, options)
-            return "buttons_sent" if success else "buttons_failed"
-        return "no_conversation"
+        options = [f"{str1} (responde: {yes_id})", f"{str2} (responde: {no_id})"]
+        return self._send(to, "buttons", question, options)
     
     def sendDocType(self, to: str, body: str):
         """Send document type selection"""
-        conv_id = self.conversation_map.get(to)
-        if conv_id:
-            options = [
-                "CC - Cédula de Ciudadanía",
-                "TI - Tarjeta de Identidad", 
-                "CE - Cédula de Extranjería",
-                "RC - Registro Civil",
-                "PT - Permiso de Trabajo",
-                "SC - Salvoconducto",
-                "AS - Adulto Sin I.D."
-            ]
-            self.client.send_interactive_message(conv_id, body, options)
+        options = [
+            "CC - Cédula de Ciudadanía",
+            "TI - Tarjeta de Identidad", 
+            "CE - Cédula de Extranjería",
+            "RC - Registro Civil",
+            "PT - Permiso de Trabajo",
+            "SC - Salvoconducto",
+            "AS - Adulto Sin I.D."
+        ]
+        return self._send(to, "list", body, options)
     
     def sendMenu(self, to: str, body: str):
         """Send main menu options"""
-        conv_id = self.conversation_map.get(to)
-        if conv_id:
-            options = [
-                "ESTADO_MED - Estado del Medicamento",
-                "HORARIO_UBI - Horarios y Ubicaciones", 
-                "MED_AUTORIZAR - Medicamento a Domicilio",
-                "OTROS - Hablar con un agente"
-            ]
-            self.client.send_interactive_message(conv_id, body, options)
+        options = [
+            "ESTADO_MED - Estado del Medicamento",
+            "HORARIO_UBI - Horarios y Ubicaciones", 
+            "MED_AUTORIZAR - Medicamento a Domicilio",
+            "OTROS - Hablar con un agente"
+        ]
+        return self._send(to, "list", body, options)
+
+# Backward compatible name
+ChatwootBotInterface = ChatwootTransport
 
 # ────────────────────────────── Session Management ─────────────────────────────
 class SessionManager:
-    def __init__(self, bot_interface: ChatwootBotInterface, timeout_hours: int = 2):
+    def __init__(self, bot_interface: ChatwootTransport, timeout_hours: int = 2):
         self.bot_interface = bot_interface
         self.sessions: Dict[str, ChatBot] = {}
         self.session_timestamps: Dict[str, datetime] = {}
@@ -190,15 +259,8 @@ class SessionManager:
             self.session_timestamps[contact_id] = datetime.now()
             return self.sessions[contact_id]
         
-        # Create new bot with Chatwoot interface
-        bot = ChatBot(sender=contact_id)
-        
-        # Replace bot's WhatsApp methods with Chatwoot methods
-        import whatsappAPI as wa
-        wa.send_text = self.bot_interface.send_text
-        wa.send_two_buttons = self.bot_interface.send_two_buttons  
-        wa.sendDocType = self.bot_interface.sendDocType
-        wa.sendMenu = self.bot_interface.sendMenu
+        # Create new bot that talks through the Chatwoot transport
+        bot = ChatBot(sender=contact_id, transport=self.bot_interface)
         
         self.sessions[contact_id] = bot
         self.session_timestamps[contact_id] = datetime.now()
@@ -219,20 +281,40 @@ class SessionManager:
             self.session_timestamps.pop(contact_id, None)
         
         if expired:
-            logger.info(f"Cleaned up {len(expired)} expired bot sessions")
+            logger.info("Cleaned up %d expired bot sessions", len(expired))
 
 # ────────────────────────────── Agent Handoff ─────────────────────────────
+@dataclass
+class HandoffResult:
+    """Outcome of a handoff; truthy when the conversation was handed over"""
+    completed: bool
+    agent_id: Optional[int] = None
+    failed_steps: Dict[str, str] = field(default_factory=dict)
+
+    def __bool__(self) -> bool:
+        return self.completed
+
+def _require(ok: bool, what: str) -> bool:
+    if not ok:
+        raise RuntimeError(f"{what} failed")
+    return ok
+
 class AgentHandoff:
-    def __init__(self, client: ChatwootClient):
+    def __init__(self, client: ChatwootClient, load_index: Optional[AgentLoadIndex] = None,
+                 roster: Optional[AgentRoster] = None,
+                 transport: Optional[ChatwootTransport] = None):
         self.client = client
+        self.transport = transport
+        self.load_index = load_index or AgentLoadIndex(client)
+        self.roster = roster or AgentRoster(client)
         self.agent_assignment_strategy = os.getenv("AGENT_ASSIGNMENT", "round_robin")  # round_robin, least_busy, or specific
         self.default_agent_id = os.getenv("DEFAULT_AGENT_ID")  # Fallback agent ID
     
     def get_available_agents(self) -> Optional[list]:
         """Get list of available agents"""
         try:
-            # Get all agents
-            agents = self.client._request("GET", "/agents")
+            # Get all agents (cached, refreshed in the background)
+            agents = self.roster.agents()
             if not agents:
                 return None
             
@@ -246,24 +328,12 @@ class AgentHandoff:
             return available if available else agents  # Return all if none online
             
         except Exception as e:
-            logger.error(f"Failed to get agents: {e}")
+            logger.error("Failed to get agents: %s", e)
             return None
     
     def get_agent_conversations_count(self, agent_id: int) -> int:
-        """Get number of open conversations for an agent"""
-        try:
-            # Get conversations assigned to this agent
-            params = {
-                "assignee_type": "assigned",
-                "assignee_id": agent_id,
-                "status": "open"
-            }
-            result = self.client._request("GET", "/conversations", params=params)
-            return len(result.get("data", [])) if result else 0
-            
-        except Exception as e:
-            logger.error(f"Failed to get agent conversation count: {e}")
-            return 0
+        """Get number of open conversations for an agent (from the load index)"""
+        return self.load_index.count(agent_id)
     
     def select_agent(self, available_agents: list) -> Optional[int]:
         """Select an agent based on assignment strategy"""
@@ -272,14 +342,7 @@ class AgentHandoff:
         
         if self.agent_assignment_strategy == "least_busy":
             # Find agent with least open conversations
-            agent_loads = []
-            for agent in available_agents:
-                count = self.get_agent_conversations_count(agent["id"])
-                agent_loads.append((agent["id"], count, agent))
-            
-            # Sort by conversation count
-            agent_loads.sort(key=lambda x: x[1])
-            return agent_loads[0][0] if agent_loads else None
+            return self.load_index.least_busy(a["id"] for a in available_agents)
             
         elif self.agent_assignment_strategy == "specific":
             # Use specific agent if available
@@ -296,67 +359,86 @@ class AgentHandoff:
             return available_agents[0]["id"]
     
     def handoff_to_agent(self, conversation_id: int, contact_id: str, 
-                        bot_context: Dict[str, Any]) -> bool:
-        """Hand conversation over to human agent"""
+                        bot_context: Dict[str, Any]) -> HandoffResult:
+        """Hand conversation over to human agent
+        
+        The Chatwoot calls are independent of each other, so they run in
+        parallel; customer-visible messages are sent in order within a
+        single step.
+        """
         try:
             # Get available agents
             available_agents = self.get_available_agents()
             if not available_agents:
                 logger.error("No agents available for handoff")
-                self.client.send_message(
+                (self.transport.post_message if self.transport else self.client.send_message)(
                     conversation_id,
                     "Lo siento, no hay agentes disponibles en este momento. "
                     "Por favor intenta más tarde o deja tu mensaje."
                 )
-                return False
+                return HandoffResult(False)
             
             # Select an agent
             selected_agent_id = self.select_agent(available_agents)
             if not selected_agent_id:
                 logger.error("Failed to select an agent")
-                return False
+                return HandoffResult(False)
             
             # Find agent name for logging
             agent_name = next(
                 (a.get("name", "Unknown") for a in available_agents if a["id"] == selected_agent_id),
                 "Unknown"
             )
-            logger.info(f"Assigning conversation {conversation_id} to agent {agent_name} (ID: {selected_agent_id})")
-            
-            # Add labels for agent routing
-            self.client.add_labels(conversation_id, ["bot-handoff", "needs-agent"])
-            
-            # Send context to agents first (before assignment)
-            context_msg = self._format_context_message(bot_context)
-            self.client.send_message(conversation_id, context_msg, message_type="private")
-            
-            # Assign to selected agent
-            assignment_success = self.client.assign_agent(conversation_id, selected_agent_id)
-            if not assignment_success:
-                logger.error(f"Failed to assign conversation to agent {selected_agent_id}")
-            
-            # Update conversation status to open
-            self.client.update_conversation_status(conversation_id, "open")
-            
-            # Send handoff confirmation to customer
-            handoff_msg = (
-                f"Te estoy conectando con uno de nuestros agentes. "
-                f"Un momento por favor... 👨‍💼"
-            )
-            self.client.send_message(conversation_id, handoff_msg)
+            logger.info("Assigning conversation %s to agent %s (ID: %s)", conversation_id, agent_name, selected_agent_id)
             
-            # Add a note for the agent
+            # Context and handoff note go out as a single private message
             agent_note = (
-                f"🤖 Bot handoff completed. Customer was in state: {bot_context.get('current_state', 'unknown')}. "
-                f"Please review the context message above."
+                f"🤖 Bot handoff completed. Customer was in state: {bot_context.get('current_state', 'unknown')}."
             )
-            self.client.send_message(conversation_id, agent_note, message_type="private")
+            private_msg = f"{self._format_context_message(bot_context)}\n\n{agent_note}"
             
-            return True
+            # Messages the customer sees, in the order they must arrive
+            customer_msgs = [
+                "Te estoy conectando con uno de nuestros agentes. "
+                "Un momento por favor... 👨‍💼",
+            ]
+            
+            def send_customer_msgs():
+                # Through the transport so they land after the bot's queued replies
+                send = self.transport.post_message if self.transport else self.client.send_message
+                for msg in customer_msgs:
+                    _require(send(conversation_id, msg), "customer message")
+                return True
+            
+            def assign():
+                _require(self.client.assign_agent(conversation_id, selected_agent_id), "assignment")
+                self.load_index.note_assignment(conversation_id, selected_agent_id)
+                return True
+            
+            report = run_graph({
+                "labels": (lambda: _require(self.client.add_labels(
+                    conversation_id, ["bot-handoff", "needs-agent"]), "labels"), ()),
+                "private_note": (lambda: _require(self.client.send_message(
+                    conversation_id, private_msg, message_type="private"), "private note"), ()),
+                "assign": (assign, ()),
+                "status": (lambda: _require(self.client.update_conversation_status(
+                    conversation_id, "open"), "status update"), ()),
+                "customer_messages": (send_customer_msgs, ()),
+            })
+            
+            if "assign" in report.failed:
+                # Nobody owns the conversation; the caller keeps the bot on it
+                logger.error("Handoff of conversation %s failed, no agent assigned: %s",
+                             conversation_id, report.failed)
+                return HandoffResult(False, failed_steps=dict(report.failed))
+            if report.failed:
+                logger.error("Handoff of conversation %s partially failed: %s", conversation_id, report.failed)
+            
+            return HandoffResult(True, selected_agent_id, dict(report.failed))
             
         except Exception as e:
-            logger.error(f"Agent handoff failed for conversation {conversation_id}: {e}")
-            return False
+            logger.error("Agent handoff failed for conversation %s: %s", conversation_id, e)
+            return HandoffResult(False)
     
     def _format_context_message(self, context: Dict[str, Any]) -> str:
         """Format bot context for agent"""
@@ -376,6 +458,9 @@ class AgentHandoff:
             
         if context.get("last_query"):
             lines.append(f"💬 Última consulta: {context['last_query']}")
+
+        for label in context.get("attachments") or ():
+            lines.append(f"📎 Adjunto: {label}")
         
         lines.append("\n_El usuario ahora está conectado con un agente humano._")
         
@@ -510,24 +595,56 @@ def extract_doc_type(content: str) -> Optional[str]:
     return None
 
 # ────────────────────────────── Flask Blueprint ─────────────────────────────
+def _count_states(sessions: Dict[str, ChatBot]) -> Dict[str, int]:
+    counts: Dict[str, int] = {}
+    for bot in list(sessions.values()):
+        state = bot.current_state.id
+        counts[state] = counts.get(state, 0) + 1
+    return counts
+
 def create_chatwoot_blueprint() -> Blueprint:
     # Validate configuration
     ChatwootConfig.validate()
     
     # Initialize components
     client = ChatwootClient(ChatwootConfig)
-    bot_interface = ChatwootBotInterface(client)
+    bot_interface = ChatwootTransport(client)
     session_manager = SessionManager(bot_interface)
-    agent_handoff = AgentHandoff(client)
+    agent_handoff = AgentHandoff(client, transport=bot_interface)
+    handoffs = HandoffIndex()
+    # Count open conversations per agent off the request path; handoffs
+    # meanwhile see every agent as idle. Conversations the count finds
+    # assigned are left to their agent, even those handed off before a restart.
+    agent_handoff.load_index.on_seed = handoffs.seed
+    agent_handoff.load_index.start()
+    
+    # Gauges read at scrape time
+    metrics.gauge("bot_sessions", "Live bot sessions by state").set_function(
+        lambda: _count_states(session_manager.sessions), label="state", channel="chatwoot")
+    metrics.gauge("agent_roster_age_seconds", "Age of the cached Chatwoot agent roster").set_function(
+        agent_handoff.roster.age_seconds)
+    metrics.gauge("agent_open_conversations", "Open conversations per agent (load index)").set_function(
+        agent_handoff.load_index.snapshot, label="agent_id")
+    metrics.gauge("handoff_conversations", "Conversations currently left to a human agent").set_function(
+        lambda: len(handoffs))
     
     bp = Blueprint("chatwoot", __name__, url_prefix="/chatwoot")
+    wanted_events = {"message_created"} | CONVERSATION_EVENTS | ROSTER_EVENTS
     
     @bp.route("/health", methods=["GET"])
     def health_check():
         """Health check endpoint"""
-        return jsonify({"status": "ok", "service": "chatwoot-bot"}), 200
+        return jsonify({
+            "status": "ok",
+            "service": "chatwoot-bot",
+            "agent_roster": agent_handoff.roster.stats(),
+            "outbound": bot_interface.stats(),
+        }), 200
     
     @bp.route("/webhook", methods=["POST"])
+    @metrics.timed(metrics.WEBHOOK_SECONDS, endpoint="chatwoot")
+    @tracing.traced_root("webhook.chatwoot")
+    @profiled
     def webhook():
         """Main webhook endpoint for Chatwoot"""
         try:
@@ -538,18 +655,42 @@ def create_chatwoot_blueprint() -> Blueprint:
                     logger.warning("Invalid webhook token received")
                     return jsonify({"error": "Invalid webhook token"}), 401
             
-            payload = request.get_json()
-            if not payload:
+            # Drop irrelevant events before paying for a full decode
+            raw = request.get_data(cache=False)
+            copy = request.headers.get(COPY_HEADER) == "1"
+            if not copy:
+                capture.record("chatwoot", raw)
+            reason = jsonCodec.chatwoot_reject_reason(raw, wanted_events)
+            if reason:
+                return jsonify({"status": "ignored", "reason": reason}), 200
+            
+            try:
+                payload = jsonCodec.loads(raw) if raw else None
+            except jsonCodec.DecodeError:
+                payload = None
+            if not payload or not isinstance(payload, dict):
                 return jsonify({"error": "No JSON payload"}), 400
             
             # Extract event type
             event = payload.get("event")
-            logger.info(f"Received webhook event: {event}")
+            outbox.begin_turn(f"cw:{payload['id']}" if payload.get("id") else None)
+            log_event(logger, logging.DEBUG, "cw.event", "Received webhook event: %s", event)
+            
+            # Keep the agent roster, handoff index and load index current from webhook events
+            agent_handoff.roster.apply_event(event)
+            handoffs.apply_event(event, payload)
+            if agent_handoff.load_index.apply_event(event, payload) or copy:
+                return jsonify({"status": "indexed", "event": event}), 200
             
             # Only process message creation events
             if event != "message_created":
                 return jsonify({"status": "ignored", "reason": f"not message_created, got {event}"}), 200
             
+            # Conversations already with an agent: no session, no upstream calls
+            conversation_id = (payload.get("conversation") or {}).get("id")
+            if conversation_id and conversation_id in handoffs:
+                return jsonify({"status": "ignored", "reason": "with agent"}), 200
+            
             # IMPORTANT: Chatwoot sends message data at the root level, not nested
             content = payload.get("content", "").strip()
             message_type = payload.get("message_type")
@@ -557,17 +698,14 @@ def create_chatwoot_blueprint() -> Blueprint:
             sender = payload.get("sender", {})
             inbox = payload.get("inbox", {})
             
-            logger.info(f"Message type: {message_type}, Content: '{content}'")
-            logger.info(f"Sender: {sender.get('name')} ({sender.get('phone_number')})")
-            
             # Skip messages from bots
             if sender.get("type") == "agent_bot":
-                logger.info("Skipping message from bot itself")
+                logger.debug("Skipping message from bot itself")
                 return jsonify({"status": "ignored", "reason": "from bot"}), 200
             
             # Only process incoming messages
             if message_type != "incoming":
-                logger.info(f"Skipping non-incoming message: {message_type}")
+                logger.debug("Skipping non-incoming message: %s", message_type)
                 return jsonify({"status": "ignored", "reason": f"not incoming, type: {message_type}"}), 200
             
             # Ensure we have content
@@ -596,16 +734,22 @@ def create_chatwoot_blueprint() -> Blueprint:
             if phone_number:
                 # Clean the phone number format for WhatsApp API
                 phone_number = clean_phone_number(phone_number)
-                logger.info(f"Using phone number: {phone_number}")
             
-            logger.info(f"Processing message: '{content}' from contact {contact_id} in conversation {conversation_id}")
             
             # Clean up expired sessions
             session_manager.cleanup_expired_sessions()
             
             # Get or create bot session - use cleaned phone number
             bot = session_manager.get_or_create_bot(phone_number or contact_id, conversation_id)
-            logger.info(f"Bot state before processing: {bot.current_state.name}")
+            verdict = admission.messages.admit(bot.sender)
+            if verdict != admission.ADMIT:
+                if verdict == admission.SHED_NOTIFY:
+                    bot.transport.send_text(bot.sender, admission.RATE_LIMIT_REPLY)
+                return jsonify({"status": "ignored", "reason": "rate_limited"}), 200
+            
+            state_before = bot.current_state.name
+            tracing.current_span().set(conversation_id=conversation_id, contact_id=contact_id,
+                                       state_before=state_before)
             
             # Process message based on content and bot state
             try:
@@ -615,11 +759,12 @@ def create_chatwoot_blueprint() -> Blueprint:
                 if bot.current_state.name == "docType":
                     doc_type = extract_doc_type(content)
                     if doc_type:
-                        logger.info(f"Document type detected: {doc_type}")
+                        logger.debug("Document type detected: %s", doc_type)
                         bot.list_op(doc_type)
                         processed = True
                     else:
                         # Let bot handle invalid input
+                        funnel.unrecognized("doc_type", content)
                         bot.text_op(content)
                         processed = True
                 
@@ -627,12 +772,14 @@ def create_chatwoot_blueprint() -> Blueprint:
                 elif bot.current_state.name == "menu":
                     menu_option = extract_menu_option(content)
                     if menu_option:
-                        logger.info(f"Menu option detected: {menu_option}")
+                        logger.debug("Menu option detected: %s", menu_option)
                         bot.list_op(menu_option)
                         processed = True
                     else:
                         # For unrecognized input in menu state, show menu again
-                        bot.sendMenu(bot.sender, "Por favor selecciona una opción del menú:")
+                        metrics.FSM_REPROMPTS.inc(state="menu")
+                        funnel.unrecognized("menu", content)
+                        bot.transport.sendMenu(bot.sender, "Por favor selecciona una opción del menú:")
                         processed = True
                 
                 # For other states or if no specific handler matched
@@ -650,10 +797,12 @@ def create_chatwoot_blueprint() -> Blueprint:
                         bot.text_op(content)
                         processed = True
                 
-                logger.info(f"Message processed successfully. Bot state after: {bot.current_state.name}")
+                log_event(logger, logging.INFO, "cw.message", "Chatwoot message processed",
+                          conversation_id=conversation_id, contact_id=contact_id,
+                          state_before=state_before, state_after=bot.current_state.name)
                 
             except Exception as e:
-                logger.error(f"Error processing message: {e}", exc_info=True)
+                logger.error("Error processing message: %s", e, exc_info=True)
                 processed = False
             
             # Handle agent handoff if bot is in human state or menu selection is OTROS
@@ -674,15 +823,20 @@ def create_chatwoot_blueprint() -> Blueprint:
                     "customer_name": sender.get("name"),
                     "phone": sender.get("phone_number"),
                     "first_name": getattr(bot, "_first_name", None) if hasattr(bot, "_first_name") else None,
-                    "status": getattr(bot, "_status", None) if hasattr(bot, "_status") else None
+                    "status": getattr(bot, "_status", None) if hasattr(bot, "_status") else None,
+                    "attachments": [f.label for f in getattr(bot, "attachments", ())],
                 }
                 
                 # Perform the handoff
                 success = agent_handoff.handoff_to_agent(conversation_id, contact_id, context)
-                logger.info(f"Agent handoff {'successful' if success else 'failed'}")
+                logger.info("Agent handoff %s", "successful" if success else "failed")
+                if success.failed_steps:
+                    logger.warning("Handoff steps failed: %s", ", ".join(success.failed_steps))
                 
-                # If handoff successful, remove bot session to prevent further processing
+                # If handoff successful, remove bot session and keep the bot out of
+                # the conversation until Chatwoot says it is resolved
                 if success:
+                    handoffs.add(conversation_id)
                     session_manager.sessions.pop(phone_number or contact_id, None)
                     session_manager.session_timestamps.pop(phone_number or contact_id, None)
             
@@ -693,7 +847,7 @@ def create_chatwoot_blueprint() -> Blueprint:
             }), 200
             
         except Exception as e:
-            logger.error(f"Webhook processing error: {e}", exc_info=True)
+            logger.error("Webhook processing error: %s", e, exc_info=True)
             return jsonify({"error": "Internal server error"}), 500
     
     return bp
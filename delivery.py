@@ -0,0 +1,83 @@
+from __future__ import annotations
+
+import os
+import time
+import logging
+import threading
+
+from collections import OrderedDict
+from typing import Iterable, Optional, Tuple
+
+import metrics
+
+log = logging.getLogger(__name__)
+
+# DELIVERY_TRACK_SIZE - Recently sent message ids kept for delivery latency (default: 50000)
+TRACK_SIZE = int(os.getenv("DELIVERY_TRACK_SIZE", "50000"))
+
+# Meta's status timestamps have one-second resolution; reads can take hours
+DELIVERY_BUCKETS = (1.0, 2.0, 5.0, 10.0, 30.0, 60.0, 300.0, 900.0, 3600.0, 14400.0, 86400.0)
+DELIVERY_SECONDS = metrics.histogram("wa_delivery_seconds",
+                                     "Time from our send to Meta's sent/delivered/read status",
+                                     buckets=DELIVERY_BUCKETS)
+STATUSES = metrics.counter("wa_statuses_total", "WhatsApp status callbacks by status")
+
+STAGES = ("sent", "delivered", "read")
+
+# (message id, status, unix timestamp) as Meta reports it
+StatusEvent = Tuple[str, str, int]
+
+class DeliveryTracker:
+    """Send times of recent outbound message ids, matched against status callbacks.
+
+    `sent()` is called with the wamid Graph returns; each later status
+    for that id observes (status timestamp - send time) once per stage.
+    Meta does not order status webhooks, so an id is only dropped once it
+    has seen every stage or has failed; the oldest are evicted past
+    `maxsize`, so ids that never get a status don't accumulate. Only sends
+    made by this process can be matched.
+
+    That matters in two setups, where statuses count as tracked="no" and
+    give no latency:
+    - with OUTBOX_PATH set, durable sends are made by whichever process
+      holds the outbox drain lease, not by the one that queued them;
+    - behind the dispatcher, a status usually reaches the worker that owns
+      the patient, and that is not necessarily the drainer.
+    wa_delivery_seconds then only covers the drainer's own share. Read it
+    per worker, and compare it with wa_statuses_total{tracked="no"}.
+    """
+
+    def __init__(self, maxsize: int = TRACK_SIZE):
+        self.maxsize = maxsize
+        self._sent: "OrderedDict[str, list]" = OrderedDict()   # wamid -> [sent_at, phone_id, stages seen]
+        self._lock = threading.Lock()
+        metrics.gauge("wa_delivery_tracked", "Sent message ids awaiting a status").set_function(
+            lambda: len(self._sent))
+
+    def sent(self, wamid: str, phone_id: Optional[str] = None):
+        with self._lock:
+            self._sent[wamid] = [time.time(), phone_id, set()]
+            if len(self._sent) > self.maxsize:
+                self._sent.popitem(last=False)
+
+    def observe(self, wamid: str, status: str, timestamp: Optional[int] = None):
+        with self._lock:
+            item = self._sent.get(wamid)
+            first = item is not None and status not in item[2]
+            if first:
+                item[2].add(status)
+            if item is not None and (status == "failed" or item[2].issuperset(STAGES)):
+                del self._sent[wamid]
+        STATUSES.inc(status=status, tracked="yes" if item is not None else "no")
+        if first and status in STAGES:
+            at = float(timestamp) if timestamp else time.time()
+            DELIVERY_SECONDS.observe(max(0.0, at - item[0]), stage=status, phone_id=item[1])
+
+    def __len__(self) -> int:
+        return len(self._sent)
+
+tracker = DeliveryTracker()
+
+def observe(events: Iterable[StatusEvent]):
+    for wamid, status, timestamp in events:
+        tracker.observe(wamid, status, timestamp)
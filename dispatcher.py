@@ -0,0 +1,415 @@
+"""Sender-affine front process for running the bot on several cores.
+
+    python -m dispatcher --workers 4 --port 5000
+
+Sessions (ChatBot instances) live in per-process dicts, so plain gunicorn
+workers would scatter one patient's messages over processes that each
+hold a different copy of the conversation. Here a front process accepts
+every HTTP request, derives an affinity key (WhatsApp number + sender, or
+the Chatwoot contact), and forwards the request over a pipe to the
+worker process that owns that key. Ownership is decided by rendezvous
+hashing over the live workers: when a worker dies only its own keys move
+to the others, and they move back once it has been restarted.
+
+Inside a worker, requests for the same key run on the same lane thread,
+so a ChatBot is never driven by two threads at once.
+
+State that is not per patient is handled here too:
+- Chatwoot conversation and roster events go to every worker (copies are
+  marked with X-Dispatch-Copy), so each worker's agent load index sees
+  every assignment, not just those of its own patients;
+- GET /metrics is scraped from every worker and merged, with a `worker`
+  label on each sample;
+- other requests without a body (e.g. /profile) can be pinned to a worker
+  with ?worker=<slot>;
+- workers get DISPATCH_PEERS, so process-wide budgets (send rate per
+  number, upstream concurrency) are split between them instead of
+  multiplied.
+"""
+from __future__ import annotations
+
+import io
+import os
+import sys
+import time
+import queue
+import hashlib
+import logging
+import argparse
+import importlib
+import threading
+import multiprocessing as mp
+
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional, Tuple
+
+import jsonCodec
+from agentLoad import CONVERSATION_EVENTS, ROSTER_EVENTS
+
+log = logging.getLogger(__name__)
+
+# DISPATCH_WORKERS - Worker processes (default: CPU count)
+# DISPATCH_LANES   - Per-sender serialized lanes inside each worker (default: 16)
+# DISPATCH_TIMEOUT - Seconds the front waits for a worker's response (default: 60)
+# DISPATCH_APP     - WSGI app the workers serve, "module:attr" (default: app:app)
+WORKERS = int(os.getenv("DISPATCH_WORKERS", str(os.cpu_count() or 1)))
+LANES = int(os.getenv("DISPATCH_LANES", "16"))
+TIMEOUT = float(os.getenv("DISPATCH_TIMEOUT", "60"))
+APP = os.getenv("DISPATCH_APP", "app:app")
+
+# request:  (request id, method, path, query string, headers, body)
+# response: (request id, status, headers, body)
+Request = Tuple[int, str, str, str, List[Tuple[str, str]], bytes]
+
+COPY_HEADER = "X-Dispatch-Copy"
+# Chatwoot events every worker's shared indexes must see (agentLoad)
+BROADCAST_EVENTS = CONVERSATION_EVENTS | ROSTER_EVENTS
+
+# ────────────────────────────── Affinity ─────────────────────────────
+def route(path: str, body: bytes) -> Tuple[str, bool]:
+    """Affinity key of a request, and whether every worker should get a copy."""
+    if not body:
+        return path, False
+    try:
+        payload = jsonCodec.loads(body)
+    except jsonCodec.DecodeError:
+        return path, False
+    if not isinstance(payload, dict):
+        return path, False
+    if path.startswith("/chatwoot"):
+        # message events carry the contact at the root, conversation events under meta
+        sender = payload.get("sender") or (payload.get("meta") or {}).get("sender") or {}
+        phone = "".join(c for c in str(sender.get("phone_number") or "") if c.isdigit())
+        conversation = payload.get("conversation") or {}
+        key = f"cw:{phone or sender.get('id') or conversation.get('id') or ''}"
+        return key, payload.get("event") in BROADCAST_EVENTS
+    try:
+        value = payload["entry"][0]["changes"][0]["value"]
+    except (KeyError, IndexError, TypeError):
+        return path, False
+    phone_id = (value.get("metadata") or {}).get("phone_number_id", "")
+    msg = (value.get("messages") or value.get("statuses") or [{}])[0]
+    return f"wa:{phone_id}:{msg.get('from') or msg.get('recipient_id') or ''}", False
+
+def affinity_key(path: str, body: bytes) -> str:
+    """The patient a webhook belongs to; requests without one spread by path."""
+    return route(path, body)[0]
+
+def _score(slot: int, key: str) -> int:
+    return int.from_bytes(hashlib.blake2b(f"{slot}:{key}".encode(), digest_size=8).digest(), "big")
+
+def owner(key: str, slots: List[int]) -> Optional[int]:
+    """Rendezvous (highest random weight) choice of a worker slot for `key`."""
+    return max(slots, key=lambda s: _score(s, key)) if slots else None
+
+def _pinned_slot(query: str, slots: List[int]) -> Optional[int]:
+    """The live slot named by ?worker=<slot>, if any."""
+    for part in query.split("&"):
+        name, _, value = part.partition("=")
+        if name == "worker" and value.isdigit() and int(value) in slots:
+            return int(value)
+    return None
+
+def merge_metrics(scrapes: Dict[int, str]) -> str:
+    """Merge workers' Prometheus text into one exposition, labelling samples by worker.
+
+    Samples of a metric family stay together under its HELP/TYPE lines, as
+    the format requires.
+    """
+    families: Dict[str, Tuple[List[str], List[str]]] = {}
+    for slot, text in sorted(scrapes.items()):
+        family = None
+        for line in text.splitlines():
+            if not line:
+                continue
+            if line.startswith("#"):
+                parts = line.split(None, 3)
+                if len(parts) >= 3 and parts[1] in ("HELP", "TYPE"):
+                    family = parts[2]
+                    headers, _ = families.setdefault(family, ([], []))
+                    if line not in headers:
+                        headers.append(line)
+                continue
+            name, brace, rest = line.partition("{")
+            if brace:
+                line = f'{name}{{worker="{slot}",{rest}'
+            else:
+                name, _, value = line.partition(" ")
+                line = f'{name}{{worker="{slot}"}} {value}'
+            families.setdefault(family or name, ([], []))[1].append(line)
+    out = []
+    for headers, samples in families.values():
+        out.extend(headers)
+        out.extend(samples)
+    return "\n".join(out) + "\n"
+
+# ────────────────────────────── Worker process ─────────────────────────────
+def _load_app(spec: str):
+    module, _, attr = spec.partition(":")
+    app = getattr(importlib.import_module(module), attr or "app")
+    if module == "app":
+        # like `python app.py`: serve the Chatwoot webhook too
+        from chatwootWebhook import cw_bp
+        if "chatwoot" not in app.blueprints:
+            app.register_blueprint(cw_bp)
+    return app
+
+def _environ(method: str, path: str, query: str, headers: List[Tuple[str, str]], body: bytes) -> dict:
+    env = {
+        "REQUEST_METHOD": method, "SCRIPT_NAME": "", "PATH_INFO": path, "QUERY_STRING": query,
+        "SERVER_NAME": "dispatcher", "SERVER_PORT": "0", "SERVER_PROTOCOL": "HTTP/1.1",
+        "CONTENT_LENGTH": str(len(body)),
+        "wsgi.version": (1, 0), "wsgi.url_scheme": "http", "wsgi.input": io.BytesIO(body),
+        "wsgi.errors": sys.stderr, "wsgi.multithread": True, "wsgi.multiprocess": True,
+        "wsgi.run_once": False,
+    }
+    for k, v in headers:
+        name = k.upper().replace("-", "_")
+        if name == "CONTENT_TYPE":
+            env[name] = v
+        elif name != "CONTENT_LENGTH":
+            env[f"HTTP_{name}"] = v
+    return env
+
+def _worker_main(conn, slot: int, lanes: int, app_spec: str, peers: int = 1):
+    """Child process: serve forwarded requests with the normal WSGI app."""
+    # read at import time by modules that hold process-wide budgets
+    os.environ["DISPATCH_PEERS"] = str(peers)
+    app = _load_app(app_spec)
+    send_lock = threading.Lock()
+
+    def handle(req: Request):
+        rid, method, path, query, headers, body = req
+        try:
+            started: list = []
+            app_iter = app(_environ(method, path, query, headers, body),
+                           lambda status, hdrs, exc_info=None: started.extend((status, hdrs)))
+            try:
+                data = b"".join(app_iter)
+            finally:
+                if hasattr(app_iter, "close"):
+                    app_iter.close()
+            status, resp_headers = started
+            response = (rid, int(status.split()[0]), list(resp_headers), data)
+        except Exception as e:
+            log.exception("worker %d failed on %s: %s", slot, path, e)
+            response = (rid, 500, [("Content-Type", "text/plain")], b"worker error")
+        with send_lock:
+            conn.send(response)
+
+    def lane(q: queue.SimpleQueue):
+        while True:
+            handle(q.get())
+
+    queues = [queue.SimpleQueue() for _ in range(max(1, lanes))]
+    for i, q in enumerate(queues):
+        threading.Thread(target=lane, args=(q,), name=f"lane-{i}", daemon=True).start()
+
+    while True:
+        try:
+            key, req = conn.recv()
+        except (EOFError, OSError):
+            return
+        queues[_score(0, key) % len(queues)].put(req)
+
+class _Worker:
+    """Front-side handle on one worker process and its pipe."""
+
+    def __init__(self, slot: int, lanes: int, app_spec: str, peers: int = 1):
+        self.slot = slot
+        self.lanes = lanes
+        self.app_spec = app_spec
+        self.peers = peers
+        self.process: Optional[mp.Process] = None
+        self.conn = None
+        self.pending: Dict[int, Future] = {}
+        self.lock = threading.Lock()
+        self.restarts = -1
+
+    def start(self, ctx):
+        front, back = ctx.Pipe()
+        self.process = ctx.Process(target=_worker_main,
+                                   args=(back, self.slot, self.lanes, self.app_spec, self.peers),
+                                   name=f"bot-worker-{self.slot}", daemon=True)
+        self.process.start()
+        back.close()
+        with self.lock:
+            self.conn = front
+            self.pending = {}
+        self.restarts += 1
+        threading.Thread(target=self._read, args=(front, self.pending),
+                         name=f"reader-{self.slot}", daemon=True).start()
+
+    @property
+    def alive(self) -> bool:
+        return self.process is not None and self.process.is_alive()
+
+    def submit(self, key: str, req: Request) -> Future:
+        fut: Future = Future()
+        with self.lock:
+            self.pending[req[0]] = fut
+            self.conn.send((key, req))
+        return fut
+
+    def _read(self, conn, pending: Dict[int, Future]):
+        while True:
+            try:
+                rid, status, headers, body = conn.recv()
+            except (EOFError, OSError):
+                break
+            with self.lock:
+                fut = pending.pop(rid, None)
+            if fut is not None:
+                fut.set_result((status, headers, body))
+        # worker gone: fail whatever it still owed us
+        with self.lock:
+            owed = list(pending.values())
+            pending.clear()
+        for fut in owed:
+            fut.set_exception(ConnectionError(f"worker {self.slot} exited"))
+
+# ────────────────────────────── Front ─────────────────────────────
+class Dispatcher:
+    def __init__(self, workers: int = WORKERS, lanes: int = LANES, app_spec: str = APP):
+        self.ctx = mp.get_context("spawn")   # fresh interpreters: no inherited threads or sockets
+        workers = max(1, workers)
+        self.workers = [_Worker(i, lanes, app_spec, workers) for i in range(workers)]
+        self._ids = iter(range(1, sys.maxsize))
+        self._id_lock = threading.Lock()
+        self.forwarded = 0
+
+    def start(self):
+        for w in self.workers:
+            w.start(self.ctx)
+        threading.Thread(target=self._supervise, name="supervisor", daemon=True).start()
+        return self
+
+    def _supervise(self):
+        while True:
+            time.sleep(1.0)
+            for w in self.workers:
+                if not w.alive:
+                    log.warning("worker %d exited (code %s); restarting", w.slot,
+                                w.process.exitcode if w.process else None)
+                    w.start(self.ctx)
+
+    def live_slots(self) -> List[int]:
+        return [w.slot for w in self.workers if w.alive]
+
+    def _next_id(self) -> int:
+        with self._id_lock:
+            self.forwarded += 1
+            return next(self._ids)
+
+    def forward(self, method: str, path: str, query: str,
+                headers: List[Tuple[str, str]], body: bytes):
+        key, broadcast = route(path, body)
+        slots = self.live_slots()
+        slot = _pinned_slot(query, slots) if not body else None
+        if slot is None:
+            slot = owner(key, slots)
+        if slot is None:
+            return 503, [("Content-Type", "text/plain")], b"no workers"
+        if broadcast:
+            # the owner answers; the others only update their indexes
+            copy = headers + [(COPY_HEADER, "1")]
+            for other in slots:
+                if other != slot:
+                    try:
+                        self.workers[other].submit(key, (self._next_id(), method, path, query,
+                                                         copy, body))
+                    except Exception as e:
+                        log.warning("copy to worker %d failed: %s", other, e)
+        try:
+            return self.workers[slot].submit(key, (self._next_id(), method, path, query,
+                                                   headers, body)).result(timeout=TIMEOUT)
+        except Exception as e:
+            log.warning("forward to worker %d failed: %s", slot, e)
+            return 503, [("Content-Type", "text/plain")], b"worker unavailable"
+
+    def scrape(self, path: str, query: str, headers: List[Tuple[str, str]]):
+        """GET `path` from every live worker and merge the Prometheus text."""
+        pending = {}
+        for slot in self.live_slots():
+            try:
+                pending[slot] = self.workers[slot].submit(
+                    path, (self._next_id(), "GET", path, query, headers, b""))
+            except Exception as e:
+                log.warning("scrape of worker %d failed: %s", slot, e)
+        scrapes = {}
+        for slot, fut in pending.items():
+            try:
+                status, _, body = fut.result(timeout=TIMEOUT)
+            except Exception as e:
+                log.warning("scrape of worker %d failed: %s", slot, e)
+                continue
+            if status == 200:
+                scrapes[slot] = body.decode("utf-8", "replace")
+        if not scrapes:
+            return 503, [("Content-Type", "text/plain")], b"no workers"
+        return 200, [("Content-Type", "text/plain; version=0.0.4")], \
+            merge_metrics(scrapes).encode()
+
+    def stats(self) -> dict:
+        return {
+            "forwarded": self.forwarded,
+            "workers": [{"slot": w.slot, "alive": w.alive, "restarts": w.restarts,
+                         "in_flight": len(w.pending)} for w in self.workers],
+        }
+
+def make_front(dispatcher: Dispatcher, host: str, port: int) -> ThreadingHTTPServer:
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def _relay(self):
+            path, _, query = self.path.partition("?")
+            if path == "/dispatch/stats":
+                status, headers, body = 200, [("Content-Type", "application/json")], \
+                    jsonCodec.dumps(dispatcher.stats())
+            elif path == "/metrics" and self.command == "GET":
+                status, headers, body = dispatcher.scrape(path, query, list(self.headers.items()))
+            else:
+                length = int(self.headers.get("Content-Length") or 0)
+                body = self.rfile.read(length) if length else b""
+                status, headers, body = dispatcher.forward(
+                    self.command, path, query, list(self.headers.items()), body)
+            self.send_response(status)
+            for k, v in headers:
+                if k.lower() not in ("content-length", "connection", "transfer-encoding"):
+                    self.send_header(k, v)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        do_GET = do_POST = do_PUT = do_DELETE = _relay
+
+        def log_message(self, fmt, *args):
+            log.debug("front: " + fmt, *args)
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    return server
+
+def main(argv=None) -> int:
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument("--workers", type=int, default=WORKERS)
+    ap.add_argument("--lanes", type=int, default=LANES)
+    ap.add_argument("--app", default=APP, help="WSGI app to serve, module:attr")
+    ap.add_argument("--host", default="0.0.0.0")
+    ap.add_argument("--port", type=int, default=int(os.getenv("PORT", "5000")))
+    args = ap.parse_args(argv)
+
+    from logConfig import configure_logging
+    configure_logging()
+    dispatcher = Dispatcher(args.workers, args.lanes, args.app).start()
+    server = make_front(dispatcher, args.host, args.port)
+    log.info("dispatching on %s:%d to %d workers", args.host, args.port, args.workers)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,114 @@
+import os
+import logging
+import contextvars
+from dataclasses import dataclass, field
+from concurrent.futures import Future, ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import Any, Callable, Dict, Iterable, Optional, Sequence, Tuple
+
+import metrics
+
+log = logging.getLogger(__name__)
+
+FANOUT_WORKERS = int(os.getenv("FANOUT_WORKERS", "8"))
+FANOUT_TIMEOUT = float(os.getenv("FANOUT_TIMEOUT", "20"))
+
+# One shared pool per process so concurrent webhooks can't multiply threads.
+_executor = ThreadPoolExecutor(max_workers=FANOUT_WORKERS,
+                               thread_name_prefix="fanout")
+metrics.gauge("fanout_queue_depth", "Tasks waiting for a fan-out worker").set_function(
+    lambda: _executor._work_queue.qsize())
+
+
+@dataclass
+class FanOutResult:
+    """Per-recipient outcome of a fan-out call."""
+    ok: Dict[str, Any] = field(default_factory=dict)
+    failed: Dict[str, str] = field(default_factory=dict)
+
+    def __bool__(self) -> bool:
+        return not self.failed
+
+    def summary(self) -> dict:
+        return {"sent": len(self.ok), "failed": len(self.failed),
+                "errors": dict(self.failed)}
+
+
+def submit(fn: Callable[..., Any], *args) -> Future:
+    """Run fn(*args) on the shared pool in a copy of the caller's context.
+
+    Every task on the pool goes through here, so each one sees the caller's
+    context variables (trace spans, outbox turn) in its own copy.
+    """
+    return _executor.submit(contextvars.copy_context().run, fn, *args)
+
+
+def fan_out(fn: Callable[[str], Any], recipients: Iterable[str],
+            *, timeout: Optional[float] = FANOUT_TIMEOUT) -> FanOutResult:
+    """Call fn(recipient) for every recipient concurrently on the shared pool.
+
+    A failure (or timeout) for one recipient is recorded and never aborts
+    the others.
+    """
+    result = FanOutResult()
+    futures = {}
+    for r in dict.fromkeys(filter(None, recipients)):
+        futures[submit(fn, r)] = r
+
+    if not futures:
+        return result
+
+    done, pending = wait(futures, timeout=timeout)
+    for fut in done:
+        r = futures[fut]
+        try:
+            result.ok[r] = fut.result()
+        except Exception as exc:
+            log.warning("fan-out to %s failed: %s", r, exc)
+            result.failed[r] = str(exc) or exc.__class__.__name__
+    for fut in pending:
+        fut.cancel()
+        result.failed[futures[fut]] = "timeout"
+
+    return result
+
+
+def run_graph(steps: Dict[str, Tuple[Callable[[], Any], Sequence[str]]],
+              *, timeout: Optional[float] = FANOUT_TIMEOUT) -> FanOutResult:
+    """Run named steps on the shared pool, each as soon as its deps are done.
+
+    `steps` maps a name to (fn, deps). A step whose dependency failed is
+    skipped and reported as failed. Must not be called from a pool thread.
+    """
+    result = FanOutResult()
+    remaining = dict(steps)
+    running = {}
+
+    def submit_ready():
+        for name, (fn, deps) in list(remaining.items()):
+            if any(d in result.failed for d in deps):
+                result.failed[name] = "skipped: dependency failed"
+                del remaining[name]
+            elif all(d in result.ok for d in deps):
+                running[submit(fn)] = name
+                del remaining[name]
+
+    submit_ready()
+    while running:
+        done, _ = wait(running, timeout=timeout, return_when=FIRST_COMPLETED)
+        if not done:
+            for fut, name in running.items():
+                fut.cancel()
+                result.failed[name] = "timeout"
+            break
+        for fut in done:
+            name = running.pop(fut)
+            try:
+                result.ok[name] = fut.result()
+            except Exception as exc:
+                log.warning("step %s failed: %s", name, exc)
+                result.failed[name] = str(exc) or exc.__class__.__name__
+        submit_ready()
+
+    for name in remaining:
+        result.failed[name] = "skipped: unresolved dependency"
+    return result
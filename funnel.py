@@ -0,0 +1,276 @@
+"""Where patients drop off in the conversation, in fixed memory.
+
+    python -m funnel                     # last 24 h from FUNNEL_FILE
+    python -m funnel --hours 168 funnel.jsonl
+
+ChatBot.after_transition feeds every FSM transition in. Each window
+(FUNNEL_WINDOW_S, an hour by default) keeps transition counters, a
+HyperLogLog of the patients that reached each step, and Space-Saving
+top-k lists of the inputs extract_doc_type / extract_menu_option could
+not map. Nothing grows with traffic: a window is a few KB no matter how
+many patients pass through. When a window closes it is appended to
+FUNNEL_FILE as one JSON line; the sketches are stored with it, so the
+report can merge any range of windows (and the lines of several worker
+processes) into distinct-patient counts without double counting.
+"""
+from __future__ import annotations
+
+import os
+import re
+import sys
+import math
+import time
+import zlib
+import atexit
+import base64
+import hashlib
+import logging
+import argparse
+import threading
+
+from collections import Counter
+from datetime import datetime
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import jsonCodec
+import metrics
+
+log = logging.getLogger(__name__)
+
+# FUNNEL_FILE     - Closed windows are appended here as JSON lines; empty disables (default: funnel.jsonl)
+# FUNNEL_WINDOW_S - Window length in seconds (default: 3600)
+# FUNNEL_TOPK     - Unrecognized inputs tracked per field and window (default: 32)
+FUNNEL_FILE = os.getenv("FUNNEL_FILE", "funnel.jsonl")
+WINDOW_S = int(os.getenv("FUNNEL_WINDOW_S", "3600"))
+TOPK = int(os.getenv("FUNNEL_TOPK", "32"))
+
+STEPS = ("welcome", "docType", "docNum", "menu", "medState", "human")
+HLL_P = 11                 # 2048 one-byte registers per step, ~2.3% standard error
+TEXT_LIMIT = 40
+
+# ────────────────────────────── Sketches ─────────────────────────────
+class HyperLogLog:
+    """Distinct-count estimate in 2**p bytes."""
+
+    def __init__(self, p: int = HLL_P, registers: Optional[bytearray] = None):
+        self.p = p
+        self.m = 1 << p
+        self.registers = registers if registers is not None else bytearray(self.m)
+
+    def add(self, item: str):
+        h = int.from_bytes(hashlib.blake2b(item.encode(), digest_size=8).digest(), "big")
+        idx = h >> (64 - self.p)
+        rest = h & ((1 << (64 - self.p)) - 1)
+        rank = (64 - self.p) - rest.bit_length() + 1
+        if rank > self.registers[idx]:
+            self.registers[idx] = rank
+
+    def merge(self, other: "HyperLogLog"):
+        self.registers = bytearray(map(max, self.registers, other.registers))
+
+    def count(self) -> int:
+        m = self.m
+        estimate = (0.7213 / (1 + 1.079 / m)) * m * m / sum(2.0 ** -r for r in self.registers)
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * m and zeros:
+            estimate = m * math.log(m / zeros)     # linear counting for small sets
+        return int(round(estimate))
+
+    def dumps(self) -> str:
+        return base64.b64encode(zlib.compress(bytes(self.registers))).decode()
+
+    @classmethod
+    def loads(cls, raw: str, p: int = HLL_P) -> "HyperLogLog":
+        return cls(p, bytearray(zlib.decompress(base64.b64decode(raw))))
+
+class TopK:
+    """Space-Saving heavy hitters: at most k entries, counts overestimate by <= error."""
+
+    def __init__(self, k: int = TOPK):
+        self.k = k
+        self.items: Dict[str, List[int]] = {}      # item -> [count, error]
+
+    def offer(self, item: str, n: int = 1):
+        entry = self.items.get(item)
+        if entry is not None:
+            entry[0] += n
+        elif len(self.items) < self.k:
+            self.items[item] = [n, 0]
+        else:
+            victim = min(self.items, key=lambda i: self.items[i][0])
+            floor = self.items.pop(victim)[0]
+            self.items[item] = [floor + n, floor]
+
+    def top(self, n: Optional[int] = None) -> List[Tuple[str, int, int]]:
+        ranked = sorted(((i, c, e) for i, (c, e) in self.items.items()), key=lambda t: -t[1])
+        return ranked[:n] if n else ranked
+
+_DIGITS_RE = re.compile(r"\d+")
+
+def normalize_input(text: str) -> str:
+    """Group free text without keeping document numbers: digits become '#'."""
+    return _DIGITS_RE.sub("#", " ".join(text.lower().split()))[:TEXT_LIMIT]
+
+# ────────────────────────────── Windows ─────────────────────────────
+class Window:
+    def __init__(self, start: float, length: int = WINDOW_S):
+        self.start = start
+        self.end = start + length
+        self.entered: Counter = Counter()
+        self.transitions: Counter = Counter()
+        self.patients = {step: HyperLogLog() for step in STEPS}
+        self.unrecognized: Dict[str, TopK] = {}
+
+    @property
+    def empty(self) -> bool:
+        return not self.entered and not self.unrecognized
+
+    def to_json(self, partial: bool = False) -> dict:
+        return {
+            "start": datetime.fromtimestamp(self.start).isoformat(timespec="seconds"),
+            "end": datetime.fromtimestamp(min(self.end, time.time())).isoformat(timespec="seconds"),
+            "pid": os.getpid(),
+            "partial": partial,
+            "entered": dict(self.entered),
+            "patients": {s: h.count() for s, h in self.patients.items()},
+            "transitions": {f"{s}>{t}": n for (s, t), n in self.transitions.items()},
+            "unrecognized": {field: top.top() for field, top in self.unrecognized.items()},
+            "hll": {s: h.dumps() for s, h in self.patients.items() if any(h.registers)},
+        }
+
+class Funnel:
+    """Current window of transitions; closed windows go to `path`."""
+
+    def __init__(self, path: Optional[str] = FUNNEL_FILE, window_s: int = WINDOW_S):
+        self.path = path
+        self.window_s = window_s
+        self._lock = threading.Lock()
+        self._window = Window(self._window_start(time.time()), window_s)
+        metrics.gauge("funnel_patients", "Distinct patients reaching each step this window") \
+            .set_function(self.patients, label="step")
+
+    def _window_start(self, now: float) -> float:
+        return now - now % self.window_s
+
+    def _roll(self) -> Optional[Window]:
+        """Start a new window if the current one is over; returns the closed one. Lock held."""
+        now = time.time()
+        if now < self._window.end:
+            return None
+        closed, self._window = self._window, Window(self._window_start(now), self.window_s)
+        return closed
+
+    def transition(self, sender: str, source: str, target: str):
+        with self._lock:
+            closed = self._roll()
+            window = self._window
+            window.entered[target] += 1
+            window.transitions[(source, target)] += 1
+            if target in window.patients:
+                window.patients[target].add(sender)
+        if closed is not None:
+            self._write(closed)
+
+    def unrecognized(self, field: str, text: str):
+        item = normalize_input(text)
+        if not item:
+            return
+        with self._lock:
+            closed = self._roll()
+            top = self._window.unrecognized.get(field)
+            if top is None:
+                top = self._window.unrecognized[field] = TopK()
+            top.offer(item)
+        if closed is not None:
+            self._write(closed)
+
+    def patients(self) -> Dict[str, int]:
+        with self._lock:
+            return {s: h.count() for s, h in self._window.patients.items()}
+
+    def flush(self):
+        """Write the open window as a partial line, e.g. at shutdown."""
+        with self._lock:
+            window = self._window
+            if window.empty:
+                return
+            self._window = Window(window.start, self.window_s)
+        self._write(window, partial=True)
+
+    def _write(self, window: Window, partial: bool = False):
+        if not self.path or window.empty:
+            return
+        try:
+            line = jsonCodec.dumps(window.to_json(partial))
+            with open(self.path, "ab") as fh:
+                fh.write((line if isinstance(line, bytes) else line.encode()) + b"\n")
+        except Exception as e:
+            log.warning("Could not write funnel window: %s", e)
+
+funnel = Funnel()
+atexit.register(funnel.flush)
+
+def transition(sender: str, source: str, target: str):
+    funnel.transition(sender, source, target)
+
+def unrecognized(field: str, text: str):
+    funnel.unrecognized(field, text)
+
+# ────────────────────────────── Report ─────────────────────────────
+def read_windows(lines: Iterable[str], since: float = 0.0) -> Iterable[dict]:
+    for line in lines:
+        try:
+            window = jsonCodec.loads(line)
+        except jsonCodec.DecodeError:
+            continue
+        if datetime.fromisoformat(window["start"]).timestamp() >= since:
+            yield window
+
+def summarize(windows: Iterable[dict]) -> dict:
+    """Merge windows: distinct patients per step, transitions and unrecognized inputs."""
+    patients = {step: HyperLogLog() for step in STEPS}
+    transitions: Counter = Counter()
+    unrecognized: Dict[str, TopK] = {}
+    count = 0
+    for window in windows:
+        count += 1
+        for step, raw in window.get("hll", {}).items():
+            if step in patients:
+                patients[step].merge(HyperLogLog.loads(raw))
+        transitions.update(window.get("transitions", {}))
+        for field, items in window.get("unrecognized", {}).items():
+            top = unrecognized.setdefault(field, TopK())
+            for item, n, _ in items:
+                top.offer(item, n)
+    return {
+        "windows": count,
+        "patients": {s: h.count() for s, h in patients.items()},
+        "transitions": transitions,
+        "unrecognized": {field: top.top(10) for field, top in unrecognized.items()},
+    }
+
+def main(argv=None) -> int:
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument("file", nargs="?", default=FUNNEL_FILE or "funnel.jsonl")
+    ap.add_argument("--hours", type=float, default=24, help="how far back to look (0: everything)")
+    args = ap.parse_args(argv)
+
+    since = time.time() - args.hours * 3600 if args.hours else 0.0
+    with open(args.file, encoding="utf-8") as fh:
+        s = summarize(read_windows(fh, since))
+
+    print(f"{s['windows']} windows")
+    previous = None
+    for step in STEPS:
+        n = s["patients"][step]
+        kept = f"  ({n / previous:.0%} of previous step)" if previous else ""
+        print(f"{step:>9}: {n:6d} patients{kept}")
+        previous = n or None
+    for field, items in s["unrecognized"].items():
+        print(f"\nunrecognized {field}:")
+        for item, n, err in items:
+            print(f"  {n:5d}{f' (±{err})' if err else ''}  {item}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
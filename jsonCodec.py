@@ -0,0 +1,94 @@
+from __future__ import annotations
+
+import os
+import re
+import json
+
+from typing import Any, Iterable, List, Optional, Tuple
+
+# JSON_CODEC - "orjson" (default when installed) or "json" to force the stdlib
+_wanted = os.getenv("JSON_CODEC", "orjson")
+
+try:
+    if _wanted != "orjson":
+        raise ImportError
+    import orjson
+
+    BACKEND = "orjson"
+
+    def loads(raw: bytes | str) -> Any:
+        return orjson.loads(raw)
+
+    def dumps(obj: Any) -> bytes:
+        return orjson.dumps(obj)
+
+    DecodeError = orjson.JSONDecodeError
+
+except ImportError:
+    BACKEND = "json"
+
+    def loads(raw: bytes | str) -> Any:
+        return json.loads(raw)
+
+    def dumps(obj: Any) -> bytes:
+        return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode()
+
+    DecodeError = json.JSONDecodeError
+
+# ────────────────────────────── Pre-filters ─────────────────────────────
+# These look at raw bytes only. They may let an irrelevant payload through
+# (the handler still checks after decoding) but must never drop a relevant one.
+_EVENT_RE = re.compile(rb'"event"\s*:\s*"([a-z_]+)"')
+_MSG_TYPE_RE = re.compile(rb'"message_type"\s*:\s*"([a-z_]+)"')
+
+def peek_event(raw: bytes) -> Optional[str]:
+    m = _EVENT_RE.search(raw)
+    return m.group(1).decode() if m else None
+
+def chatwoot_reject_reason(raw: bytes, wanted_events: Iterable[str]) -> Optional[str]:
+    """Why a Chatwoot webhook body can be ignored without decoding, if it can."""
+    event = peek_event(raw)
+    if event is None:
+        return None
+    if event not in wanted_events:
+        return f"not handled, got {event}"
+    if event == "message_created":
+        # The root message carries message_type as a string; nested
+        # conversation messages use integers and never match here.
+        types = {m.decode() for m in _MSG_TYPE_RE.findall(raw)}
+        if types and "incoming" not in types:
+            return f"not incoming, type: {', '.join(sorted(types))}"
+    return None
+
+# The "messages" array itself; "field": "messages" appears in every webhook
+_MESSAGES_RE = re.compile(rb'"messages"\s*:\s*\[')
+
+# Meta writes each status object as {"id":..., "status":..., "timestamp":..., "recipient_id":...}
+_STATUS_RE = re.compile(rb'\{"id"\s*:\s*"([^"]+)"\s*,\s*"status"\s*:\s*"([a-z]+)"'
+                        rb'\s*,\s*"timestamp"\s*:\s*"(\d+)"')
+
+def peek_statuses(raw: bytes) -> Optional[List[Tuple[str, str, int]]]:
+    """(message id, status, timestamp) of a status-only WhatsApp webhook.
+
+    None when the body carries messages or no statuses. The events are
+    read off the raw bytes; only if the objects aren't laid out as Meta
+    usually sends them is the body decoded.
+    """
+    if b'"statuses"' not in raw or _MESSAGES_RE.search(raw):
+        return None
+    events = [(m[0].decode(), m[1].decode(), int(m[2])) for m in _STATUS_RE.findall(raw)]
+    if len(events) == raw.count(b'"recipient_id"'):
+        return events
+    try:
+        payload = loads(raw)
+        return [(s["id"], s["status"], int(s.get("timestamp") or 0))
+                for entry in payload["entry"] for change in entry["changes"]
+                for s in change["value"].get("statuses", [])]
+    except (DecodeError, KeyError, TypeError, ValueError):
+        return []
+
+def whatsapp_reject_reason(raw: bytes) -> Optional[str]:
+    """Why a WhatsApp webhook body can be acknowledged without decoding."""
+    if not _MESSAGES_RE.search(raw):
+        return "no messages"
+    return None
@@ -0,0 +1,173 @@
+from __future__ import annotations
+
+import os
+import re
+import sys
+import copy
+import json
+import queue
+import random
+import atexit
+import logging
+import logging.handlers
+
+from datetime import datetime, timezone
+from typing import Any, Dict, Optional
+
+# LOG_LEVEL  - Root log level (default: INFO)
+# LOG_FORMAT - "json" (default) or "text"
+# LOG_SAMPLE - Per-event sampling rates, e.g. "cw.message=0.1,wa.status=0.01"
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json")
+
+def _parse_rates(raw: str) -> Dict[str, float]:
+    rates = {}
+    for part in filter(None, raw.split(",")):
+        name, _, rate = part.partition("=")
+        try:
+            rates[name.strip()] = float(rate)
+        except ValueError:
+            pass
+    return rates
+
+SAMPLE_RATES = _parse_rates(os.getenv("LOG_SAMPLE", ""))
+
+# ────────────────────────────── Redaction ─────────────────────────────
+# Only phone and document numbers are masked in free text, so dates,
+# amounts, timestamps and ids stay readable:
+# - phones: Colombian mobiles (optionally with 57/+57) and +international numbers;
+# - document numbers: digits right after a document label ("CC 1234",
+#   "doc_num=1234", "NUMERO_DOCUMENTO": "1234"), whatever their length.
+# Structured fields are redacted by key instead. Numbers of 6+ digits keep
+# their last two digits for correlation.
+_PHONE_RE = re.compile(r"(?<![\w.:/-])(?:\+?57[ -]?)?3\d{2}[ -]?\d{3}[ -]?\d{4}(?![\w.:/-])"
+                       r"|(?<![\w.])\+\d{8,15}\b")
+_DOC_RE = re.compile(r"(?i)\b(\w*(?:doc|c[eé]dula|identificaci[oó]n|n[uú]mero|nro)\w*"
+                     r"|cc|ti|ce|rc|pt|sc|as)(\W{0,4})(\d[\d.]*\d|\d)\b")
+_NUMBER_RE = re.compile(r"\d[\d .\-]*\d|\d")
+_PII_KEYS = {
+    "doc_num", "documento", "document", "doc_id", "phone", "phone_number",
+    "sender", "to", "from", "contact_id", "wa_id", "recipient_id", "source_id",
+    "name", "first_name", "customer_name",
+    "primer_nombre", "segundo_nombre", "primer_apellido", "segundo_apellido",
+}
+
+def _mask(number: str) -> str:
+    digits = re.sub(r"\D", "", number)
+    if len(digits) < 6:
+        return "*" * len(digits)
+    return "*" * (len(digits) - 2) + digits[-2:]
+
+def redact(text: str) -> str:
+    """Mask document numbers and phone numbers inside free text."""
+    text = _PHONE_RE.sub(lambda m: _mask(m.group(0)), text)
+    return _DOC_RE.sub(lambda m: m.group(1) + m.group(2) + _mask(m.group(3)), text)
+
+def redact_value(key: str, value: Any) -> Any:
+    if value is None:
+        return None
+    if key.lower() in _PII_KEYS:
+        if key.lower().endswith("name") or "nombre" in key.lower() or "apellido" in key.lower():
+            return "[redacted]"
+        return _NUMBER_RE.sub(lambda m: _mask(m.group(0)), str(value))
+    if isinstance(value, str):
+        return redact(value)
+    if isinstance(value, dict):
+        return {k: redact_value(k, v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [redact_value(key, v) for v in value]
+    return value
+
+# ────────────────────────────── Filters / Formatters ─────────────────────────────
+class SamplingFilter(logging.Filter):
+    """Drops a fraction of records per `event`, as configured in LOG_SAMPLE.
+
+    Warnings and errors are never sampled out.
+    """
+
+    def __init__(self, rates: Optional[Dict[str, float]] = None):
+        super().__init__()
+        self.rates = SAMPLE_RATES if rates is None else rates
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING or not self.rates:
+            return True
+        rate = self.rates.get(getattr(record, "event", ""), 1.0)
+        return rate >= 1.0 or random.random() < rate
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line, with PII redacted from message and fields."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        out = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": redact(record.getMessage()),
+        }
+        event = getattr(record, "event", None)
+        if event:
+            out["event"] = event
+        fields = getattr(record, "fields", None)
+        if fields:
+            out.update({k: redact_value(k, v) for k, v in fields.items()})
+        exc = self.formatException(record.exc_info) if record.exc_info else record.exc_text
+        if exc:
+            out["exc"] = redact(exc)
+        return json.dumps(out, ensure_ascii=False, default=str)
+
+class RedactingTextFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        return redact(super().format(record))
+
+class _DeferredQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that leaves formatting and redaction to the listener thread.
+
+    Only the %-interpolation happens here, so arguments the caller mutates
+    after logging can't change the message.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        fields = getattr(record, "fields", None)
+        if fields:
+            record.fields = dict(fields)
+        return record
+
+# ────────────────────────────── Setup ─────────────────────────────
+_listener: Optional[logging.handlers.QueueListener] = None
+
+def configure_logging(level: str = LOG_LEVEL, fmt: str = LOG_FORMAT) -> None:
+    """Route all logging through a non-blocking queue to a redacting stdout handler.
+
+    Safe to call more than once; only the first call installs handlers.
+    """
+    global _listener
+    if _listener is not None:
+        return
+
+    stream = logging.StreamHandler(sys.stdout)
+    stream.setFormatter(JsonFormatter() if fmt == "json" else
+                        RedactingTextFormatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+
+    q: queue.SimpleQueue = queue.SimpleQueue()
+    handler = _DeferredQueueHandler(q)
+    handler.addFilter(SamplingFilter())
+
+    root = logging.getLogger()
+    root.handlers[:] = [handler]
+    root.setLevel(level)
+
+    _listener = logging.handlers.QueueListener(q, stream, respect_handler_level=True)
+    _listener.start()
+    atexit.register(_listener.stop)
+
+def log_event(logger: logging.Logger, level: int, event: str, msg: str, *args, **fields) -> None:
+    """Log a structured event; nothing is built when the level is disabled."""
+    if logger.isEnabledFor(level):
+        logger.log(level, msg, *args, extra={"event": event, "fields": fields})
@@ -0,0 +1,251 @@
+from __future__ import annotations
+
+import os
+import time
+import uuid
+import base64
+import hashlib
+import logging
+import mimetypes
+import threading
+import contextvars
+
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Callable, Optional
+
+import metrics
+import whatsappAPI as wa
+from transports import pooled_session
+
+log = logging.getLogger(__name__)
+
+# MEDIA_DIR       - Where inbound images and documents are stored (default: media)
+# MEDIA_MAX_MB    - Largest file accepted (default: 16)
+# MEDIA_WORKERS   - Downloads running at once, off the webhook threads (default: 2)
+# MEDIA_QUEUE     - Downloads allowed to wait for a worker before new ones are refused (default: 16)
+# MEDIA_DEADLINE  - Seconds a whole download may take, however steadily it trickles (default: 120)
+# MEDIA_RETENTION_DAYS - Stored files (patients' health documents) are deleted after this (default: 30)
+# MEDIA_DISK_MB   - Cap on MEDIA_DIR; past it the oldest files are deleted first (default: 2048)
+MEDIA_DIR = os.getenv("MEDIA_DIR", "media")
+MAX_BYTES = int(float(os.getenv("MEDIA_MAX_MB", "16")) * 1024 * 1024)
+WORKERS = int(os.getenv("MEDIA_WORKERS", "2"))
+QUEUE_LIMIT = int(os.getenv("MEDIA_QUEUE", "16"))
+DEADLINE = float(os.getenv("MEDIA_DEADLINE", "120"))
+RETENTION_SECONDS = float(os.getenv("MEDIA_RETENTION_DAYS", "30")) * 86400
+DISK_CAP_BYTES = int(float(os.getenv("MEDIA_DISK_MB", "2048")) * 1024 * 1024)
+CHUNK_BYTES = 64 * 1024
+TIMEOUT = 30                # per connect/read; DEADLINE bounds the whole download
+SWEEP_EVERY = 600.0
+PART_MAX_AGE = 3600.0       # leftovers of a crashed download
+
+DOWNLOADS = metrics.counter("media_downloads_total", "Inbound media downloads by result")
+DOWNLOAD_BYTES = metrics.counter("media_download_bytes_total", "Bytes of inbound media stored")
+PURGED = metrics.counter("media_files_purged_total", "Stored media files deleted, by reason")
+
+class MediaRejected(Exception):
+    """The file can't be taken; `reply` tells the patient why."""
+
+    def __init__(self, reason: str, reply: str):
+        super().__init__(reason)
+        self.reason = reason
+        self.reply = reply
+
+TOO_LARGE_REPLY = (f"El archivo supera el tamaño máximo de {MAX_BYTES // (1024 * 1024)} MB. "
+                   "Envia una foto o un PDF mas liviano, por favor.")
+BUSY_REPLY = ("En este momento no podemos recibir archivos. "
+              "Intentalo de nuevo en unos minutos, por favor.")
+FAILED_REPLY = "No pudimos recibir tu archivo. Intentalo de nuevo, por favor."
+
+@dataclass
+class MediaRef:
+    """An image/document message as it arrives in the webhook."""
+    media_id: str
+    kind: str
+    mime_type: str = ""
+    filename: str = ""
+    caption: str = ""
+    sha256: str = ""
+
+@dataclass
+class MediaFile:
+    """A stored inbound file."""
+    media_id: str
+    kind: str
+    mime_type: str
+    path: str
+    size: int
+    sha256: str
+    filename: str = ""
+    caption: str = ""
+
+    @property
+    def label(self) -> str:
+        name = self.filename or os.path.basename(self.path)
+        return f"{name} ({self.size // 1024} KB, sha256 {self.sha256[:12]})"
+
+def parse_media(payload: dict) -> MediaRef:
+    """The media part of a webhook that parse_incoming labelled "media"."""
+    msg = payload["entry"][0]["changes"][0]["value"]["messages"][0]
+    kind = msg["type"]
+    body = msg[kind]
+    return MediaRef(media_id=body["id"], kind=kind, mime_type=body.get("mime_type", ""),
+                    filename=body.get("filename", ""), caption=body.get("caption", ""),
+                    sha256=body.get("sha256", ""))
+
+def _digest_matches(expected: str, digest) -> bool:
+    # Graph has reported the hash both hex- and base64-encoded
+    return expected in (digest.hexdigest(), base64.b64encode(digest.digest()).decode())
+
+# ────────────────────────────── Download ─────────────────────────────
+_session = pooled_session(WORKERS)
+
+def download(ref: MediaRef, phone_id: Optional[str] = None) -> MediaFile:
+    """Stream one media file to MEDIA_DIR, hashing it on the way.
+
+    The body is read in CHUNK_BYTES pieces and never held in memory; a
+    download that passes MAX_BYTES is aborted and its partial file
+    removed, and so is one still running after DEADLINE seconds. Files
+    are stored under their sha256, so a patient resending the same photo
+    doesn't take extra space.
+    """
+    info = wa.media_info(ref.media_id, session=_session, phone_id=phone_id)
+    declared = int(info.get("file_size") or 0)
+    if declared > MAX_BYTES:
+        raise MediaRejected("too_large", TOO_LARGE_REPLY)
+    mime_type = info.get("mime_type") or ref.mime_type
+
+    os.makedirs(MEDIA_DIR, exist_ok=True)
+    part = os.path.join(MEDIA_DIR, f".{uuid.uuid4().hex}.part")
+    digest = hashlib.sha256()
+    size = 0
+    deadline = time.monotonic() + DEADLINE
+    try:
+        with _session.get(info["url"], headers={"Authorization": wa.HEADERS["Authorization"]},
+                          stream=True, timeout=TIMEOUT) as resp:
+            resp.raise_for_status()
+            with open(part, "wb") as fh:
+                for chunk in resp.iter_content(CHUNK_BYTES):
+                    size += len(chunk)
+                    if size > MAX_BYTES:
+                        raise MediaRejected("too_large", TOO_LARGE_REPLY)
+                    if time.monotonic() > deadline:
+                        raise TimeoutError(f"media {ref.media_id} not downloaded in {DEADLINE:g}s")
+                    digest.update(chunk)
+                    fh.write(chunk)
+        expected = info.get("sha256") or ref.sha256
+        if expected and not _digest_matches(expected, digest):
+            raise RuntimeError(f"sha256 mismatch for media {ref.media_id}")
+        sha256 = digest.hexdigest()
+        ext = mimetypes.guess_extension(mime_type.split(";")[0].strip()) or ""
+        path = os.path.join(MEDIA_DIR, f"{sha256}{ext}")
+        os.replace(part, path)
+    except BaseException:
+        if os.path.exists(part):
+            os.remove(part)
+        raise
+    DOWNLOAD_BYTES.inc(size)
+    return MediaFile(ref.media_id, ref.kind, mime_type, path, size, sha256,
+                     ref.filename, ref.caption)
+
+# ────────────────────────────── Retention ─────────────────────────────
+def sweep(directory: str = MEDIA_DIR, retention: float = RETENTION_SECONDS,
+          cap_bytes: int = DISK_CAP_BYTES) -> int:
+    """Delete files past `retention`, then the oldest until the directory fits `cap_bytes`.
+
+    Returns the number of files deleted. Safe to run from several workers
+    sharing the directory.
+    """
+    now = time.time()
+    files = []
+    try:
+        entries = list(os.scandir(directory))
+    except FileNotFoundError:
+        return 0
+    for entry in entries:
+        try:
+            st = entry.stat()
+        except FileNotFoundError:
+            continue
+        if entry.is_file():
+            files.append((st.st_mtime, st.st_size, entry.path, entry.name.endswith(".part")))
+
+    removed = 0
+    total = 0
+    keep = []
+    for mtime, size, path, partial in files:
+        if now - mtime > (PART_MAX_AGE if partial else retention):
+            removed += _remove(path, "partial" if partial else "expired")
+        else:
+            keep.append((mtime, size, path, partial))
+            total += size
+    for mtime, size, path, partial in sorted(keep):
+        if total <= cap_bytes:
+            break
+        if not partial:     # a download in progress is bounded by MAX_BYTES already
+            removed += _remove(path, "disk_cap")
+            total -= size
+    return removed
+
+def _remove(path: str, reason: str) -> int:
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        return 0
+    PURGED.inc(reason=reason)
+    return 1
+
+# ────────────────────────────── Ingest queue ─────────────────────────────
+class MediaIngest:
+    """Runs downloads on a few dedicated threads so big uploads can't tie up
+    the webhook workers; past `queue_limit` waiting downloads, new ones are
+    refused instead of queued. Every SWEEP_EVERY seconds a media thread
+    also runs the retention sweep after its download."""
+
+    def __init__(self, workers: int = WORKERS, queue_limit: int = QUEUE_LIMIT):
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="media")
+        self._slots = threading.BoundedSemaphore(workers + queue_limit)
+        self._swept_at = 0.0
+        self._sweep_lock = threading.Lock()
+        metrics.gauge("media_downloads_queued", "Media downloads running or waiting").set_function(
+            lambda: workers + queue_limit - self._slots._value)
+
+    def submit(self, ref: MediaRef, on_done: Callable[[Optional[MediaFile], Optional[Exception]], None],
+               phone_id: Optional[str] = None) -> bool:
+        """Start downloading `ref`; on_done(file, error) runs on a media thread."""
+        if not self._slots.acquire(blocking=False):
+            DOWNLOADS.inc(result="refused")
+            return False
+
+        def run():
+            try:
+                stored = download(ref, phone_id)
+            except Exception as exc:
+                DOWNLOADS.inc(result=exc.reason if isinstance(exc, MediaRejected) else "error")
+                log.warning("Media %s download failed: %s", ref.media_id, exc)
+                on_done(None, exc)
+            else:
+                DOWNLOADS.inc(result="stored")
+                on_done(stored, None)
+            finally:
+                self._slots.release()
+                self._maybe_sweep()
+
+        self._pool.submit(contextvars.copy_context().run, run)
+        return True
+
+    def _maybe_sweep(self):
+        now = time.monotonic()
+        if now - self._swept_at < SWEEP_EVERY or not self._sweep_lock.acquire(blocking=False):
+            return
+        try:
+            self._swept_at = now
+            removed = sweep()
+            if removed:
+                log.info("Media retention sweep removed %d files", removed)
+        except Exception as e:
+            log.warning("Media retention sweep failed: %s", e)
+        finally:
+            self._sweep_lock.release()
+
+ingest = MediaIngest()
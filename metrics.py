@@ -0,0 +1,270 @@
+from __future__ import annotations
+
+import time
+import bisect
+import weakref
+import logging
+import threading
+import functools
+
+from abc import ABC, abstractmethod
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+log = logging.getLogger(__name__)
+
+# Instruments write to a per-thread shard, so the hot path never waits on a
+# lock; the scrape (rare) walks and sums all shards. The only lock taken on
+# the hot path is the one-time registration of a thread's first shard.
+# Shards of threads that have exited are folded into a base shard (at
+# scrape time, and when registrations pile up), so thread-per-request
+# servers don't grow the shard list without bound.
+
+LabelKey = Tuple[Tuple[str, str], ...]
+
+def _key(labels: Dict[str, object]) -> LabelKey:
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+def _escape(v: str) -> str:
+    return v.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _fmt_labels(key: LabelKey, extra: Iterable[Tuple[str, str]] = ()) -> str:
+    pairs = list(key) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in pairs) + "}"
+
+class _Sharded(ABC):
+    def __init__(self, name: str, help_text: str):
+        self.name = name
+        self.help = help_text
+        self._local = threading.local()
+        self._base: dict = {}     # totals of threads that have exited
+        self._shards: List[Tuple[Callable[[], Optional[threading.Thread]], dict]] = []
+        self._sweep_at = 64
+        self._lock = threading.Lock()
+
+    def _shard(self) -> dict:
+        shard = getattr(self._local, "shard", None)
+        if shard is None:
+            shard = {}
+            owner = weakref.ref(threading.current_thread())
+            with self._lock:
+                self._shards.append((owner, shard))
+                if len(self._shards) >= self._sweep_at:
+                    self._sweep()
+            self._local.shard = shard
+        return shard
+
+    def _sweep(self):
+        """Fold shards of dead threads into the base shard. Lock held."""
+        live = []
+        for owner, shard in self._shards:
+            thread = owner()
+            if thread is not None and thread.is_alive():
+                live.append((owner, shard))
+            else:
+                self._fold(shard)
+        self._shards = live
+        self._sweep_at = max(64, 2 * len(live))
+
+    @abstractmethod
+    def _fold(self, shard: dict):
+        """Add a dead thread's shard into `_base`. Lock held."""
+
+    def _all_shards(self) -> List[dict]:
+        with self._lock:
+            self._sweep()
+            return [self._base] + [shard for _, shard in self._shards]
+
+class Counter(_Sharded):
+    kind = "counter"
+
+    def inc(self, amount: float = 1.0, **labels):
+        shard = self._shard()
+        key = _key(labels)
+        shard[key] = shard.get(key, 0.0) + amount
+
+    def _fold(self, shard: dict):
+        for key, v in shard.items():
+            self._base[key] = self._base.get(key, 0.0) + v
+
+    def values(self) -> Dict[LabelKey, float]:
+        out: Dict[LabelKey, float] = {}
+        for shard in self._all_shards():
+            for key, v in list(shard.items()):
+                out[key] = out.get(key, 0.0) + v
+        return out
+
+    def render(self) -> List[str]:
+        return [f"{self.name}{_fmt_labels(k)} {v:g}" for k, v in sorted(self.values().items())]
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 40.0)
+
+class Histogram(_Sharded):
+    kind = "histogram"
+
+    def __init__(self, name: str, help_text: str, buckets: Iterable[float] = DEFAULT_BUCKETS):
+        super().__init__(name, help_text)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels):
+        shard = self._shard()
+        key = _key(labels)
+        row = shard.get(key)
+        if row is None:
+            # per-bucket counts (last slot is +Inf), then sum
+            row = shard[key] = [0] * (len(self.buckets) + 1) + [0.0]
+        row[bisect.bisect_left(self.buckets, value)] += 1
+        row[-1] += value
+
+    def time(self, **labels):
+        return _Timer(self, labels)
+
+    def _fold(self, shard: dict):
+        for key, row in shard.items():
+            acc = self._base.get(key)
+            if acc is None:
+                self._base[key] = list(row)
+            else:
+                for i, v in enumerate(row):
+                    acc[i] += v
+
+    def render(self) -> List[str]:
+        merged: Dict[LabelKey, list] = {}
+        for shard in self._all_shards():
+            for key, row in list(shard.items()):
+                acc = merged.setdefault(key, [0] * len(row[:-1]) + [0.0])
+                for i, v in enumerate(row):
+                    acc[i] += v
+        lines = []
+        for key, row in sorted(merged.items()):
+            cumulative = 0
+            for bound, n in zip(self.buckets, row):
+                cumulative += n
+                lines.append(f"{self.name}_bucket{_fmt_labels(key, [('le', f'{bound:g}')])} {cumulative}")
+            cumulative += row[len(self.buckets)]
+            lines.append(f"{self.name}_bucket{_fmt_labels(key, [('le', '+Inf')])} {cumulative}")
+            lines.append(f"{self.name}_sum{_fmt_labels(key)} {row[-1]:g}")
+            lines.append(f"{self.name}_count{_fmt_labels(key)} {cumulative}")
+        return lines
+
+class _Timer:
+    __slots__ = ("hist", "labels", "start")
+
+    def __init__(self, hist: Histogram, labels: dict):
+        self.hist = hist
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.hist.observe(time.perf_counter() - self.start, **self.labels)
+        return False
+
+class Gauge:
+    """Gauge read at scrape time from registered callbacks."""
+    kind = "gauge"
+
+    def __init__(self, name: str, help_text: str):
+        self.name = name
+        self.help = help_text
+        self._callbacks: List[Callable[[], Dict[LabelKey, float]]] = []
+
+    def set_function(self, fn: Callable[[], object], label: Optional[str] = None, **labels):
+        """Register a callback returning a number, or {value of `label`: number}."""
+        fixed = _key(labels)
+
+        def wrapped() -> Dict[LabelKey, float]:
+            v = fn()
+            if label is None:
+                return {fixed: v}
+            return {tuple(sorted(fixed + ((label, str(k)),))): n for k, n in v.items()}
+
+        self._callbacks.append(wrapped)
+
+    def render(self) -> List[str]:
+        lines = []
+        for cb in self._callbacks:
+            try:
+                values = cb()
+            except Exception as e:
+                log.debug("gauge %s callback failed: %s", self.name, e)
+                continue
+            for key, v in sorted(values.items()):
+                if v is not None:
+                    lines.append(f"{self.name}{_fmt_labels(key)} {float(v):g}")
+        return lines
+
+# ────────────────────────────── Registry ─────────────────────────────
+_registry: Dict[str, object] = {}
+_registry_lock = threading.Lock()
+
+def _register(cls, name: str, help_text: str, **kwargs):
+    with _registry_lock:
+        inst = _registry.get(name)
+        if inst is None:
+            inst = _registry[name] = cls(name, help_text, **kwargs)
+        return inst
+
+def counter(name: str, help_text: str = "") -> Counter:
+    return _register(Counter, name, help_text)
+
+def histogram(name: str, help_text: str = "", buckets: Iterable[float] = DEFAULT_BUCKETS) -> Histogram:
+    return _register(Histogram, name, help_text, buckets=buckets)
+
+def gauge(name: str, help_text: str = "") -> Gauge:
+    return _register(Gauge, name, help_text)
+
+def render() -> str:
+    """Everything registered, in Prometheus text exposition format."""
+    out = []
+    with _registry_lock:
+        instruments = list(_registry.values())
+    for inst in instruments:
+        lines = inst.render()
+        if not lines:
+            continue
+        if inst.help:
+            out.append(f"# HELP {inst.name} {inst.help}")
+        out.append(f"# TYPE {inst.name} {inst.kind}")
+        out.extend(lines)
+    return "\n".join(out) + "\n"
+
+# ────────────────────────────── Shared instruments ─────────────────────────────
+UPSTREAM_SECONDS = histogram("upstream_request_seconds", "Latency of calls to upstream services")
+UPSTREAM_ERRORS = counter("upstream_errors_total", "Upstream calls that raised")
+WEBHOOK_SECONDS = histogram("webhook_seconds", "Webhook handler latency")
+FSM_TRANSITIONS = counter("fsm_transitions_total", "ChatBot state transitions")
+FSM_REPROMPTS = counter("fsm_reprompts_total", "Invalid-input re-prompts by state")
+CACHE_REQUESTS = counter("cache_requests_total", "Cache lookups by cache and result")
+
+def timed(hist: Histogram, **labels):
+    """Decorator: observe the wall time of every call into `hist`."""
+    def deco(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                hist.observe(time.perf_counter() - start, **labels)
+        return wrapper
+    return deco
+
+def timed_upstream(call: str):
+    """Decorator: record latency (and raised errors) of an upstream call."""
+    def deco(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            except Exception:
+                UPSTREAM_ERRORS.inc(call=call)
+                raise
+            finally:
+                UPSTREAM_SECONDS.observe(time.perf_counter() - start, call=call)
+        return wrapper
+    return deco
@@ -0,0 +1,296 @@
+from __future__ import annotations
+
+import os
+import time
+import uuid
+import socket
+import itertools
+import sqlite3
+import logging
+import threading
+import contextvars
+
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import jsonCodec
+import metrics
+
+log = logging.getLogger(__name__)
+
+# OUTBOX_PATH          - SQLite file for durable outbound messages; unset sends directly
+# OUTBOX_SYNC          - SQLite synchronous level: NORMAL survives a process crash, FULL
+#                        also a power cut (default: NORMAL)
+# OUTBOX_COMMIT_MS     - How long the writer waits to gather a group commit (default: 1)
+# OUTBOX_DRAIN_WORKERS - Recipients delivered in parallel (default: 8)
+# OUTBOX_MAX_ATTEMPTS  - Attempts before a message is parked as dead (default: 8)
+# OUTBOX_RETENTION_S   - How long sent rows are kept for de-duplication (default: 3600)
+OUTBOX_PATH = os.getenv("OUTBOX_PATH")
+OUTBOX_SYNC = os.getenv("OUTBOX_SYNC", "NORMAL").upper()
+COMMIT_WINDOW = float(os.getenv("OUTBOX_COMMIT_MS", "1")) / 1000
+DRAIN_WORKERS = int(os.getenv("OUTBOX_DRAIN_WORKERS", "8"))
+MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "8"))
+RETENTION_SECONDS = float(os.getenv("OUTBOX_RETENTION_S", "3600"))
+LEASE_SECONDS = 15.0      # minimum; raised to twice the longest send timeout registered
+
+DELIVERIES = metrics.counter("outbox_deliveries_total", "Outbox delivery attempts by channel and result")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS outbox (
+    id        INTEGER PRIMARY KEY AUTOINCREMENT,
+    idem_key  TEXT NOT NULL UNIQUE,
+    channel   TEXT NOT NULL,
+    recipient TEXT NOT NULL,
+    call      TEXT NOT NULL,
+    args      BLOB NOT NULL,
+    created   REAL NOT NULL,
+    state     TEXT NOT NULL DEFAULT 'pending',
+    attempts  INTEGER NOT NULL DEFAULT 0,
+    next_at   REAL NOT NULL DEFAULT 0,
+    last_error TEXT
+);
+CREATE INDEX IF NOT EXISTS outbox_pending ON outbox (state, channel, recipient, id);
+CREATE TABLE IF NOT EXISTS drain_lease (
+    id    INTEGER PRIMARY KEY CHECK (id = 1),
+    owner TEXT NOT NULL,
+    until REAL NOT NULL
+);
+"""
+
+# ────────────────────────────── Idempotency keys ─────────────────────────────
+# A webhook turn is keyed by the inbound message id, and each send in the turn
+# by its position, so a webhook Meta/Chatwoot redelivers enqueues nothing new.
+# The counter is shared by every context copied from the turn (fan-out
+# threads), and next() on itertools.count is atomic, so no two sends of a
+# turn get the same key - which INSERT OR IGNORE would silently drop.
+_turn: contextvars.ContextVar[Optional[Tuple[str, Any]]] = \
+    contextvars.ContextVar("outbox_turn", default=None)
+
+def begin_turn(message_id: Optional[str]):
+    """Key the sends of the current webhook turn off the inbound message id."""
+    _turn.set((str(message_id), itertools.count(1)) if message_id else None)
+
+def _next_key() -> str:
+    turn = _turn.get()
+    if turn is None:
+        return uuid.uuid4().hex
+    message_id, seq = turn
+    return f"{message_id}#{next(seq)}"
+
+# ────────────────────────────── Outbox ─────────────────────────────
+class _Pending:
+    __slots__ = ("row", "done", "error")
+
+    def __init__(self, row: tuple):
+        self.row = row
+        self.done = threading.Event()
+        self.error: Optional[Exception] = None
+
+class Outbox:
+    """Durable, ordered outbound queue in a SQLite WAL file.
+
+    put() hands a row to a writer thread that commits everything queued
+    in the same COMMIT_WINDOW as one transaction (group commit) and only
+    then releases the callers, so a reply is on disk before the webhook
+    answers. A drainer - one per file, across processes, via a lease row -
+    delivers the oldest pending message of every recipient in parallel,
+    retries with backoff and parks messages as dead after MAX_ATTEMPTS.
+    Delivery is at-least-once: a crash between the upstream accepting a
+    message and the row being marked sent resends that one message.
+    """
+
+    def __init__(self, path: str, *, sync: str = OUTBOX_SYNC, commit_window: float = COMMIT_WINDOW,
+                 drain_workers: int = DRAIN_WORKERS, max_attempts: int = MAX_ATTEMPTS):
+        self.path = path
+        self.sync = sync
+        self.commit_window = commit_window
+        self.max_attempts = max_attempts
+        self.lease_seconds = LEASE_SECONDS
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{id(self):x}"
+        self._handlers: Dict[str, Callable[[str, list, str], Any]] = {}
+        self._queue: List[_Pending] = []
+        self._cond = threading.Condition()
+        self._wake = threading.Event()
+        self._pool = ThreadPoolExecutor(max_workers=drain_workers, thread_name_prefix="outbox")
+        self._local = threading.local()
+        self._threads: List[threading.Thread] = []
+        self._started_lock = threading.Lock()
+        metrics.gauge("outbox_pending", "Outbox messages not yet delivered") \
+            .set_function(self.pending_count)
+
+    def _db(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(f"PRAGMA synchronous={self.sync}")
+            conn.executescript(_SCHEMA)
+            self._local.conn = conn
+        return conn
+
+    def register(self, channel: str, deliver: Callable[[str, list, str], Any], timeout: float = 0.0):
+        """deliver(call, args, idem_key) sends one message; raising means retry.
+
+        `timeout` is the longest one delivery can take. The drain lease is
+        kept at twice that, so it can't lapse while a round is in flight
+        and let a second drainer resend the same heads.
+        """
+        self._handlers[channel] = deliver
+        self.lease_seconds = max(self.lease_seconds, 2 * timeout)
+        self.start()
+
+    def start(self, drain: bool = True):
+        if self._threads:
+            return
+        with self._started_lock:
+            if self._threads:
+                return
+            self._db()   # create the schema before the threads race for it
+            loops = [(self._write_loop, "outbox-writer")]
+            if drain:
+                loops.append((self._drain_loop, "outbox-drain"))
+            for target, name in loops:
+                t = threading.Thread(target=target, name=name, daemon=True)
+                t.start()
+                self._threads.append(t)
+
+    # ── enqueue (hot path) ──
+    def put(self, channel: str, recipient: str, call: str, args: list,
+            idem_key: Optional[str] = None, timeout: float = 5.0) -> str:
+        """Durably enqueue one send; returns its idempotency key once committed."""
+        key = idem_key or _next_key()
+        item = _Pending((key, channel, recipient, call, jsonCodec.dumps(args), time.time()))
+        with self._cond:
+            self._queue.append(item)
+            self._cond.notify()
+        if not item.done.wait(timeout):
+            raise TimeoutError("outbox commit timed out")
+        if item.error is not None:
+            raise item.error
+        return key
+
+    def _write_loop(self):
+        db = self._db()
+        while True:
+            with self._cond:
+                while not self._queue:
+                    self._cond.wait()
+            if self.commit_window:
+                time.sleep(self.commit_window)
+            with self._cond:
+                batch, self._queue = self._queue, []
+            error = None
+            try:
+                db.execute("BEGIN IMMEDIATE")
+                db.executemany(
+                    "INSERT OR IGNORE INTO outbox (idem_key, channel, recipient, call, args, created) "
+                    "VALUES (?, ?, ?, ?, ?, ?)", [p.row for p in batch])
+                db.execute("COMMIT")
+            except sqlite3.Error as e:
+                log.error("Outbox commit of %d messages failed: %s", len(batch), e)
+                if db.in_transaction:
+                    db.execute("ROLLBACK")
+                error = e
+            for p in batch:
+                p.error = error
+                p.done.set()
+            self._wake.set()
+
+    # ── drain ──
+    def _take_lease(self) -> bool:
+        now = time.time()
+        cur = self._db().execute(
+            "INSERT INTO drain_lease (id, owner, until) VALUES (1, ?, ?) "
+            "ON CONFLICT (id) DO UPDATE SET owner = excluded.owner, until = excluded.until "
+            "WHERE drain_lease.until < ? OR drain_lease.owner = excluded.owner",
+            (self.owner, now + self.lease_seconds, now))
+        return cur.rowcount == 1
+
+    def _heads(self, limit: int = 256) -> List[Tuple]:
+        """Oldest pending message of each recipient whose retry time has come."""
+        channels = list(self._handlers)
+        if not channels:
+            return []
+        marks = ",".join("?" * len(channels))
+        return self._db().execute(
+            f"SELECT o.id, o.idem_key, o.channel, o.call, o.args, o.attempts FROM outbox o "
+            f"JOIN (SELECT MIN(id) AS id FROM outbox WHERE state = 'pending' AND channel IN ({marks}) "
+            f"      GROUP BY channel, recipient) h ON h.id = o.id "
+            f"WHERE o.next_at <= ? ORDER BY o.id LIMIT ?",
+            (*channels, time.time(), limit)).fetchall()
+
+    def _deliver(self, row: Tuple) -> Tuple[int, Optional[str], int]:
+        row_id, key, channel, call, args, attempts = row
+        try:
+            self._handlers[channel](call, jsonCodec.loads(args), key)
+            DELIVERIES.inc(channel=channel, result="sent")
+            return row_id, None, attempts
+        except Exception as e:
+            DELIVERIES.inc(channel=channel, result="error")
+            return row_id, f"{e.__class__.__name__}: {e}"[:500], attempts
+
+    def drain_once(self) -> int:
+        """Deliver one round of recipient heads; returns messages sent."""
+        heads = self._heads()
+        if not heads:
+            return 0
+        results = list(self._pool.map(self._deliver, heads))
+        now = time.time()
+        sent = [(now, row_id) for row_id, err, _ in results if err is None]
+        failed = []
+        for row_id, err, attempts in results:
+            if err is None:
+                continue
+            attempts += 1
+            state = "dead" if attempts >= self.max_attempts else "pending"
+            if state == "dead":
+                log.error("Outbox message %d parked after %d attempts: %s", row_id, attempts, err)
+            failed.append((state, attempts, now + min(300.0, 2 ** attempts), err, row_id))
+        db = self._db()
+        db.execute("BEGIN IMMEDIATE")
+        db.executemany("UPDATE outbox SET state = 'sent', next_at = ? WHERE id = ?", sent)
+        db.executemany("UPDATE outbox SET state = ?, attempts = ?, next_at = ?, last_error = ? "
+                       "WHERE id = ?", failed)
+        db.execute("COMMIT")
+        return len(sent)
+
+    def purge(self):
+        self._db().execute("DELETE FROM outbox WHERE state = 'sent' AND next_at < ?",
+                           (time.time() - RETENTION_SECONDS,))
+
+    def _drain_loop(self):
+        last_purge = 0.0
+        while True:
+            self._wake.wait(1.0)
+            self._wake.clear()
+            try:
+                if not self._take_lease():
+                    continue
+                while self.drain_once() and self._take_lease():
+                    pass
+                if time.monotonic() - last_purge > 60:
+                    self.purge()
+                    last_purge = time.monotonic()
+            except Exception as e:
+                log.warning("Outbox drain failed: %s", e)
+
+    def pending_count(self) -> int:
+        return self._db().execute("SELECT COUNT(*) FROM outbox WHERE state = 'pending'").fetchone()[0]
+
+    def stats(self) -> Dict[str, int]:
+        rows = self._db().execute("SELECT state, COUNT(*) FROM outbox GROUP BY state").fetchall()
+        return dict(rows)
+
+_shared: Optional[Outbox] = None
+_shared_lock = threading.Lock()
+
+def shared() -> Optional[Outbox]:
+    """The process-wide outbox at OUTBOX_PATH, or None when it is not configured."""
+    global _shared
+    if not OUTBOX_PATH:
+        return None
+    if _shared is None:
+        with _shared_lock:
+            if _shared is None:
+                _shared = Outbox(OUTBOX_PATH)
+    return _shared
@@ -0,0 +1,195 @@
+from __future__ import annotations
+
+import os
+import sys
+import hmac
+import time
+import logging
+import threading
+import functools
+
+from collections import Counter
+from typing import Dict, List, Optional
+
+from flask import Blueprint, request, jsonify, Response, abort
+
+log = logging.getLogger(__name__)
+
+# PROFILE_TOKEN       - Required to use /debug/profile; unset disables profiling entirely
+# PROFILE_DIR         - Where collapsed-stack files are written (default: profiles)
+# PROFILE_INTERVAL_MS - Sampling interval (default: 5)
+# PROFILE_MAX_SECONDS - Upper bound for a profiling window (default: 300)
+PROFILE_TOKEN = os.getenv("PROFILE_TOKEN")
+PROFILE_DIR = os.getenv("PROFILE_DIR", "profiles")
+INTERVAL = float(os.getenv("PROFILE_INTERVAL_MS", "5")) / 1000
+MAX_SECONDS = float(os.getenv("PROFILE_MAX_SECONDS", "300"))
+MAX_DEPTH = 64
+
+def _collapse(frame) -> str:
+    """Render a frame's stack root-first as 'file:func;file:func' (flamegraph.pl format)."""
+    parts: List[str] = []
+    while frame is not None and len(parts) < MAX_DEPTH:
+        code = frame.f_code
+        parts.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+        frame = frame.f_back
+    return ";".join(reversed(parts))
+
+# ────────────────────────────── Sampler ─────────────────────────────
+class SamplingProfiler:
+    """Samples the stacks of threads that are serving webhook requests.
+
+    Only runs while a window is open. In slow-request mode a request's
+    samples are kept only if it took longer than `slow_ms`.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._active: Dict[int, Counter] = {}   # thread id -> samples of its current request
+        self._stacks: Counter = Counter()
+        self._until = 0.0
+        self._slow_ms: Optional[float] = None
+        self._thread: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+        self._requests = 0
+        self._kept = 0
+        self.last_file: Optional[str] = None
+
+    @property
+    def running(self) -> bool:
+        return time.monotonic() < self._until
+
+    def start(self, seconds: float, slow_ms: Optional[float] = None) -> bool:
+        old = self._thread
+        if old is not None and old.is_alive() and not self.running:
+            # A stopped window's sampler may still be finishing; let it flush
+            # its own stacks before this window resets them
+            self._stop.set()
+            old.join()
+        with self._lock:
+            if self.running or (self._thread is not None and self._thread.is_alive()):
+                return False
+            self._stacks = Counter()
+            self._requests = self._kept = 0
+            self._slow_ms = slow_ms
+            self._until = time.monotonic() + min(seconds, MAX_SECONDS)
+            self._stop = threading.Event()
+            self._thread = threading.Thread(target=self._run, args=(self._stop,),
+                                            name="profiler", daemon=True)
+            self._thread.start()
+        log.info("Profiling for %.0fs (slow_ms=%s)", seconds, slow_ms)
+        return True
+
+    def stop(self):
+        self._until = 0.0
+        self._stop.set()
+
+    def _run(self, stop: threading.Event):
+        me = threading.get_ident()
+        while self.running and not stop.is_set():
+            frames = sys._current_frames()
+            with self._lock:
+                for tid, samples in self._active.items():
+                    frame = frames.get(tid)
+                    if frame is not None and tid != me:
+                        samples[_collapse(frame)] += 1
+            stop.wait(INTERVAL)
+        self._flush()
+
+    def _flush(self):
+        with self._lock:
+            stacks, self._stacks = self._stacks, Counter()
+        if not stacks:
+            return
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        path = os.path.join(PROFILE_DIR, time.strftime("webhook-%Y%m%d-%H%M%S.folded"))
+        with open(path, "w") as fh:
+            for stack, n in stacks.most_common():
+                fh.write(f"{stack} {n}\n")
+        self.last_file = path
+        log.info("Profile written to %s (%d requests kept of %d)", path, self._kept, self._requests)
+
+    # ── request hooks ──
+    def begin(self):
+        if self.running:
+            with self._lock:
+                self._active[threading.get_ident()] = Counter()
+
+    def end(self, elapsed_ms: float):
+        if not self._active:
+            return
+        with self._lock:
+            samples = self._active.pop(threading.get_ident(), None)
+            if samples is None:
+                return
+            self._requests += 1
+            if self._slow_ms is None or elapsed_ms >= self._slow_ms:
+                self._kept += 1
+                self._stacks.update(samples)
+
+    def status(self) -> dict:
+        return {
+            "running": self.running,
+            "remaining_s": round(max(0.0, self._until - time.monotonic()), 1),
+            "slow_ms": self._slow_ms,
+            "requests_seen": self._requests,
+            "requests_kept": self._kept,
+            "last_file": self.last_file,
+        }
+
+profiler = SamplingProfiler()
+
+def profiled(fn):
+    """Decorator for webhook views: let the profiler sample this request."""
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        if not profiler.running:
+            return fn(*args, **kwargs)
+        profiler.begin()
+        start = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            profiler.end((time.perf_counter() - start) * 1000)
+    return wrapper
+
+# ────────────────────────────── Control endpoints ─────────────────────────────
+profile_bp = Blueprint("profile", __name__, url_prefix="/debug/profile")
+
+@profile_bp.before_request
+def _check_token():
+    if not PROFILE_TOKEN:
+        abort(404)
+    given = request.headers.get("X-Profile-Token", "")
+    if not hmac.compare_digest(given, PROFILE_TOKEN):
+        abort(401)
+
+@profile_bp.route("", methods=["POST"])
+def start_profile():
+    """Open a window: {"seconds": 60, "slow_ms": 2000} (slow_ms optional)"""
+    body = request.get_json(silent=True) or {}
+    try:
+        seconds = float(body.get("seconds", 30))
+        slow_ms = float(body["slow_ms"]) if body.get("slow_ms") is not None else None
+    except (TypeError, ValueError):
+        return jsonify({"error": "seconds and slow_ms must be numbers"}), 400
+    if not seconds > 0 or (slow_ms is not None and slow_ms < 0):
+        return jsonify({"error": "seconds must be > 0 and slow_ms >= 0"}), 400
+    if not profiler.start(seconds, slow_ms):
+        return jsonify({"error": "already running", **profiler.status()}), 409
+    return jsonify(profiler.status()), 202
+
+@profile_bp.route("", methods=["GET"])
+def profile_status():
+    return jsonify(profiler.status()), 200
+
+@profile_bp.route("", methods=["DELETE"])
+def stop_profile():
+    profiler.stop()
+    return jsonify(profiler.status()), 200
+
+@profile_bp.route("/latest", methods=["GET"])
+def latest_profile():
+    if not profiler.last_file or not os.path.exists(profiler.last_file):
+        return jsonify({"error": "no profile yet"}), 404
+    with open(profiler.last_file) as fh:
+        return Response(fh.read(), mimetype="text/plain")
@@ -0,0 +1,287 @@
+from __future__ import annotations
+
+import os
+import time
+import socket
+import sqlite3
+import logging
+import threading
+
+from collections import defaultdict, deque
+from concurrent.futures import Future
+from dataclasses import dataclass
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+import utils
+import metrics
+from fanout import fan_out, FanOutResult
+from transports import whatsapp_transport
+
+log = logging.getLogger(__name__)
+
+# RESTOCK_ENABLED  - "1" to offer a stock alert after a medication status reply
+# RESTOCK_DB       - SQLite file holding subscriptions, shared by all workers (default: restock.db)
+# RESTOCK_INTERVAL - Seconds between inventory sweeps (default: 900)
+# RESTOCK_TTL_DAYS - Forget a subscription after this many days (default: 30)
+# RESTOCK_TEMPLATE - Approved template for the alert, "name" or "name:lang", with the
+#                    medication and the place as its two body parameters. Without it a
+#                    plain text is sent, which Graph only delivers inside the 24h window.
+ENABLED = os.getenv("RESTOCK_ENABLED", "0") == "1"
+RESTOCK_DB = os.getenv("RESTOCK_DB", "restock.db")
+INTERVAL = float(os.getenv("RESTOCK_INTERVAL", "900"))
+TTL_SECONDS = float(os.getenv("RESTOCK_TTL_DAYS", "30")) * 86400
+TEMPLATE = os.getenv("RESTOCK_TEMPLATE", "")
+MAX_ATTEMPTS = 3            # failed alerts before a subscription is dropped
+ALERTS_IN_FLIGHT = 8        # alerts queued on the send lanes at once, so live replies
+                            # never wait behind a whole sweep
+
+NOTIFICATIONS = metrics.counter("restock_notifications_total", "Stock alerts pushed, by result")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS subscription (
+    sender      TEXT NOT NULL,
+    centro      TEXT NOT NULL,
+    cod_mol     TEXT NOT NULL,
+    doc_num     TEXT NOT NULL,
+    cantidad    INTEGER NOT NULL,
+    descripcion TEXT NOT NULL DEFAULT '',
+    nom_centro  TEXT NOT NULL DEFAULT '',
+    created     REAL NOT NULL,
+    channel     TEXT NOT NULL DEFAULT 'whatsapp',
+    phone_id    TEXT NOT NULL DEFAULT '',
+    attempts    INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (sender, centro, cod_mol)
+);
+CREATE INDEX IF NOT EXISTS subscription_centro ON subscription (centro, cod_mol);
+CREATE TABLE IF NOT EXISTS sweep_lease (
+    id    INTEGER PRIMARY KEY CHECK (id = 1),
+    owner TEXT NOT NULL,
+    until REAL NOT NULL
+);
+"""
+# columns added after the first release; older databases get them on open
+_ADDED_COLUMNS = (
+    ("channel", "TEXT NOT NULL DEFAULT 'whatsapp'"),
+    ("phone_id", "TEXT NOT NULL DEFAULT ''"),
+    ("attempts", "INTEGER NOT NULL DEFAULT 0"),
+)
+_COLUMNS = ("sender, centro, cod_mol, doc_num, cantidad, descripcion, nom_centro, created, "
+            "channel, phone_id, attempts")
+
+# Channels a subscription can be delivered on, long after the conversation ended.
+# Chatwoot sessions have no way to push into a closed conversation, so they are
+# never offered the alert (see Transport.push_alerts).
+CHANNELS = ("whatsapp",)
+
+@dataclass
+class Subscription:
+    sender: str
+    centro: str
+    cod_mol: str
+    doc_num: str
+    cantidad: int
+    descripcion: str = ""
+    nom_centro: str = ""
+    created: float = 0.0
+    channel: str = "whatsapp"
+    phone_id: str = ""          # business number the patient wrote to
+    attempts: int = 0
+
+    @property
+    def place(self) -> str:
+        if self.centro == "920":
+            return "la central de domicilio"
+        return f"el punto {self.nom_centro[:-6]}"
+
+def alert_text(subs: List[Subscription]) -> str:
+    lines = [f"*{s.descripcion.capitalize()}* ya esta *disponible* en {s.place}." for s in subs]
+    return "Buenas noticias!\n\n" + "\n".join(lines) + "\n\n*Puedes ir a reclamarlo!*"
+
+def _send_alert(sender: str, subs: List[Subscription]):
+    """Send through the number the patient subscribed on (and its outbox, if any).
+
+    Returns the transport's result: a Future when the send was queued on a lane.
+    """
+    transport = whatsapp_transport(subs[0].phone_id or None)
+    if not TEMPLATE:
+        result = transport.send_text(sender, alert_text(subs))
+    else:
+        name, _, lang = TEMPLATE.partition(":")
+        meds = ", ".join(s.descripcion.capitalize() for s in subs)
+        places = ", ".join(dict.fromkeys(s.place for s in subs))
+        result = transport.send_template(sender, name, [meds, places], lang or "es")
+    return result
+
+# ────────────────────────────── Watch list ─────────────────────────────
+class RestockWatch:
+    """Pending medications patients asked to be alerted about.
+
+    A background sweep checks stock for every watched (centro, cod_mol)
+    once per interval - one inventory call per pair, however many
+    patients wait on it - and pushes one message per patient when stock
+    covers what they are owed. Subscriptions live in SQLite so every
+    worker sees the same list; a lease row makes sure only one worker
+    sweeps at a time.
+    """
+
+    def __init__(self, path: str = RESTOCK_DB, interval: float = INTERVAL,
+                 ttl_seconds: float = TTL_SECONDS,
+                 notify: Callable[[str, List[Subscription]], object] = _send_alert):
+        self.path = path
+        self.interval = interval
+        self.ttl_seconds = ttl_seconds
+        self.notify = notify
+        self.owner = f"{socket.gethostname()}:{os.getpid()}"
+        self._local = threading.local()
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        metrics.gauge("restock_subscriptions", "Patients waiting for a stock alert") \
+            .set_function(self.count)
+
+    def _db(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(_SCHEMA)
+            have = {row[1] for row in conn.execute("PRAGMA table_info(subscription)")}
+            for name, decl in _ADDED_COLUMNS:
+                if name not in have:
+                    try:
+                        conn.execute(f"ALTER TABLE subscription ADD COLUMN {name} {decl}")
+                    except sqlite3.OperationalError:
+                        pass    # another worker added it first
+            self._local.conn = conn
+        return conn
+
+    def subscribe(self, sender: str, doc_num: str, records: Iterable[utils.HistoryRecord],
+                  channel: str = "whatsapp", phone_id: Optional[str] = None) -> int:
+        """Watch the given pending records for `sender`; returns how many are watched."""
+        if channel not in CHANNELS:
+            raise ValueError(f"restock alerts can't be delivered on {channel!r}")
+        now = time.time()
+        rows = [(sender, r.centro, r.cod_mol, doc_num, r.cant_pendiente,
+                 r.descripcion, r.nom_centro or "", now, channel, phone_id or "", 0)
+                for r in records if r.cod_mol and r.cant_pendiente]
+        if not rows:
+            return 0
+        self._db().executemany(
+            f"INSERT OR REPLACE INTO subscription ({_COLUMNS}) "
+            f"VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+        self.start()
+        return len(rows)
+
+    def unsubscribe(self, sender: str) -> int:
+        return self._db().execute("DELETE FROM subscription WHERE sender = ?", (sender,)).rowcount
+
+    def count(self) -> int:
+        return self._db().execute("SELECT COUNT(*) FROM subscription").fetchone()[0]
+
+    def _take_lease(self) -> bool:
+        now = time.time()
+        cur = self._db().execute(
+            "INSERT INTO sweep_lease (id, owner, until) VALUES (1, ?, ?) "
+            "ON CONFLICT (id) DO UPDATE SET owner = excluded.owner, until = excluded.until "
+            "WHERE sweep_lease.until < ? OR sweep_lease.owner = excluded.owner",
+            (self.owner, now + self.interval * 1.5, now))
+        return cur.rowcount == 1
+
+    # ── sweep ──
+    def sweep(self) -> int:
+        """Check stock for all watched medications; returns alerts sent."""
+        db = self._db()
+        db.execute("DELETE FROM subscription WHERE created < ?", (time.time() - self.ttl_seconds,))
+        subs = [Subscription(*row) for row in db.execute(
+            f"SELECT {_COLUMNS} FROM subscription WHERE channel IN ({','.join('?' * len(CHANNELS))}) "
+            "ORDER BY centro, cod_mol", CHANNELS)]
+        if not subs:
+            return 0
+
+        token = utils.medicar_tokens.get()
+        pairs = {f"{s.centro}|{s.cod_mol}" for s in subs}
+        stock = fan_out(lambda key: utils.get_inventory(*key.split("|", 1), token), sorted(pairs))
+
+        # one alert per patient and business number
+        ready: Dict[Tuple[str, str], List[Subscription]] = defaultdict(list)
+        for s in subs:
+            available = stock.ok.get(f"{s.centro}|{s.cod_mol}")
+            if available is not None and s.cantidad <= available:
+                ready[(s.sender, s.phone_id)].append(s)
+        if not ready:
+            return 0
+
+        keys = {f"{sender}|{phone_id}": (sender, phone_id) for sender, phone_id in ready}
+        sent = self._send_all(keys, ready)
+        done = [s for key in sent.ok for s in ready[keys[key]]]
+        failed = [s for key in sent.failed for s in ready[keys[key]]]
+        db.executemany("DELETE FROM subscription WHERE sender = ? AND centro = ? AND cod_mol = ?",
+                       [(s.sender, s.centro, s.cod_mol) for s in done])
+        NOTIFICATIONS.inc(len(sent.ok), result="sent")
+        if failed:
+            NOTIFICATIONS.inc(len(sent.failed), result="failed")
+            log.warning("Restock alerts failed: %s", sent.summary())
+            # retried next sweep, up to MAX_ATTEMPTS
+            db.executemany("UPDATE subscription SET attempts = attempts + 1 "
+                           "WHERE sender = ? AND centro = ? AND cod_mol = ?",
+                           [(s.sender, s.centro, s.cod_mol) for s in failed])
+            dropped = db.execute("DELETE FROM subscription WHERE attempts >= ?", (MAX_ATTEMPTS,)).rowcount
+            if dropped:
+                NOTIFICATIONS.inc(dropped, result="dropped")
+        log.info("Restock sweep: %d watched, %d pairs checked, %d patients alerted",
+                 len(subs), len(pairs), len(sent.ok))
+        return len(sent.ok)
+
+    def _send_all(self, keys: Dict[str, Tuple[str, str]],
+                  ready: Dict[Tuple[str, str], List[Subscription]]) -> FanOutResult:
+        """Send the alerts from this thread, ALERTS_IN_FLIGHT at a time.
+
+        Queued sends are waited for without a deadline of our own: the lane
+        bounds each Graph call (WA_TIMEOUT), and giving up earlier would
+        count as failed an alert that still goes out, and send it again on
+        the next sweep.
+        """
+        result = FanOutResult()
+        window: deque = deque()
+
+        def settle(key: str, outcome):
+            try:
+                result.ok[key] = outcome.result() if isinstance(outcome, Future) else outcome
+            except Exception as exc:
+                log.warning("Restock alert to %s failed: %s", key, exc)
+                result.failed[key] = str(exc) or exc.__class__.__name__
+
+        for key, (sender, phone_id) in keys.items():
+            try:
+                window.append((key, self.notify(sender, ready[(sender, phone_id)])))
+            except Exception as exc:
+                log.warning("Restock alert to %s failed: %s", key, exc)
+                result.failed[key] = str(exc) or exc.__class__.__name__
+            while len(window) >= ALERTS_IN_FLIGHT:
+                settle(*window.popleft())
+        while window:
+            settle(*window.popleft())
+        return result
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            try:
+                if self._take_lease():
+                    self.sweep()
+            except Exception as e:
+                log.warning("Restock sweep failed: %s", e)
+
+    def start(self):
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="restock-sweep", daemon=True)
+                self._thread.start()
+
+watch: Optional[RestockWatch] = None
+if ENABLED:
+    watch = RestockWatch()
+    watch.start()
@@ -0,0 +1,170 @@
+from __future__ import annotations
+
+import os
+import time
+import queue
+import random
+import logging
+import threading
+import functools
+import contextvars
+
+from typing import Any, Dict, Optional
+
+import jsonCodec
+from logConfig import redact_value
+
+log = logging.getLogger(__name__)
+
+# TRACE_SAMPLE_RATE   - Fraction of webhook turns traced, 0..1 (default: 0, off)
+# TRACE_FILE          - JSONL file spans are appended to (default: traces.jsonl)
+# TRACE_COLLECTOR_URL - If set, spans are POSTed there in JSON batches instead
+SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "0"))
+TRACE_FILE = os.getenv("TRACE_FILE", "traces.jsonl")
+COLLECTOR_URL = os.getenv("TRACE_COLLECTOR_URL")
+
+_current: contextvars.ContextVar[Optional["Span"]] = contextvars.ContextVar("span", default=None)
+
+def _new_id(bits: int) -> str:
+    return f"{random.getrandbits(bits):0{bits // 4}x}"
+
+# ────────────────────────────── Spans ─────────────────────────────
+class Span:
+    __slots__ = ("trace_id", "span_id", "parent_id", "name", "attrs",
+                 "start", "end", "status", "_token")
+
+    def __init__(self, name: str, trace_id: str, parent_id: Optional[str], attrs: Dict[str, Any]):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = _new_id(64)
+        self.parent_id = parent_id
+        self.attrs = attrs
+        self.status = "ok"
+        self.start = time.time()
+        self.end: Optional[float] = None
+        self._token = None
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+    def __enter__(self) -> "Span":
+        self._token = _current.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.end = time.time()
+        if exc_type is not None:
+            self.status = "error"
+            self.attrs["error"] = exc_type.__name__
+        _current.reset(self._token)
+        _exporter.submit(self)
+        return False
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "start": self.start,
+            "duration_ms": round(((self.end or time.time()) - self.start) * 1000, 3),
+            "status": self.status,
+            "attrs": {k: redact_value(k, v) for k, v in self.attrs.items()},
+        }
+
+class _NoopSpan:
+    """Stand-in used when the current turn isn't sampled."""
+    __slots__ = ()
+
+    def set(self, **attrs):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+_NOOP = _NoopSpan()
+
+def start_trace(name: str, **attrs):
+    """Open a root span for one webhook turn, subject to TRACE_SAMPLE_RATE."""
+    if SAMPLE_RATE <= 0 or random.random() >= SAMPLE_RATE:
+        return _NOOP
+    return Span(name, _new_id(128), None, attrs)
+
+def span(name: str, **attrs):
+    """Open a child of the current span; a no-op outside a sampled trace."""
+    parent = _current.get()
+    if parent is None:
+        return _NOOP
+    return Span(name, parent.trace_id, parent.span_id, attrs)
+
+def current_span():
+    return _current.get() or _NOOP
+
+def traced(name: str):
+    """Decorator: run the function inside a child span."""
+    def deco(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if _current.get() is None:
+                return fn(*args, **kwargs)
+            with span(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return deco
+
+def traced_root(name: str):
+    """Decorator: run the function as a (possibly sampled) root span."""
+    def deco(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with start_trace(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return deco
+
+# ────────────────────────────── Export ─────────────────────────────
+class _Exporter:
+    """Ships finished spans off the request thread, in batches."""
+
+    def __init__(self, batch_size: int = 200, flush_seconds: float = 2.0):
+        self._queue: queue.SimpleQueue = queue.SimpleQueue()
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+        self.batch_size = batch_size
+        self.flush_seconds = flush_seconds
+
+    def submit(self, s: Span):
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name="trace-export", daemon=True)
+                    self._thread.start()
+        self._queue.put(s)
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.flush_seconds
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get(timeout=max(0.0, deadline - time.monotonic())))
+                except queue.Empty:
+                    break
+            try:
+                self._write([s.to_dict() for s in batch])
+            except Exception as e:
+                log.warning("Dropped %d spans: %s", len(batch), e)
+
+    def _write(self, spans: list):
+        if COLLECTOR_URL:
+            import requests
+            requests.post(COLLECTOR_URL, data=jsonCodec.dumps(spans),
+                          headers={"Content-Type": "application/json"}, timeout=5)
+            return
+        with open(TRACE_FILE, "ab") as fh:
+            fh.write(b"".join(jsonCodec.dumps(s) + b"\n" for s in spans))
+
+_exporter = _Exporter()
@@ -0,0 +1,260 @@
+from __future__ import annotations
+
+import os
+import time
+import queue
+import logging
+import threading
+import functools
+import contextvars
+import requests
+
+from abc import ABC, abstractmethod
+from concurrent.futures import Future
+from typing import Any, Callable, Dict, List, Optional
+
+import whatsappAPI as wa
+import metrics
+import outbox
+
+log = logging.getLogger(__name__)
+
+# WA_SEND_LANES  - Parallel outbound lanes for WhatsApp (default: 8)
+# WA_ASYNC_SEND  - "0" to send WhatsApp messages inline on the request thread
+# WA_POOL_SIZE   - Max pooled HTTP connections to Graph (default: WA_SEND_LANES)
+WA_SEND_LANES = int(os.getenv("WA_SEND_LANES", "8"))
+WA_ASYNC_SEND = os.getenv("WA_ASYNC_SEND", "1") != "0"
+WA_POOL_SIZE = int(os.getenv("WA_POOL_SIZE", str(WA_SEND_LANES)))
+
+BATCH_SIZE = 16
+
+def pooled_session(pool_size: int) -> requests.Session:
+    """A requests.Session with a keep-alive pool sized for `pool_size` threads."""
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size,
+                                            pool_maxsize=pool_size)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+# ────────────────────────────── Outbound Pipeline ─────────────────────────────
+class _Item:
+    __slots__ = ("key", "kind", "fn", "args", "future", "queued_at", "context")
+
+    def __init__(self, key, kind, fn, args):
+        self.key = key
+        self.kind = kind
+        self.fn = fn
+        self.args = args
+        self.future: Future = Future()
+        self.queued_at = time.monotonic()
+        self.context = contextvars.copy_context()
+
+class OutboundPipeline:
+    """Per-channel send queue.
+
+    Messages for the same key (recipient or conversation) always go to the
+    same lane and are sent in order; different keys are spread over
+    `lanes` worker threads. A lane drains up to BATCH_SIZE queued items at
+    a time and hands consecutive items to `coalesce`, which may merge them
+    into fewer upstream calls.
+    """
+
+    def __init__(self, name: str, lanes: int = 4, *,
+                 coalesce: Optional[Callable[[list], list]] = None):
+        self.name = name
+        metrics.gauge("outbound_queue_depth", "Messages waiting in a channel's send lanes") \
+            .set_function(self.queue_depth, channel=name)
+        self.coalesce = coalesce
+        self._queues = [queue.SimpleQueue() for _ in range(max(1, lanes))]
+        self._threads: list[threading.Thread] = []
+        self._lock = threading.Lock()
+        self._sent = 0
+        self._failed = 0
+        self._batches = 0
+        self._latency_total = 0.0
+
+    def _ensure_started(self):
+        if self._threads:
+            return
+        with self._lock:
+            if self._threads:
+                return
+            for i, q in enumerate(self._queues):
+                t = threading.Thread(target=self._run, args=(q,),
+                                     name=f"{self.name}-lane-{i}", daemon=True)
+                t.start()
+                self._threads.append(t)
+
+    def submit(self, key: str, kind: str, fn: Callable, *args) -> Future:
+        self._ensure_started()
+        item = _Item(key, kind, fn, args)
+        self._queues[hash(key) % len(self._queues)].put(item)
+        return item.future
+
+    def _run(self, q: queue.SimpleQueue):
+        while True:
+            batch = [q.get()]
+            while len(batch) < BATCH_SIZE:
+                try:
+                    batch.append(q.get_nowait())
+                except queue.Empty:
+                    break
+            with self._lock:
+                self._batches += 1
+            groups = self.coalesce(batch) if self.coalesce else [[i] for i in batch]
+            for group in groups:
+                self._deliver(group)
+
+    def _deliver(self, group: list):
+        head = group[0]
+        try:
+            result = head.context.run(head.fn, *head.args)
+        except Exception as exc:
+            log.warning("%s send to %s failed: %s", self.name, head.key, exc)
+            with self._lock:
+                self._failed += len(group)
+            for item in group:
+                item.future.set_exception(exc)
+            return
+        now = time.monotonic()
+        with self._lock:
+            self._sent += len(group)
+            self._latency_total += sum(now - item.queued_at for item in group)
+        for item in group:
+            item.future.set_result(result)
+
+    def queue_depth(self) -> int:
+        return sum(q.qsize() for q in self._queues)
+
+    def stats(self) -> Dict[str, Any]:
+        done = self._sent + self._failed
+        return {
+            "lanes": len(self._queues),
+            "queued": self.queue_depth(),
+            "sent": self._sent,
+            "failed": self._failed,
+            "batches": self._batches,
+            "avg_latency_ms": round(1000 * self._latency_total / done, 1) if done else 0.0,
+        }
+
+# ────────────────────────────── Transports ─────────────────────────────
+class Transport(ABC):
+    """Outbound channel a ChatBot session talks through.
+
+    Sends go through the channel's OutboundPipeline unless `async_send` is
+    off, in which case they run inline and return the upstream result.
+    With an outbox configured, calls named in `durable_calls` are written
+    to it instead and delivered by its drainer through `_deliver`.
+    """
+    channel = "base"
+    durable_calls: frozenset = frozenset()
+    push_alerts = False     # can reach the patient later, outside this conversation (restock)
+    send_timeout = 0.0      # longest one upstream send can take (connect + read)
+
+    def __init__(self, pipeline: OutboundPipeline, async_send: bool = True,
+                 durable: Optional[outbox.Outbox] = None):
+        self.pipeline = pipeline
+        self.async_send = async_send
+        self.outbox = durable if self.durable_calls else None
+        if self.outbox is not None:
+            self.outbox.register(self.channel, self._deliver, self.send_timeout)
+
+    def _dispatch(self, key: str, kind: str, fn: Callable, *args):
+        if self.outbox is not None:
+            call = getattr(fn, "func", fn).__name__
+            if call in self.durable_calls:
+                return self.outbox.put(self.channel, key, call, list(args))
+        if self.async_send:
+            return self.pipeline.submit(key, kind, fn, *args)
+        return fn(*args)
+
+    @abstractmethod
+    def _deliver(self, call: str, args: list, idem_key: str):
+        """Send one outbox message; only called for names in `durable_calls`."""
+
+    @abstractmethod
+    def send_text(self, to: str, body: str, preview_url: bool = False):
+        ...
+
+    @abstractmethod
+    def send_two_buttons(self, to: str, question: str, yes_id: str, no_id: str,
+                         str1: str, str2: str):
+        ...
+
+    @abstractmethod
+    def sendDocType(self, to: str, body: str):
+        ...
+
+    @abstractmethod
+    def sendMenu(self, to: str, body: str):
+        ...
+
+    def relay_to_agents(self, sender: str, body: str):
+        """Pass a customer message on to human agents (no-op by default)."""
+        return None
+
+    def stats(self) -> Dict[str, Any]:
+        return {"channel": self.channel, **self.pipeline.stats()}
+
+class WhatsAppTransport(Transport):
+    """Sends through the Graph API from one business number, with its own
+    connection pool and send lanes. The default number keeps the plain
+    "whatsapp" channel name; others are "whatsapp:<phone_id>"."""
+    channel = "whatsapp"
+    durable_calls = frozenset({"send_text", "send_template", "send_two_buttons", "sendDocType",
+                               "sendMenu"})
+    push_alerts = True
+    send_timeout = sum(wa.WA_TIMEOUT)
+
+    def __init__(self, phone_id: Optional[str] = None, lanes: int = WA_SEND_LANES,
+                 async_send: bool = WA_ASYNC_SEND, pool_size: int = WA_POOL_SIZE):
+        self.phone_id = wa.number_for(phone_id).phone_id
+        if self.phone_id != wa.PHONE_ID:
+            self.channel = f"whatsapp:{self.phone_id}"
+        self.session = pooled_session(pool_size)
+        super().__init__(OutboundPipeline(self.channel, lanes), async_send, outbox.shared())
+
+    def _deliver(self, call: str, args: list, idem_key: str):
+        return getattr(wa, call)(*args, session=self.session, phone_id=self.phone_id)
+
+    def _call(self, fn: Callable) -> Callable:
+        return functools.partial(fn, session=self.session, phone_id=self.phone_id)
+
+    def send_text(self, to: str, body: str, preview_url: bool = False):
+        return self._dispatch(to, "text", self._call(wa.send_text), to, body, preview_url)
+
+    def send_template(self, to: str, name: str, params: List[str], lang: str = "es"):
+        return self._dispatch(to, "text", self._call(wa.send_template), to, name, params, lang)
+
+    def send_two_buttons(self, to: str, question: str, yes_id: str, no_id: str,
+                         str1: str, str2: str):
+        return self._dispatch(to, "buttons", self._call(wa.send_two_buttons),
+                              to, question, yes_id, no_id, str1, str2)
+
+    def sendDocType(self, to: str, body: str):
+        return self._dispatch(to, "list", self._call(wa.sendDocType), to, body)
+
+    def sendMenu(self, to: str, body: str):
+        return self._dispatch(to, "list", self._call(wa.sendMenu), to, body)
+
+    def relay_to_agents(self, sender: str, body: str):
+        return self._dispatch(sender, "relay", wa.forward_to_agent, sender, body)
+
+_whatsapp: Dict[str, WhatsAppTransport] = {}
+_whatsapp_lock = threading.Lock()
+
+def whatsapp_transport(phone_id: Optional[str]) -> WhatsAppTransport:
+    """Process-wide transport for one configured number (unknown ids get the default)."""
+    phone_id = wa.number_for(phone_id).phone_id
+    transport = _whatsapp.get(phone_id)
+    if transport is None:
+        with _whatsapp_lock:
+            transport = _whatsapp.get(phone_id)
+            if transport is None:
+                transport = _whatsapp[phone_id] = WhatsAppTransport(phone_id)
+    return transport
+
+def default_whatsapp_transport() -> WhatsAppTransport:
+    """Transport for the default number (WA_PHONE_ID)."""
+    return whatsapp_transport(wa.PHONE_ID)
@@ -1,4 +1,6 @@
 import os
+import time
+import threading
 import requests
 from dotenv import load_dotenv
 from typing import Dict, TypedDict, Optional, Any
@@ -7,6 +9,13 @@ from typing import Tuple, Dict, List, Optional, Iterable
 import logging
 from dataclasses import dataclass
 from datetime import datetime
+from collections import OrderedDict
+
+from metrics import timed_upstream, CACHE_REQUESTS, UPSTREAM_ERRORS
+from tracing import traced
+from transports import pooled_session
+from concurrent.futures import wait, FIRST_COMPLETED
+import fanout
 
 log = logging.getLogger(__name__)
 load_dotenv()
@@ -26,6 +35,34 @@ PASSWORD = os.getenv("MEDICAR_PASSWORD")
 RIGHTS_TOKEN_URL    = os.getenv("RIGHTS_TOKEN_URL")
 RIGHTS_VALIDATE_URL = os.getenv("RIGHTS_VALIDATE_URL")
 
+# UPSTREAM_POOL_SIZE    - Keep-alive connections per upstream host (default: 32)
+# MEDICAR_TOKEN_TTL     - Seconds a Medicar login is reused (default: 1800)
+# RIGHTS_TOKEN_TTL      - Seconds a rights-service token is reused (default: 240)
+# RECORD_CACHE_TTL      - Seconds an affiliate record is served from cache (default: 600)
+# RECORD_CACHE_MISS_TTL - Seconds a "not found" answer is cached (default: 60)
+# RECORD_CACHE_SIZE     - Affiliate records kept in memory (default: 20000)
+UPSTREAM_POOL_SIZE = int(os.getenv("UPSTREAM_POOL_SIZE", "32"))
+MEDICAR_TOKEN_TTL = float(os.getenv("MEDICAR_TOKEN_TTL", "1800"))
+RIGHTS_TOKEN_TTL = float(os.getenv("RIGHTS_TOKEN_TTL", "240"))
+RECORD_CACHE_TTL = float(os.getenv("RECORD_CACHE_TTL", "600"))
+RECORD_CACHE_MISS_TTL = float(os.getenv("RECORD_CACHE_MISS_TTL", "60"))
+RECORD_CACHE_SIZE = int(os.getenv("RECORD_CACHE_SIZE", "20000"))
+
+# MED_STATUS_NOTICE_MS - Send "consultando..." once inventory lookups take longer than
+#                        this, then results as they arrive; 0 waits for all (default: 1500)
+# MED_STATUS_BATCH_MS  - Results arriving within this window go out as one message (default: 1000)
+MED_STATUS_NOTICE = float(os.getenv("MED_STATUS_NOTICE_MS", "1500")) / 1000
+MED_STATUS_BATCH = float(os.getenv("MED_STATUS_BATCH_MS", "1000")) / 1000
+WA_TEXT_LIMIT = 4096
+MED_STATUS_WAIT_REPLY = "Estamos consultando tus medicamentos, te respondemos en un momento..."
+NO_PENDING_MEDS = "No tienes medicamentos pendientes en este momento."
+
+# One keep-alive pool for DOC_API, Medicar, inventory and the rights service
+_http = pooled_session(UPSTREAM_POOL_SIZE)
+
+class UpstreamUnavailable(RuntimeError):
+    """No affiliate source answered, as opposed to answering "not found"."""
+
 @dataclass
 class DocRecord(TypedDict, total=False):
     TIPODOCUMENTO: str
@@ -51,11 +88,18 @@ class HistoryRecord:
 
 def parse_incoming(payload:dict) -> tuple[str, str, str]:
     try:
-        msg = (payload["entry"][0]["changes"][0]["value"]["messages"][0])
+        value = payload["entry"][0]["changes"][0]["value"]
+        if "messages" not in value and value.get("statuses"):
+            # delivery receipts for our own sends; nobody to answer
+            return "status", value["statuses"][0].get("status", ""), ""
+        msg = value["messages"][0]
         sender = msg["from"]
         if msg["type"] == "text":
             return "text", msg["text"]["body"], sender
 
+        if msg["type"] in ("image", "document"):
+            return "media", msg[msg["type"]]["id"], sender
+
         if msg["type"] == "interactive":
             itype = msg["interactive"]["type"]
             if itype == "button_reply":
@@ -73,6 +117,13 @@ def parse_incoming(payload:dict) -> tuple[str, str, str]:
 
     return "unsupported", "", sender if 'sender' in locals() else ""
 
+def parse_phone_id(payload: dict) -> Optional[str]:
+    """The business number (metadata.phone_number_id) a webhook arrived on."""
+    try:
+        return payload["entry"][0]["changes"][0]["value"]["metadata"]["phone_number_id"]
+    except (KeyError, IndexError, TypeError):
+        return None
+
 def clean_phone_number(phone: str) -> str:
     cleaned = ''.join(c for c in phone if c.isdigit() or c == '+')
     
@@ -90,11 +141,13 @@ def _parse_date(raw: str | None) -> Optional[datetime]:
         return None
 
 
+@traced("upstream.medicar_login")
+@timed_upstream("medicar_login")
 def get_token(email: str, password: str) -> str:
     payload = {"email": email, "password": password}
 
     try:
-        r = requests.post(LOGIN_EP, json=payload, timeout=TIMEOUT)
+        r = _http.post(LOGIN_EP, json=payload, timeout=TIMEOUT)
         r.raise_for_status()
         data = r.json()
     except requests.RequestException as exc:
@@ -118,7 +171,7 @@ def get_rights_token() -> str:
         "password": os.getenv("RIGHTS_PASSWORD"),
         "client_secret": os.getenv("RIGHTS_CLIENT_SECRET")
     }
-    r = requests.post(
+    r = _http.post(
         RIGHTS_TOKEN_URL,
         data=payload,
         timeout=TIMEOUT,
@@ -127,8 +180,10 @@ def get_rights_token() -> str:
     r.raise_for_status()
     return r.json()["access_token"]
 
+@traced("upstream.validate_rights")
+@timed_upstream("validate_rights")
 def validate_rights(doc_type: str, doc_id: str) -> Optional[Dict[str, Any]]:
-    token = get_rights_token()
+    token = rights_tokens.get()
     body = {
         "resourceType": "Parameters",
         "id": "CorrelationId",
@@ -138,14 +193,17 @@ def validate_rights(doc_type: str, doc_id: str) -> Optional[Dict[str, Any]]:
         ],
     }
 
-    r = requests.post(
+    r = _http.post(
         RIGHTS_VALIDATE_URL,
         json=body,
         headers= {
             "Authorization": f"Bearer {token}",
             "Content-Type": "application/json",
-        }
+        },
+        timeout=TIMEOUT,
     )
+    if r.status_code == 401:
+        rights_tokens.invalidate(token)
     r.raise_for_status()
     bundle = r.json()
 
@@ -166,17 +224,20 @@ def validate_rights(doc_type: str, doc_id: str) -> Optional[Dict[str, Any]]:
 def post_json(endpoint: str,
               token: str | None,
               json_body: dict | None = None,
-              *, timeout: int = TIMEOUT) -> dict | list | None:
+              *, timeout: int = TIMEOUT,
+              tokens: "TokenCache | None" = None) -> dict | list | None:
 
     headers = {"Accept": "application/json"}
     if token:
         headers["Authorization"] = f"Bearer {token}"
 
     try:
-        r = requests.post(endpoint,
+        r = _http.post(endpoint,
                           json=json_body or {},
                           headers=headers,
                           timeout=timeout)
+        if r.status_code == 401 and tokens is not None:
+            tokens.invalidate(token)
         r.raise_for_status()
 
     except requests.RequestException as exc:
@@ -189,17 +250,100 @@ def post_json(endpoint: str,
         log.error("POST %s returned non‑JSON: %s", endpoint, r.text[:400])
         return None
 
-def fetch_record(doc_type: str, doc_id: str) -> Optional[DocRecord]:
+# ────────────────────────────── Token and record caches ─────────────────────────────
+class TokenCache:
+    """One upstream login shared by every thread until it is `ttl` old.
+
+    Callers that find it expired wait on a single refresh instead of all
+    logging in at once; invalidate() makes the next get() log in again.
+    """
+
+    def __init__(self, name: str, login, ttl: float):
+        self.name = name
+        self.login = login
+        self.ttl = ttl
+        self._token: Optional[str] = None
+        self._expires = 0.0
+        self._lock = threading.Lock()
+
+    def get(self) -> str:
+        token = self._token
+        if token and time.monotonic() < self._expires:
+            CACHE_REQUESTS.inc(cache=self.name, result="hit")
+            return token
+        with self._lock:
+            if self._token and time.monotonic() < self._expires:
+                CACHE_REQUESTS.inc(cache=self.name, result="hit")
+                return self._token
+            CACHE_REQUESTS.inc(cache=self.name, result="miss")
+            self._token = self.login()
+            self._expires = time.monotonic() + self.ttl
+            return self._token
+
+    def invalidate(self, token: Optional[str] = None):
+        """Drop the cached token (only if it is still `token`, when given)."""
+        with self._lock:
+            if token is None or token == self._token:
+                self._token = None
+
+_MISSING = object()
+
+class RecordCache:
+    """Bounded LRU of affiliate lookups; "not found" expires sooner than a hit."""
+
+    def __init__(self, name: str, maxsize: int, ttl: float, miss_ttl: float):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.miss_ttl = miss_ttl
+        self._items: "OrderedDict[tuple, tuple]" = OrderedDict()   # key -> (expires, value)
+        self._lock = threading.Lock()
+
+    def get(self, key: tuple):
+        now = time.monotonic()
+        with self._lock:
+            item = self._items.get(key)
+            if item is not None and item[0] > now:
+                self._items.move_to_end(key)
+                CACHE_REQUESTS.inc(cache=self.name, result="hit")
+                return item[1]
+            if item is not None:
+                del self._items[key]
+        CACHE_REQUESTS.inc(cache=self.name, result="miss")
+        return _MISSING
+
+    def put(self, key: tuple, value):
+        ttl = self.ttl if value is not None else self.miss_ttl
+        if ttl <= 0:
+            return
+        with self._lock:
+            self._items[key] = (time.monotonic() + ttl, value)
+            self._items.move_to_end(key)
+            if len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+medicar_tokens = TokenCache("medicar_token", lambda: get_token(EMAIL, PASSWORD), MEDICAR_TOKEN_TTL)
+rights_tokens = TokenCache("rights_token", lambda: get_rights_token(), RIGHTS_TOKEN_TTL)
+records = RecordCache("affiliate_record", RECORD_CACHE_SIZE, RECORD_CACHE_TTL, RECORD_CACHE_MISS_TTL)
+
+@traced("upstream.fetch_record")
+@timed_upstream("fetch_record")
+def _lookup_record(doc_type: str, doc_id: str) -> Optional[DocRecord]:
     record = None
+    answered = False
 
     try:
         payload = {
             "function": "obtenerafiliados",
-            "tipodocumento": doc_type.upper(),
+            "tipodocumento": doc_type,
             "documento": doc_id
         }
 
         data = post_json(_API_URL, token=None, json_body=payload)
+        answered = data is not None
 
         if data and isinstance(data, dict):
             if data.get("CODIGO", 0) != 1 and "TIPODOCUMENTO" in data:
@@ -210,17 +354,39 @@ def fetch_record(doc_type: str, doc_id: str) -> Optional[DocRecord]:
                 record = data[0]
 
     except Exception as exc:
-        print(f"Error fetching record: {exc}")
+        UPSTREAM_ERRORS.inc(call="doc_api")
+        log.warning("Error fetching record: %s", exc)
     
     if record is None:
         try:
-            record = validate_rights(doc_type.upper(), doc_id)
-            print(f"{record}")
+            record = validate_rights(doc_type, doc_id)
+            answered = True
         except Exception as exc:
-            print(f"Error validating rights: {exc}")
+            UPSTREAM_ERRORS.inc(call="validate_rights")
+            log.warning("Error validating rights: %s", exc)
+
+    if record is None and not answered:
+        raise UpstreamUnavailable(f"no affiliate source answered for {doc_type}")
+    return record
 
+def lookup_record(doc_type: str, doc_id: str) -> Optional[DocRecord]:
+    """Affiliate record, or None when not found; raises UpstreamUnavailable."""
+    key = (doc_type.upper(), doc_id)
+    record = records.get(key)
+    if record is _MISSING:
+        record = _lookup_record(*key)
+        records.put(key, record)
     return record
 
+def fetch_record(doc_type: str, doc_id: str) -> Optional[DocRecord]:
+    try:
+        return lookup_record(doc_type, doc_id)
+    except UpstreamUnavailable as exc:
+        log.warning("%s", exc)
+        return None
+
+@traced("upstream.get_inventory")
+@timed_upstream("get_inventory")
 def get_inventory(centro: str, cod_mol: str, token: str,
                   *, timeout: int = TIMEOUT) -> int:
     headers = {
@@ -231,10 +397,14 @@ def get_inventory(centro: str, cod_mol: str, token: str,
     data = {"Centro": centro, "CodMol": cod_mol}
 
     try:
-        resp = requests.post(INV_EP, headers=headers, data=data, timeout=timeout)
+        resp = _http.post(INV_EP, headers=headers, data=data, timeout=timeout)
+        if resp.status_code == 401:
+            medicar_tokens.invalidate(token)
         resp.raise_for_status()
         inv_json: Any = resp.json()
     except Exception as exc:
+        # reported as 0 stock, so timed_upstream never sees it raise
+        UPSTREAM_ERRORS.inc(call="get_inventory")
         log.warning("Inventory lookup failed for (%s, %s): %s", centro, cod_mol, exc)
         return 0
 
@@ -248,15 +418,17 @@ def get_inventory(centro: str, cod_mol: str, token: str,
             return int(node.get("Inventario", 0) or node.get("InventarioMoleculaCentro", 0) or 0)
 
     return 0
+@traced("upstream.fetch_history")
+@timed_upstream("fetch_history")
 def fetch_history(doc_num: str) -> list[HistoryRecord]:
-    token = get_token(EMAIL, PASSWORD)
+    token = medicar_tokens.get()
 
     body = {
         "NumeroDocumento": doc_num,
         "DiasDispensacion": 90,
         "PendientesActivos": True,
     }
-    data = post_json(DATA_EP, token, body)
+    data = post_json(DATA_EP, token, body, tokens=medicar_tokens)
     if data is None:
         raise RuntimeError("historial: respuesta vacia")
         return []
@@ -283,20 +455,27 @@ def fetch_history(doc_num: str) -> list[HistoryRecord]:
             )
             records.append(rec)
 
-    print(f"records built: %d → %s", len(records), records[:3])
+    log.debug("history records built: %d", len(records))
     return records
 
-def med_status_msg(recs: Iterable[HistoryRecord]) -> str | None:
+def med_availability(recs: Iterable[HistoryRecord]) -> list[tuple[HistoryRecord, int]]:
+    """Pending records paired with the current stock at their centro."""
     pending = [r for r in recs if r.cant_pendiente]
     if not pending:
-        return "No tienes medicamentos pendientes en este momento."
-    
-    token = get_token(EMAIL, PASSWORD)
+        return []
 
-    lines = []
+    token = medicar_tokens.get()
+
+    items = []
     for r in pending:
         available = get_inventory(r.centro, r.cod_mol, token) or 0
-        print(f"Medicamento disponible: {available}")#DEBUG
+        log.debug("Inventory for (%s, %s): %s", r.centro, r.cod_mol, available)
+        items.append((r, available))
+    return items
+
+def med_status_lines(items: Iterable[tuple[HistoryRecord, int]]) -> list[str]:
+    lines = []
+    for r, available in items:
         if r.centro == "920" and r.cant_pendiente <= available:
             lines.append(
                 f"*{r.descripcion.capitalize()}* se encuentra disponible en la central de domicilio!\n"
@@ -315,5 +494,90 @@ def med_status_msg(recs: Iterable[HistoryRecord]) -> str | None:
                 f"*{r.descripcion.capitalize()}* sigue en gestion de compra.\n"
                 f"*Por favor intentalo mas tarde*"
             )
-    return "\n\n".join(lines)
+    return lines
+
+def render_med_status(items: Iterable[tuple[HistoryRecord, int]]) -> str:
+    return "\n\n".join(med_status_lines(items)) or NO_PENDING_MEDS
+
+def pack_messages(lines: Iterable[str], limit: int = WA_TEXT_LIMIT) -> list[str]:
+    """Join lines into as few messages as fit under WhatsApp's text limit."""
+    messages, current = [], ""
+    for line in lines:
+        line = line[:limit]
+        if current and len(current) + 2 + len(line) > limit:
+            messages.append(current)
+            current = ""
+        current = f"{current}\n\n{line}" if current else line
+    if current:
+        messages.append(current)
+    return messages
+
+def stream_med_status(recs: Iterable[HistoryRecord], send, *,
+                      notice_after: float = MED_STATUS_NOTICE,
+                      batch_window: float = MED_STATUS_BATCH,
+                      timeout: float = fanout.FANOUT_TIMEOUT) -> list[tuple[HistoryRecord, int]]:
+    """Send the medication status through send(text) as inventory lookups finish.
+
+    Lookups run in parallel. If they all finish within `notice_after` the
+    patient gets the usual reply; otherwise a short notice goes out, then
+    each `batch_window` whatever has arrived since. Returns every
+    (record, available) pair in the original order; a lookup still
+    running after `timeout` counts as no stock.
+    """
+    pending = [r for r in recs if r.cant_pendiente]
+    if not pending:
+        send(NO_PENDING_MEDS)
+        return []
+
+    token = medicar_tokens.get()
+    futures = {fanout.submit(get_inventory, r.centro, r.cod_mol, token): i
+               for i, r in enumerate(pending)}
+    available: Dict[int, int] = {}
+
+    def collect(done) -> list[int]:
+        for f in done:
+            try:
+                available[futures[f]] = f.result() or 0
+            except Exception as exc:
+                log.warning("Inventory lookup failed: %s", exc)
+                available[futures[f]] = 0
+        return [futures[f] for f in done]
+
+    def give_up(late) -> list[int]:
+        log.warning("%d inventory lookups timed out", len(late))
+        for f in late:
+            f.cancel()
+            available[futures[f]] = 0
+        return [futures[f] for f in late]
+
+    def flush(indexes: list[int]):
+        for text in pack_messages(med_status_lines((pending[i], available[i]) for i in sorted(indexes))):
+            send(text)
+
+    deadline = time.monotonic() + timeout
+    done, not_done = wait(futures, timeout=min(notice_after or timeout, timeout))
+    if not not_done or not notice_after:
+        flush(collect(done) + give_up(not_done) if not_done else collect(done))
+        return [(r, available[i]) for i, r in enumerate(pending)]
+
+    send(MED_STATUS_WAIT_REPLY)
+    batch = collect(done)
+    flush_at = time.monotonic()
+    while True:
+        now = time.monotonic()
+        if batch and (now >= flush_at or not not_done):
+            flush(batch)
+            batch = []
+            flush_at = now + batch_window
+        if not not_done:
+            break
+        if now >= deadline:
+            flush(batch + give_up(not_done))
+            break
+        wake = min(deadline, flush_at) if batch else deadline
+        done, not_done = wait(not_done, timeout=max(0.0, wake - now), return_when=FIRST_COMPLETED)
+        batch += collect(done)
+    return [(r, available[i]) for i, r in enumerate(pending)]
 
+def med_status_msg(recs: Iterable[HistoryRecord]) -> str | None:
+    return render_med_status(med_availability(recs))
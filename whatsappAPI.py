@@ -1,17 +1,77 @@
-import os, json, logging, requests
-from typing import List
+import os, time, logging, threading, requests
+from typing import Dict, List, Optional
 from dotenv import load_dotenv
+from fanout import fan_out, FanOutResult
+import jsonCodec
+import metrics
+import delivery
+from tracing import traced
 load_dotenv()
 
 log = logging.getLogger(__name__)
 
 PHONE_ID     = os.getenv("WA_PHONE_ID")
 ACCESS_TOKEN = os.getenv("WA_TOKEN")
-API_ROOT     = f"https://graph.facebook.com/v19.0/{PHONE_ID}/messages"
+GRAPH_URL    = os.getenv("GRAPH_API_URL", "https://graph.facebook.com/v19.0")
+API_ROOT     = f"{GRAPH_URL}/{PHONE_ID}/messages"
 HEADERS      = {"Authorization": f"Bearer {ACCESS_TOKEN}",
                 "Content-Type": "application/json"}
 AGENTS = os.getenv("HUMAN_AGENTS", "").split(",")
 
+# WA_PHONE_IDS - Further business numbers served besides WA_PHONE_ID, as
+#                "phone_id[:msgs_per_s],..." (same WA_TOKEN)
+# WA_RATE      - Default send rate per number in messages/s (default: 80)
+# WA_BURST     - Messages a number may send back to back before pacing (default: 20)
+# WA_TIMEOUT   - Seconds to wait for Graph to answer a send (default: 8); keeps a hung
+#                call from pinning a fan-out or outbox thread past its deadline/lease
+# DISPATCH_PEERS - Set by the dispatcher in each of its workers; rate and burst are
+#                  split between them so the number's budget is not multiplied
+WA_RATE  = float(os.getenv("WA_RATE", "80"))
+WA_BURST = float(os.getenv("WA_BURST", "20"))
+WA_TIMEOUT = (3.05, float(os.getenv("WA_TIMEOUT", "8")))   # (connect, read)
+PEERS = max(1, int(os.getenv("DISPATCH_PEERS", "1")))
+
+RATE_WAIT = metrics.counter("wa_rate_limit_wait_seconds_total",
+                            "Time sends spent waiting for their number's rate limit")
+
+class PhoneNumber:
+    """One business number: its endpoint and its send pacing (GCRA)."""
+
+    def __init__(self, phone_id: str, rate: float = WA_RATE, burst: float = WA_BURST):
+        self.phone_id = phone_id
+        self.api_root = f"{GRAPH_URL}/{phone_id}/messages"
+        self.interval = PEERS / rate if rate > 0 else 0.0
+        self.burst = max(1.0, burst / PEERS)
+        self._tat = 0.0     # theoretical arrival time of the next send
+        self._lock = threading.Lock()
+
+    def throttle(self) -> float:
+        """Block until this number may send again; returns the seconds waited."""
+        if not self.interval:
+            return 0.0
+        with self._lock:
+            now = time.monotonic()
+            self._tat = max(self._tat, now) + self.interval
+            wait = self._tat - now - self.burst * self.interval
+        if wait > 0:
+            time.sleep(wait)
+            RATE_WAIT.inc(wait, phone_id=self.phone_id)
+            return wait
+        return 0.0
+
+def _parse_numbers() -> Dict[str, PhoneNumber]:
+    numbers = {PHONE_ID: PhoneNumber(PHONE_ID)}
+    for entry in filter(None, (e.strip() for e in os.getenv("WA_PHONE_IDS", "").split(","))):
+        phone_id, _, rate = entry.partition(":")
+        numbers[phone_id] = PhoneNumber(phone_id, float(rate) if rate else WA_RATE)
+    return numbers
+
+NUMBERS = _parse_numbers()
+
+def number_for(phone_id: Optional[str]) -> PhoneNumber:
+    """The configured number with this id, or the default (WA_PHONE_ID) one."""
+    return NUMBERS.get(phone_id) or NUMBERS[PHONE_ID]
+
 def send_chatwoot_reply(convo_id: int, text: str):
     # Local import avoids circular dependency
     from chatwootWebhook import _cw_api as cw_api
@@ -25,30 +85,66 @@ def send_chatwoot_reply(convo_id: int, text: str):
         },
     )
 
-def notify_agent(user_phone: str, doc_num: str):
+def send_to_agents(body: str) -> FanOutResult:
+    """Send the same text to every agent concurrently."""
+    result = fan_out(lambda a: send_text(a, body), AGENTS)
+    if result.failed:
+        log.warning("Agent fan-out: %s", result.summary())
+    return result
+
+def notify_agent(user_phone: str, doc_num: str) -> FanOutResult:
     """Ping all agents when a hand‑off starts."""
-    body = f"⚠️ Nuevo chat 👉 {user_phone}  (doc {doc_num})"
-    for a in filter(None, AGENTS):
-        send_text(a, body)
+    return send_to_agents(f"⚠️ Nuevo chat 👉 {user_phone}  (doc {doc_num})")
 
-def forward_to_agent(user_phone: str, text: str):
+def forward_to_agent(user_phone: str, text: str) -> FanOutResult:
     """Relay every customer message to the agents."""
-    for a in filter(None, AGENTS):
-        send_text(a, f"[{user_phone}] {text}")
+    return send_to_agents(f"[{user_phone}] {text}")
 
-def _post(payload:dict) -> dict:
-    resp = requests.post(API_ROOT, headers=HEADERS, data=json.dumps(payload))
+@traced("upstream.wa_post")
+def _post(payload:dict, session: requests.Session | None = None,
+          phone_id: str | None = None) -> dict:
+    number = number_for(phone_id)
+    number.throttle()
+    start = time.perf_counter()
     try:
-        data = resp.json()
-    
-    except ValueError:
+        resp = (session or requests).post(number.api_root, headers=HEADERS,
+                                          data=jsonCodec.dumps(payload), timeout=WA_TIMEOUT)
+        try:
+            data = jsonCodec.loads(resp.content)
+        
+        except ValueError:
+            resp.raise_for_status()
+        if resp.status_code>= 300:
+            log.error("WA error %s -> %s", resp.status_code, data)
+            raise RuntimeError(data)
+        for msg in data.get("messages") or ():
+            delivery.tracker.sent(msg["id"], number.phone_id)
+        return data
+    except Exception:
+        metrics.UPSTREAM_ERRORS.inc(call="wa_post", phone_id=number.phone_id)
+        raise
+    finally:
+        metrics.UPSTREAM_SECONDS.observe(time.perf_counter() - start,
+                                         call="wa_post", phone_id=number.phone_id)
+
+@traced("upstream.wa_media_info")
+def media_info(media_id: str, *, session=None, phone_id=None) -> dict:
+    """Graph's short-lived download url plus mime_type, sha256 and file_size for an inbound media id."""
+    number = number_for(phone_id)
+    start = time.perf_counter()
+    try:
+        resp = (session or requests).get(f"{GRAPH_URL}/{media_id}", headers=HEADERS,
+                                         params={"phone_number_id": number.phone_id}, timeout=WA_TIMEOUT)
         resp.raise_for_status()
-    if resp.status_code>= 300:
-        log.error("WA error %s -> %s", resp.status_code, data)
-        raise RuntimeError(data)
-    return data
+        return jsonCodec.loads(resp.content)
+    except Exception:
+        metrics.UPSTREAM_ERRORS.inc(call="wa_media_info", phone_id=number.phone_id)
+        raise
+    finally:
+        metrics.UPSTREAM_SECONDS.observe(time.perf_counter() - start,
+                                         call="wa_media_info", phone_id=number.phone_id)
 
-def send_text(to: str, body: str, preview_url: bool = False) -> str:
+def send_text(to: str, body: str, preview_url: bool = False, *, session=None, phone_id=None) -> str:
     if not to:
         log.warning("send_text called with empty 'to'; skipping")
         return ""
@@ -59,7 +155,25 @@ def send_text(to: str, body: str, preview_url: bool = False) -> str:
         "type": "text",
         "text": {"body": body, "preview_url": preview_url}
     }
-    return _post(payload)["messages"][0]["id"]
+    return _post(payload, session, phone_id)["messages"][0]["id"]
+
+def send_template(to: str, name: str, params: List[str], lang: str = "es",
+                  *, session=None, phone_id=None) -> str:
+    """Send an approved template; the only kind Graph accepts outside the 24h window."""
+    payload = {
+        "messaging_product": "whatsapp",
+        "to": to,
+        "type": "template",
+        "template": {
+            "name": name,
+            "language": {"code": lang},
+            "components": [{
+                "type": "body",
+                "parameters": [{"type": "text", "text": p} for p in params],
+            }],
+        },
+    }
+    return _post(payload, session, phone_id)["messages"][0]["id"]
 
 def confirm_text(body: str, toConfirm: str) -> bool:
     if (str == toConfirm):
@@ -73,7 +187,8 @@ def send_two_buttons(to: str,
                     yes_id: str,
                     no_id: str,
                     str1: str,
-                    str2: str) -> str:
+                    str2: str,
+                    *, session=None, phone_id=None) -> str:
     if not to:
         raise ValueError("send_two_buttons(): 'to' phone num is empty")
 
@@ -98,9 +213,9 @@ def send_two_buttons(to: str,
             }
         }
     }
-    return _post(payload)["messages"][0]["id"]
+    return _post(payload, session, phone_id)["messages"][0]["id"]
 
-def sendDocType(to: str, body: str):
+def sendDocType(to: str, body: str, *, session=None, phone_id=None):
     if not to:
         raise ValueError("sendDocType(): 'to' phone num is empty")
     
@@ -132,9 +247,9 @@ def sendDocType(to: str, body: str):
             }
         }
     }
-    return _post(payload)["messages"][0]["id"]
+    return _post(payload, session, phone_id)["messages"][0]["id"]
 
-def sendMenu(to: str, body:str):
+def sendMenu(to: str, body:str, *, session=None, phone_id=None):
     if not to:
         raise ValueError("sendDocType(): 'to' phone num is empty")
     
@@ -163,4 +278,4 @@ def sendMenu(to: str, body:str):
             }
         }
     }
-    return _post(payload)["messages"][0]["id"]
+    return _post(payload, session, phone_id)["messages"][0]["id"]